@@ -0,0 +1,145 @@
+"""
+Fire latency against claymore count
+
+Runs on the host (CPython) against loopback stand-ins for the claymores:
+    python3 bench/bench_fire_fanout.py [--counts 4,8,16,32] [--limit 4] [--service-ms 3] [--lead-ms 100]
+
+udp   one ClackSender volley, each ClackListener acknowledging on its own
+      loopback port (stands in for the subnet broadcast). With --lead-ms
+      the listeners clock sync first and actuate together lead ms later;
+      skew is the spread of their actuation times
+http  fallback path: one POST /clack per claymore through HttpPool,
+      run_bounded with --limit in flight, each claymore taking --service-ms
+
+Reports per-claymore dispatch->acknowledged latency (p50, max), the
+time until the whole volley was confirmed and, for udp, the skew.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'host'))
+import hostenv  # noqa: E402
+
+hostenv.install()
+
+import asyncio  # noqa: E402
+from time import ticks_us, ticks_diff  # noqa: E402
+import clack_protocol  # noqa: E402
+from clack_protocol import ClackSender, ClackListener, StateTable, slot_bitmap  # noqa: E402
+from helpers import run_bounded  # noqa: E402
+from http_pool import HttpPool  # noqa: E402
+
+_LOOPBACK = '127.0.0.1'
+_TEAM = 'RED'
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def _servo(at_us=None):
+    # same spin as Claymore.fire_trigger
+    if at_us is not None:
+        while ticks_diff(at_us, ticks_us()) > 0:
+            pass
+
+
+class LoopbackSender(ClackSender):
+    """ 'broadcast' by sending one copy to every listener port """
+    def __init__(self, ports):
+        super().__init__(_LOOPBACK, _TEAM)
+        self.ports = ports
+
+    def _send(self, slots):
+        packet = clack_protocol.struct.pack(
+            clack_protocol._FIRE_FMT, clack_protocol._MAGIC, clack_protocol._VERSION,
+            clack_protocol.FIRE, self.epoch, self.seq, slots, self.team.encode(), self._at,
+            self._trace)
+        for port in self.ports:
+            self.sock.sendto(packet, (_LOOPBACK, port))
+
+
+async def bench_udp(count, lead_ms, base_port=15005):
+    tasks = [asyncio.create_task(StateTable().run())]  # answers SYNC
+    listeners = []
+    ports = [base_port + slot for slot in range(count)]
+    for slot, port in enumerate(ports):
+        listener = ClackListener(_servo, port=port)
+        listener.clacker_ip, listener.team, listener.slot = _LOOPBACK, _TEAM, slot
+        listeners.append(listener)
+        tasks.append(asyncio.create_task(listener.run()))
+    sender = LoopbackSender(ports)
+    tasks.append(asyncio.create_task(sender.run()))
+    await asyncio.sleep(0.05)  # let the listeners bind
+    if lead_ms:
+        await asyncio.gather(*[listener.sync() for listener in listeners])
+
+    start = ticks_us()
+    acked = await sender.fire(slot_bitmap(range(count)), lead_ms=lead_ms)
+    total = ticks_diff(ticks_us(), start)
+    await asyncio.sleep((lead_ms + 50) / 1000)  # FIRED follows SCHEDULED at actuate-at
+    for task in tasks:
+        task.cancel()
+    latencies = [report['rtt_us'] for report in sender.reports.values()]
+    return len(acked), latencies, total, sender.skew()
+
+
+async def bench_http(count, limit, service_ms):
+    async def claymore(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            length = 0
+            while line not in (b'\r\n', b''):
+                line = await reader.readline()
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            await asyncio.sleep(service_ms / 1000)
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nFIRE')
+            await writer.drain()
+        writer.close()
+
+    servers = [await asyncio.start_server(claymore, _LOOPBACK, 0) for _ in range(count)]
+    urls = [f'http://{_LOOPBACK}:{server.sockets[0].getsockname()[1]}/clack' for server in servers]
+    pool = HttpPool(max_connections=limit)
+    latencies = []
+    start = ticks_us()
+
+    async def fire(url):
+        await pool.post(url, json={'token': 'bench'})
+        latencies.append(ticks_diff(ticks_us(), start))
+
+    results = await run_bounded([fire(url) for url in urls], limit)
+    total = ticks_diff(ticks_us(), start)
+    await pool.close()
+    for server in servers:
+        server.close()
+    return sum(1 for r in results if not isinstance(r, Exception)), latencies, total, None
+
+
+async def main(args):
+    rows = []
+    for count in args.counts:
+        for path, coro in (
+                ('udp', bench_udp(count, args.lead_ms)),
+                ('http', bench_http(count, args.limit, args.service_ms))):
+            acked, latencies, total, skew = await coro
+            p50 = _percentile(latencies, 50) / 1000 if latencies else float('nan')
+            worst = max(latencies) / 1000 if latencies else float('nan')
+            skew = '-' if skew is None else f'{skew / 1000:.2f}'
+            rows.append(f'{count:>9} {path:>5} {acked:>6} {p50:>8.2f} {worst:>8.2f} {total / 1000:>10.2f} {skew:>8}')
+    print(f"{'claymores':>9} {'path':>5} {'acked':>6} {'p50 ms':>8} {'max ms':>8} {'volley ms':>10} {'skew ms':>8}")
+    print('\n'.join(rows))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=lambda v: [int(c) for c in v.split(',')], default=[4, 8, 16, 32])
+    parser.add_argument('--limit', type=int, default=4, help='HTTP requests in flight (clacker _FANOUT)')
+    parser.add_argument('--service-ms', type=float, default=3.0, help='claymore time to handle POST /clack')
+    parser.add_argument('--lead-ms', type=int, default=0, help='synchronized fire this long after the FIRE')
+    asyncio.run(main(parser.parse_args()))
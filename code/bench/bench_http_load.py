@@ -0,0 +1,271 @@
+"""
+HTTP load against the clacker and claymore web servers
+
+Runs on the host (CPython), against a device on the network or one booted
+under the host/ emulation layer:
+    python3 bench/bench_http_load.py --url http://192.168.4.1 [--device clacker]
+    python3 bench/bench_http_load.py --boot clacker|claymore
+        [--concurrency 1,2,4,8,16] [--duration-s 10] [--mix /=1,/ping=4,/clack=4,/register/<mac>=1]
+        [--label v1.2] [--json report.json] [--compare base.json]
+
+Every client is a phone: it opens a connection, sends one GET, reads the
+response to the end (tinyweb closes every connection) and goes again,
+picking the path at random with the --mix weights (<mac> becomes one of
+--macs made up MACs; GET /register/<mac> only looks the MAC up, so its
+404 'unknown mac' is a served answer, not an error). For each
+concurrency level, --duration-s of load gives
+    latency     p50/p95/p99 ms per path and overall, from connect to the
+                last byte
+    errors      non-200 answers, refused/reset connections and timeouts
+                (--timeout-s) as % of requests
+    heap        mem_free and mem_alloc from the device's GET /metrics
+                right after the level (--boot runs the device with
+                tracemalloc, so mem_alloc is its Python heap)
+tolerated is the highest level at which /clack p95 stayed within --slo-ms
+(default 3x its p95 at the first level) and errors within --max-error-pct.
+
+--json writes the report, with the firmware's git revision and --label;
+--compare prints the p95 and error changes against an earlier report.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIXES = {
+    'clacker': '/=1,/ping=4,/clack=4,/register/<mac>=1',
+    'claymore': '/=1,/ping=4,/status=2,/clack=4',
+}
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pct(p):
+        return round(values[min(len(values) - 1, int(len(values) * p / 100))], 2)
+    return {'n': len(values), 'p50': pct(50), 'p95': pct(95), 'p99': pct(99), 'max': round(values[-1], 2)}
+
+
+def _mix(spec):
+    paths = {}
+    for item in spec.split(','):
+        path, _, weight = item.rpartition('=')
+        paths[path] = float(weight)
+    return paths
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=CODE, stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def http_get(host, port, path, timeout_s):
+    """ one GET on its own connection: (status, body) """
+    async def exchange():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(f'GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n'.encode())
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        fields = head.split(None, 2)
+        if len(fields) < 2:
+            raise ConnectionResetError('no status line')
+        return int(fields[1]), body
+    return await asyncio.wait_for(exchange(), timeout_s)
+
+
+class Load:
+    def __init__(self, args, host, port):
+        self.args = args
+        self.host = host
+        self.port = port
+        self.mix = _mix(args.mix or MIXES[args.device])
+        self.macs = [f'02{random.getrandbits(40):010X}' for _ in range(args.macs)]
+
+    def pick(self):
+        path = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        return path, path.replace('<mac>', random.choice(self.macs))
+
+    async def client(self, deadline, results):
+        while time.monotonic() < deadline:
+            path, url = self.pick()
+            start = time.monotonic()
+            try:
+                status, _ = await http_get(self.host, self.port, url, self.args.timeout_s)
+                served = status == 200 or (status == 404 and '<' in path)
+                error = None if served else f'http_{status}'
+            except asyncio.TimeoutError:
+                error = 'timeout'
+            except OSError as e:
+                error = type(e).__name__
+            results.append((path, (time.monotonic() - start) * 1000, error))
+            if error and error != 'timeout':
+                await asyncio.sleep(0.05)  # a refusing server is not worth hammering
+
+    async def heap(self):
+        try:
+            status, body = await http_get(self.host, self.port, '/metrics', self.args.timeout_s)
+            metrics = json.loads(body) if status == 200 else {}
+        except (OSError, asyncio.TimeoutError, ValueError):
+            metrics = {}
+        return {key: metrics.get(key) for key in ('mem_free', 'mem_alloc')}
+
+    async def level(self, concurrency):
+        results = []
+        deadline = time.monotonic() + self.args.duration_s
+        started = time.monotonic()
+        await asyncio.gather(*(self.client(deadline, results) for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+        errors = {}
+        for _, _, error in results:
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+        paths = {}
+        for path in self.mix:
+            mine = [r for r in results if r[0] == path]
+            paths[path] = {
+                'latency_ms': _percentiles([ms for _, ms, error in mine if not error]),
+                'error_pct': round(100 * sum(1 for r in mine if r[2]) / len(mine), 2) if mine else None}
+        await asyncio.sleep(1)  # let the server finish closing before sampling its heap
+        return {
+            'concurrency': concurrency, 'requests': len(results), 'rps': round(len(results) / elapsed, 1),
+            'errors': errors, 'error_pct': round(100 * sum(errors.values()) / max(1, len(results)), 2),
+            'latency_ms': _percentiles([ms for _, ms, error in results if not error]),
+            'paths': paths, 'heap': await self.heap()}
+
+    def tolerated(self, levels):
+        def p95(level):
+            latency = level['paths'].get('/clack', {}).get('latency_ms') or level['latency_ms']
+            return latency['p95'] if latency else None
+        slo = self.args.slo_ms or (3 * p95(levels[0]) if levels and p95(levels[0]) else None)
+        best = None
+        for level in levels:
+            if p95(level) is None or (slo and p95(level) > slo) or level['error_pct'] > self.args.max_error_pct:
+                break
+            best = level['concurrency']
+        return best, slo
+
+    async def run(self):
+        report = {
+            'target': f'{self.host}:{self.port}', 'device': self.args.device, 'firmware': _revision(),
+            'label': self.args.label, 'mix': self.mix, 'duration_s': self.args.duration_s,
+            'heap_idle': await self.heap(), 'levels': []}
+        for concurrency in self.args.concurrency:
+            print(f'concurrency {concurrency}', file=sys.stderr)
+            report['levels'].append(await self.level(concurrency))
+        report['tolerated_concurrency'], report['slo_ms'] = self.tolerated(report['levels'])
+        return report
+
+
+async def boot(args, workdir):
+    """ the device under test on the host emulation layer: (fleet, ip) """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fleet_sim import Fleet
+    import hostenv
+    fleet = Fleet(argparse.Namespace(mode='process', tracemalloc=True), 1 if args.device == 'claymore' else 0, workdir)
+    hostenv.ETHER = fleet.ether
+    await fleet.boot_clacker()
+    if args.device == 'clacker':
+        return fleet, fleet.clacker_ip
+    fleet.boot_claymores()
+    await fleet.registration(60)
+    ips = {name: ip for ip, name in fleet.ip_names().items()}
+    if fleet.names[0] not in ips:
+        fleet.stop()
+        raise RuntimeError('the claymore did not join, see its log')
+    return fleet, ips[fleet.names[0]]
+
+
+def _or_dash(value):
+    return '-' if value is None else value
+
+
+def _compare(report, base):
+    print(f"\nagainst {base.get('label') or base.get('firmware')}:")
+    print(f"{'conc':>5} {'p95 ms':>14} {'/clack p95 ms':>16} {'err %':>14}")
+    before = {level['concurrency']: level for level in base['levels']}
+    for level in report['levels']:
+        old = before.get(level['concurrency'])
+        if not old:
+            continue
+
+        def delta(get):
+            a, b = get(old), get(level)
+            return '-' if a is None or b is None else f'{a:.1f}->{b:.1f}'
+        print(f"{level['concurrency']:>5} {delta(lambda l: (l['latency_ms'] or {}).get('p95')):>14} "
+              f"{delta(lambda l: ((l['paths'].get('/clack') or {}).get('latency_ms') or {}).get('p95')):>16} "
+              f"{delta(lambda l: l['error_pct']):>14}")
+
+
+async def main(args):
+    fleet = None
+    workdir = None
+    if args.boot:
+        args.device = args.boot
+        workdir = tempfile.mkdtemp(prefix='httpload')
+        fleet, host = await boot(args, workdir)
+        port = 80
+    else:
+        url = args.url.split('://', 1)[-1].rstrip('/')
+        host, _, port = url.partition(':')
+        port = int(port or 80)
+    try:
+        report = await Load(args, host, port).run()
+    finally:
+        if fleet:
+            fleet.stop()
+            await fleet.http.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'conc':>5} {'req/s':>7} {'err %':>6} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} "
+          f"{'clack p95':>9} {'mem_free':>9} {'mem_alloc':>9}")
+    for level in report['levels']:
+        latency = level['latency_ms'] or {}
+        clack = (level['paths'].get('/clack') or {}).get('latency_ms') or {}
+        heap = level['heap']
+        print(f"{level['concurrency']:>5} {level['rps']:>7} {level['error_pct']:>6} {latency.get('p50', '-'):>7} "
+              f"{latency.get('p95', '-'):>7} {latency.get('p99', '-'):>7} {clack.get('p95', '-'):>9} "
+              f"{_or_dash(heap['mem_free']):>9} {_or_dash(heap['mem_alloc']):>9}")
+    print(f"tolerated concurrency: {report['tolerated_concurrency']} (/clack p95 <= {report['slo_ms']} ms, "
+          f"errors <= {args.max_error_pct}%)")
+    if args.compare:
+        with open(args.compare) as fh:
+            _compare(report, json.load(fh))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='a device on the network, e.g. http://192.168.4.1')
+    target.add_argument('--boot', choices=['clacker', 'claymore'], help='boot this device on the host')
+    parser.add_argument('--device', choices=['clacker', 'claymore'], default='clacker',
+                        help='what --url is, picks the default mix')
+    parser.add_argument('--concurrency', type=lambda v: [int(c) for c in v.split(',')], default=[1, 2, 4, 8, 16])
+    parser.add_argument('--duration-s', type=float, default=10, help='load per concurrency level')
+    parser.add_argument('--mix', help='PATH=WEIGHT,... (default per device)')
+    parser.add_argument('--macs', type=int, default=8, help='MACs /register/<mac> picks from')
+    parser.add_argument('--timeout-s', type=float, default=5)
+    parser.add_argument('--slo-ms', type=float, help='/clack p95 a tolerated level stays within')
+    parser.add_argument('--max-error-pct', type=float, default=1.0)
+    parser.add_argument('--label', help='e.g. the firmware version, stored in the report')
+    parser.add_argument('--json', help='write the report here')
+    parser.add_argument('--compare', help='an earlier --json report')
+    asyncio.run(main(parser.parse_args()))
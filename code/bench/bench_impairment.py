@@ -0,0 +1,178 @@
+"""
+Reconnect and fire reliability over an impaired Wi-Fi link
+
+Runs on the host (CPython) with the host/ emulation layer:
+    python3 bench/bench_impairment.py [--claymores 3] [--profiles clean,latency,jitter,loss10,marginal]
+                                      [--profile NAME:latency_ms=50,jitter_ms=20,loss=0.1]
+                                      [--fires 5] [--drop-s 20] [--json report.json] [--keep DIR]
+
+Boots clacker/main.py and --claymores claymore/main.py processes (see
+fleet_sim.py), waits for them to register, then for every profile impairs
+each claymore's link with hostenv.impair(): every packet to or from it is
+delayed by latency_ms plus up to jitter_ms, datagrams are lost with
+probability loss (TCP segments come a retransmission timeout late).
+Under the profile it
+1. fires --fires times (arm every page, long press FIRE)
+   fire %   claymores whose servo went off / claymores registered
+   ack %    of those, the ones whose UDP ACK the clacker got (the rest
+            were reached by the HTTP fallback or not at all)
+2. cuts every claymore's link for --drop-s, then restores it
+   detect     cut -> the claymore's ping_forever saw WLAN status LINK_DOWN
+   reconnect  restored -> WLAN connected again
+   resumed    restored -> the clacker accepted a state push from it again
+   (p50/max over the claymores, '-' if none did within --recover-s)
+
+The claymores' watchdogs are off (a loaded host is not a hung device), so
+a blocking reconnect shows up as time, not as a reset.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fleet_sim import Fleet, _percentiles, _IP_TIMEOUT  # noqa: E402
+import hostenv  # noqa: E402
+import uasyncio as asyncio  # noqa: E402
+from time import ticks_us, ticks_ms, ticks_diff  # noqa: E402
+
+PROFILES = {
+    'clean': {},
+    'latency': {'latency_ms': 50, 'jitter_ms': 20},
+    'jitter': {'latency_ms': 20, 'jitter_ms': 200},
+    'loss10': {'loss': 0.1},
+    'marginal': {'latency_ms': 40, 'jitter_ms': 80, 'loss': 0.3},
+}
+_SETTLE = 2  # s under a new profile before measuring
+
+
+def _profile(spec):
+    """ NAME:key=value,key=value """
+    name, _, conf = spec.partition(':')
+    return name, {k: float(v) for k, v in (kv.split('=') for kv in conf.split(',') if kv)}
+
+
+class Impairment:
+    def __init__(self, fleet, args):
+        self.fleet = fleet
+        self.args = args
+
+    def impair(self, **conf):
+        for name in self.fleet.slots:
+            hostenv.impair(name, **conf)
+
+    async def wlan_events(self, name, event, since_us):
+        actions = (await self.fleet.ctl(name, {'cmd': 'actions', 'kind': 'wlan'}))['actions']
+        return [us for us, _, _, value in actions if value == event and ticks_diff(us, since_us) > 0]
+
+    async def fires(self):
+        await self.fleet.fire(self.args.fires)
+        fire = self.fleet.report.pop('fire')
+        attempts = self.args.fires * len(self.fleet.slots)
+        return {
+            'fire_pct': round(100 * sum(fire['fired_per_fire']) / attempts, 1),
+            'ack_pct': round(100 * sum(fire['armed_per_fire']) / attempts, 1),
+            'servo_ms': fire['servo_ms']}
+
+    async def link_drop(self, conf):
+        fleet = self.fleet
+        cut = ticks_us()
+        self.impair(**dict(conf, down=True))
+        await asyncio.sleep(self.args.drop_s)
+        restored, restored_ms = ticks_us(), ticks_ms()
+        self.impair(**conf)
+
+        resumed = {}  # slot -> ms
+        deadline = time.monotonic() + self.args.recover_s
+        while len(resumed) < len(fleet.slots) and time.monotonic() < deadline:
+            await asyncio.sleep_ms(250)
+            try:
+                states = (await fleet.get('/clack'))['states']
+            except (OSError, asyncio.TimeoutError, ValueError):
+                continue
+            for slot, state in states.items():
+                if slot not in resumed and ticks_diff(state['seen'], restored_ms) > 0:
+                    resumed[slot] = ticks_diff(state['seen'], restored_ms)
+
+        detect, reconnect = [], []
+        for name in fleet.slots:
+            downs = await self.wlan_events(name, 'down', cut)
+            ups = await self.wlan_events(name, 'up', restored)
+            if downs and ticks_diff(downs[0], restored) < 0:
+                detect.append(ticks_diff(downs[0], cut) / 1000000)
+            if ups:
+                reconnect.append(ticks_diff(ups[0], restored) / 1000000)
+        return {
+            'detect_s': _percentiles(detect),
+            'reconnect_s': _percentiles(reconnect),
+            'resumed_s': _percentiles([ms / 1000 for ms in resumed.values()]),
+            'not_resumed': len(fleet.slots) - len(resumed)}
+
+    async def run(self, profiles):
+        fleet = self.fleet
+        hostenv.ETHER = fleet.ether
+        results = {}
+        try:
+            await fleet.boot_clacker()
+            fleet.boot_claymores()
+            await fleet.registration(self.args.register_s)
+            if not fleet.slots:
+                raise RuntimeError('no claymore registered, see the logs')
+            for name, conf in profiles:
+                print(f'profile {name} {conf}', file=sys.stderr)
+                self.impair(**conf)
+                await asyncio.sleep(_SETTLE)
+                results[name] = dict(conf=conf, **await self.fires())
+                results[name].update(await self.link_drop(conf))
+                self.impair()
+        finally:
+            for name in fleet.slots:
+                hostenv.impair(name)
+            fleet.stop()
+            await fleet.http.close()
+        return {'claymores': len(fleet.slots), 'drop_s': self.args.drop_s, 'profiles': results}
+
+
+def _fmt(d, key='p50'):
+    return '-' if not d else f'{d[key]:.1f}'
+
+
+async def main(args):
+    profiles = [(name, PROFILES[name]) for name in args.profiles]
+    profiles.extend(_profile(spec) for spec in args.profile)
+    workdir = args.keep or tempfile.mkdtemp(prefix='impair')
+    os.makedirs(workdir, exist_ok=True)
+    fleet_args = argparse.Namespace(mode='process', tracemalloc=False)
+    try:
+        report = await Impairment(Fleet(fleet_args, args.claymores, workdir), args).run(profiles)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print(f"{'profile':>10} {'fire %':>6} {'ack %':>6} {'servo p50':>9} {'detect p50':>10} {'detect max':>10} "
+          f"{'reconn p50':>10} {'reconn max':>10} {'resumed p50':>11} {'lost':>4}")
+    for name, r in report['profiles'].items():
+        print(f"{name:>10} {r['fire_pct']:>6} {r['ack_pct']:>6} {_fmt(r['servo_ms']):>9} "
+              f"{_fmt(r['detect_s']):>10} {_fmt(r['detect_s'], 'max'):>10} {_fmt(r['reconnect_s']):>10} "
+              f"{_fmt(r['reconnect_s'], 'max'):>10} {_fmt(r['resumed_s']):>11} {r['not_resumed']:>4}")
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--claymores', type=int, default=3)
+    parser.add_argument('--profiles', type=lambda v: v.split(','), default=list(PROFILES))
+    parser.add_argument('--profile', action='append', default=[], type=str,
+                        help='extra profile NAME:latency_ms=..,jitter_ms=..,loss=..')
+    parser.add_argument('--fires', type=int, default=5)
+    parser.add_argument('--drop-s', type=float, default=20, help='how long each link drop lasts')
+    parser.add_argument('--recover-s', type=float, default=8 * _IP_TIMEOUT / 1000,
+                        help='give up waiting for a claymore to come back')
+    parser.add_argument('--register-s', type=float, default=60, help='give up waiting for registrations')
+    parser.add_argument('--json', help='write the full report here')
+    parser.add_argument('--keep', help='keep state, ether and logs under this directory')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,527 @@
+"""
+Fleet simulator: one clacker against N claymores
+
+Runs on the host (CPython) with the host/ emulation layer:
+    python3 bench/fleet_sim.py [--counts 4,16,64] [--mode process|inprocess] [--fires 3]
+                               [--idle-s 20] [--tracemalloc] [--json report.json] [--keep DIR]
+
+The clacker is always clacker/main.py in its own process. The claymores are
+process    claymore/main.py, one process each (host/run_device.py)
+inprocess  virtual claymores sharing this process: the ClackListener,
+           StatePusher and HttpPool of the firmware, registering, pinging,
+           clock syncing and pushing state on claymore/main.py's schedule,
+           each on its own loopback address
+
+Per claymore count the script
+1. boots the clacker, then every claymore at once (door closed)
+2. registration: claymore launch -> first state push the clacker accepted,
+   until all are in or none joined for 18 s (the clacker holds 32)
+3. heartbeat: --idle-s of idling; pings, state pushes, clock sync
+   datagrams and register requests the clacker handles per claymore per
+   minute (turned away claymores keep asking), and clacker CPU
+4. fire, --fires times: arms every claymore (hold one slot button, long
+   press another) and long presses FIRE.
+   ack    FIRE detected -> clacker has the slot's ACK (clacker trace)
+   servo  FIRE detected -> claymore servo set (one host, one clock)
+5. door: opens and closes the door of up to 8 claymores, time until the
+   clacker's pushed state shows it
+6. memory per claymore: process RSS, and with --tracemalloc the Python
+   heap in use (mem_alloc of GET /metrics); inprocess: growth of this
+   process / N
+
+and prints one row per count; --json writes everything.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(CODE, 'host'))
+import hostenv  # noqa: E402
+
+hostenv.install('clacker')
+
+import uasyncio as asyncio  # noqa: E402
+from time import ticks_us, ticks_ms, ticks_diff  # noqa: E402
+import network  # noqa: E402
+from helpers import wait_readable  # noqa: E402
+from http_pool import HttpPool  # noqa: E402
+from clack_protocol import ClackListener, StatePusher, parse_token, FIRED  # noqa: E402
+from tinyweb import webserver  # noqa: E402
+from hardware_red import BTN1_GP, BTN2_GP, BTN3_GP, BTN4_GP, BTN_FIRE_GP  # noqa: E402
+
+
+def _load(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+_CLAYMORE = _load(os.path.join(CODE, 'claymore', 'hardware.py'), 'claymore_pins')
+RUN_DEVICE = os.path.join(CODE, 'host', 'run_device.py')
+BUTTONS = (BTN1_GP, BTN2_GP, BTN3_GP, BTN4_GP)
+_CLOSED, _OPEN = 0, 1  # door pin level
+_PRESSED, _RELEASED = 0, 1
+_IP_TIMEOUT = 6000  # ms, claymore/main.py ping interval and state heartbeat
+_STATE_POLL = 50  # ms, claymore/main.py door/trigger/armed checks
+_TRIGGER_RESET = 3500  # ms, Claymore.TRIGGER_RESET
+_LONG_PRESS = 1200  # ms, Pushbutton.long_press_ms is 1000
+_TAP = 80  # ms per level of a click, Pushbutton samples every 50
+_ARM_PING = 100  # ms per claymore the clacker's arm pings may take, 4 at a time
+_FIRE_SETTLE = 1500  # ms after releasing FIRE until every ACK and FIRED report is in
+_DOORS = 8  # claymores whose door is opened and closed
+_SETTLED = 3 * _IP_TIMEOUT / 1000  # s without a new registration: the rest will not register
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pct(p):
+        return round(values[min(len(values) - 1, int(len(values) * p / 100))], 2)
+    return {'n': len(values), 'p50': pct(50), 'p95': pct(95), 'p99': pct(99), 'max': round(values[-1], 2)}
+
+
+def _proc_rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _proc_cpu_s(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as fh:
+            fields = fh.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+    except OSError:
+        return None
+
+
+class Control:
+    """ JSON datagrams to the control port of a run_device.py process """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(False)
+        self.lock = asyncio.Lock()
+
+    async def __call__(self, name, cmd, timeout_ms=2000):
+        port = hostenv.read(f'ctl_{name}')['port']
+        async with self.lock:
+            self.sock.sendto(json.dumps(cmd).encode(), ('127.0.0.1', port))
+            await asyncio.wait_for_ms(wait_readable(self.sock), timeout_ms)
+            return json.loads(self.sock.recvfrom(65536)[0])
+
+    async def drive(self, name, gpio, value):
+        await self(name, {'cmd': 'drive', 'gpio': gpio, 'value': value})
+
+
+class VirtualClaymore:
+    """ claymore/main.py's network behavior without its hardware, many per process """
+
+    def __init__(self, name):
+        self.name = name
+        self.mac = network.mac_of(name).hex().upper()
+        self.ip = None
+        self.launched = None  # time.monotonic()
+        self.state = {'door': 'CLOSED', 'trigger': 'READY', 'armed': 'OFF'}
+        self.version = 0
+        self.servo_us = []
+        self.pool = HttpPool(max_connections=1, timeout_ms=_IP_TIMEOUT)
+        self.clack = ClackListener(self.fire_trigger)
+        self.pusher = StatePusher()  # its socket binds on first use, from our task
+        self.tasks = []
+        self.app = webserver()  # what the clacker asks a claymore: /ping, /status, POST /clack
+        self.app.add_route('/ping', self._ping)
+        self.app.add_route('/status', self._status)
+        self.app.add_resource(self, '/clack')
+
+    async def _ping(self, _request, response):
+        await response.start_html()
+        await response.send('pong')
+
+    async def _status(self, _request, response):
+        await response.start_html()
+        await response.send(self.state['door'])
+
+    def get(self, data):
+        data.update(self.state)
+        return data
+
+    def post(self, data):
+        token = data.get('token')
+        status = self.clack.actuate(parse_token(token) if token else None, data.get('trace', 0))
+        return 'FIRE' if status == FIRED else 'DUPLICATE'
+
+    def set(self, key, value):
+        if self.state[key] != value:
+            self.state[key] = value
+            self.version += 1
+
+    def fire_trigger(self, at_us=None):
+        # same spin as Claymore.fire_trigger
+        if at_us is not None:
+            while ticks_diff(at_us, ticks_us()) > 0:
+                pass
+        servo_us = ticks_us()
+        self.servo_us.append(servo_us)
+        self.set('trigger', 'FIRING')
+        asyncio.loop().call_later(_TRIGGER_RESET / 1000, self.set, 'trigger', 'READY')
+        return servo_us
+
+    async def run(self, clacker_ip, team):
+        hostenv.DEVICE_IP.set(self.ip)  # our sockets, and those of the tasks we start, use our address
+        url = f'http://{clacker_ip}'
+        self.clack.clacker_ip = clacker_ip
+        self.clack.team = team
+        self.tasks.append(asyncio.create_task(self.clack.run()))
+        self.tasks.append(asyncio.create_task(self._push_forever(clacker_ip)))
+        self.app.run(host='0.0.0.0', port=80, loop_forever=False)
+        body = {'mac': self.mac, 'team': team, 'ip': self.ip}
+        while True:
+            # like ping_forever: a full interval first, then (re)register until we have a slot
+            await asyncio.sleep_ms(_IP_TIMEOUT)
+            try:
+                if self.clack.slot is None:
+                    self.clack.slot = await self._register(url, body)
+                    if self.clack.slot is not None:
+                        self.set('armed', f'COUNT{self.clack.slot + 1}')
+                resp = await self.pool.get(f'{url}/ping')
+                if resp.text().lower() == 'pong':
+                    await self.clack.sync()
+            except Exception as e:
+                print(f'{self.name}: {e!r}')
+
+    async def _register(self, url, body):
+        url = f'{url}/register/{self.mac}'
+        for verb in ('GET', 'POST', 'PUT', 'GET'):
+            resp = await self.pool.request(verb, url, json=None if verb == 'GET' else body)
+            if resp.status == 200:
+                data = resp.json()
+                if 'id' in data:
+                    return data['id']
+        return None
+
+    async def _push_forever(self, clacker_ip):
+        version = -1
+        since = 0
+        while True:
+            await asyncio.sleep_ms(_STATE_POLL)
+            since += _STATE_POLL
+            if self.clack.slot is None or (version == self.version and since < _IP_TIMEOUT):
+                continue
+            self.pusher.push(
+                clacker_ip, self.clack.slot, self.state['door'], self.state['trigger'], self.state['armed'],
+                self.clack.sync_rtt_us)
+            version = self.version
+            since = 0
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.app.shutdown()
+
+
+class Fleet:
+    def __init__(self, args, count, workdir):
+        self.args = args
+        self.count = count
+        self.workdir = workdir
+        self.ether = os.path.join(workdir, 'ether')
+        self.procs = {}  # name -> Popen
+        self.launched = {}  # name -> time.monotonic()
+        self.virtual = {}  # name -> VirtualClaymore
+        self.names = [f'claymore{i:02d}' for i in range(count)]
+        self.ctl = Control()
+        self.http = HttpPool(max_connections=4, timeout_ms=5000)
+        self.clacker_ip = None
+        self.team = None
+        self.report = {'count': count, 'mode': args.mode}
+
+    # ---- devices ------------------------------------------------------------
+
+    def spawn(self, device, name, *extra):
+        cmd = [sys.executable, RUN_DEVICE, device, '--state', os.path.join(self.workdir, name),
+               '--ether', self.ether, '--name', name, *extra]
+        if self.args.tracemalloc:
+            cmd.append('--tracemalloc')
+        log = open(os.path.join(self.workdir, f'{name}.log'), 'w')
+        env = dict(os.environ, PYTHONUNBUFFERED='1', FOAM_WDT='0')  # a loaded host is not a hung device
+        self.procs[name] = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        self.launched[name] = time.monotonic()
+
+    async def boot_clacker(self, timeout_s=30):
+        self.spawn('clacker', 'clacker')
+        deadline = time.monotonic() + timeout_s
+        while time.monotonic() < deadline:
+            for ap in hostenv.listing('ap_').values():
+                if ap['ssid'].startswith('clacker'):
+                    self.clacker_ip = ap['ip']
+                    self.team = ap['ssid'].split('_')[1]
+            if self.clacker_ip:
+                try:
+                    await self.get('/ping')
+                    return
+                except (OSError, asyncio.TimeoutError):
+                    pass
+            await asyncio.sleep_ms(200)
+        raise RuntimeError('clacker did not come up, see clacker.log')
+
+    def boot_claymores(self):
+        if self.args.mode == 'process':
+            for name in self.names:
+                self.spawn('claymore', name, '--pin', f'{_CLAYMORE.DOOR_GPIO}={_CLOSED}')
+            return
+        for name in self.names:
+            vc = self.virtual[name] = VirtualClaymore(name)
+            vc.ip = network.lease(self.clacker_ip, name)
+            vc.launched = self.launched[name] = time.monotonic()
+            vc.tasks.append(asyncio.create_task(vc.run(self.clacker_ip, self.team)))
+
+    def stop(self):
+        for vc in self.virtual.values():
+            vc.stop()
+        for proc in self.procs.values():
+            proc.terminate()
+        for proc in self.procs.values():
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    async def get(self, path, ip=None):
+        resp = await self.http.get(f'http://{ip or self.clacker_ip}{path}')
+        return resp.json() if resp.status == 200 and path != '/ping' else resp.text()
+
+    def ip_names(self):
+        # station addresses only, a claymore also brings up its own AP at boot (mac_to_hostname)
+        return {info['ip']: info['name'] for info in hostenv.listing('ip_').values() if info.get('role') == 'sta'}
+
+    async def set_door(self, name, door):
+        if self.args.mode == 'process':
+            await self.ctl.drive(name, _CLAYMORE.DOOR_GPIO, _OPEN if door == 'OPEN' else _CLOSED)
+        else:
+            self.virtual[name].set('door', door)
+
+    async def servo_times(self, name):
+        if self.args.mode == 'process':
+            actions = (await self.ctl(name, {'cmd': 'actions', 'kind': 'pwm'}))['actions']
+            return [us for us, _, _, duty in actions if duty == _CLAYMORE.ServoFire]
+        return self.virtual[name].servo_us
+
+    # ---- phases -------------------------------------------------------------
+
+    async def registration(self, timeout_s):
+        seen = {}  # name -> s since launch
+        slots = {}  # name -> slot
+        deadline = time.monotonic() + timeout_s
+        last = time.monotonic()
+        while len(seen) < self.count and time.monotonic() < deadline:
+            if seen and time.monotonic() - last > _SETTLED:
+                break  # the rest keep being turned away (clacker full)
+            await asyncio.sleep_ms(250)
+            try:
+                states = (await self.get('/clack'))['states']
+            except (OSError, asyncio.TimeoutError, ValueError):
+                continue
+            names = self.ip_names()
+            now = time.monotonic()
+            for slot, state in states.items():
+                name = names.get(state['ip'])
+                if name and name not in seen:
+                    seen[name] = now - self.launched[name]
+                    last = now
+                    slots[name] = int(slot)
+        self.slots = slots
+        self.report['registered'] = len(seen)
+        self.report['registration_s'] = _percentiles(list(seen.values()))
+
+    async def heartbeat(self, idle_s):
+        pid = self.procs['clacker'].pid
+
+        async def sample():
+            clack = await self.get('/clack')
+            metrics = await self.get('/metrics')
+            histograms = metrics['histograms']
+            pings = histograms.get('/ping', {}).get('count', 0)
+            registers = sum(h['count'] for url, h in histograms.items() if '/register/' in url)
+            return time.monotonic(), _proc_cpu_s(pid), pings, clack['state_pushes'], clack['syncs'], registers
+
+        before = await sample()
+        await asyncio.sleep(idle_s)
+        after = await sample()
+        minutes = (after[0] - before[0]) / 60
+        per = self.count * minutes  # unregistered claymores keep pinging and asking to register too
+        self.report['heartbeat'] = {
+            'window_s': round(after[0] - before[0], 1),
+            'clacker_cpu_pct': round(100 * (after[1] - before[1]) / (after[0] - before[0]), 2),
+            'pings_per_claymore_min': round((after[2] - before[2]) / per, 2),
+            'state_pushes_per_claymore_min': round((after[3] - before[3]) / per, 2),
+            'sync_datagrams_per_claymore_min': round((after[4] - before[4]) / per, 2),
+            'register_requests_per_claymore_min': round((after[5] - before[5]) / per, 2)}
+
+    async def click(self, gpio, times=1, hold=None):
+        for _ in range(times):
+            await self.ctl.drive('clacker', gpio, _PRESSED)
+            await asyncio.sleep_ms(_TAP)
+            await self.ctl.drive('clacker', gpio, _RELEASED)
+            await asyncio.sleep_ms(_TAP)
+
+    async def arm(self):
+        # hold one slot button and long press another: the clacker arms every claymore
+        await self.ctl.drive('clacker', BUTTONS[1], _PRESSED)
+        await asyncio.sleep_ms(_TAP)
+        await self.ctl.drive('clacker', BUTTONS[0], _PRESSED)
+        await asyncio.sleep_ms(_LONG_PRESS)
+        await self.ctl.drive('clacker', BUTTONS[0], _RELEASED)
+        await self.ctl.drive('clacker', BUTTONS[1], _RELEASED)
+        await asyncio.sleep_ms(500 + _ARM_PING * len(self.slots) // 4)
+
+    async def fire(self, fires):
+        ack_ms, servo_ms, armed, fired_per_fire, missed = [], [], [], [], 0
+        for _ in range(fires):
+            await self.arm()
+            await self.ctl.drive('clacker', BTN_FIRE_GP, _PRESSED)
+            await asyncio.sleep_ms(_LONG_PRESS)
+            await self.ctl.drive('clacker', BTN_FIRE_GP, _RELEASED)
+            await asyncio.sleep_ms(_FIRE_SETTLE)
+            trace = (await self.get('/trace/all'))['traces'][-1]
+            stages = {s['stage']: s['us'] for s in trace['stages']}
+            detected = stages.get('detected')
+            if detected is None:
+                fired_per_fire.append(0)
+                continue
+            acks = {name[4:]: us for name, us in stages.items() if name.startswith('ack_')}
+            armed.append(len(acks))
+            ack_ms.extend(ticks_diff(us, detected) / 1000 for us in acks.values())
+            fired = 0
+            for name in self.slots:
+                after = [us for us in await self.servo_times(name) if 0 < ticks_diff(us, detected) < 10000000]
+                if after:
+                    fired += 1
+                    servo_ms.append(ticks_diff(after[0], detected) / 1000)
+            fired_per_fire.append(fired)
+            missed += len(acks) - fired
+            await asyncio.sleep_ms(_TRIGGER_RESET)  # servos back to READY, LEDs off again
+        self.report['fire'] = {
+            'armed_per_fire': armed, 'fired_per_fire': fired_per_fire, 'missed_servo': missed,
+            'ack_ms': _percentiles(ack_ms), 'servo_ms': _percentiles(servo_ms)}
+
+    async def doors(self):
+        latencies = []
+        for name in list(self.slots)[:_DOORS]:
+            slot = str(self.slots[name])
+            for door in ('OPEN', 'CLOSED'):
+                start = ticks_ms()
+                await self.set_door(name, door)
+                while ticks_diff(ticks_ms(), start) < 3 * _IP_TIMEOUT:
+                    state = (await self.get('/clack'))['states'].get(slot)
+                    if state and state['door'] == door:
+                        latencies.append(ticks_diff(ticks_ms(), start))
+                        break
+                    await asyncio.sleep_ms(10)
+        self.report['door_ms'] = _percentiles(latencies)
+
+    async def memory(self, base_rss_kb, base_traced):
+        if self.args.mode == 'inprocess':
+            per = max(1, self.count)
+            self.report['memory'] = {
+                'rss_kb_per_claymore': round((_proc_rss_kb(os.getpid()) - base_rss_kb) / per, 1),
+                'alloc_per_claymore': round(
+                    (tracemalloc.get_traced_memory()[0] - base_traced) / per) if self.args.tracemalloc else None}
+        else:
+            rss = [_proc_rss_kb(self.procs[name].pid) for name in self.names]
+            alloc = []
+            if self.args.tracemalloc:
+                ips = {name: ip for ip, name in self.ip_names().items()}
+                for name in self.slots:
+                    try:
+                        alloc.append((await self.get('/metrics', ips[name]))['mem_alloc'])
+                    except (OSError, asyncio.TimeoutError, KeyError, ValueError):
+                        pass
+            self.report['memory'] = {
+                'rss_kb_per_claymore': _percentiles([r for r in rss if r]),
+                'alloc_per_claymore': _percentiles(alloc)}
+        self.report['memory']['clacker_rss_kb'] = _proc_rss_kb(self.procs['clacker'].pid)
+
+    async def run(self):
+        hostenv.ETHER = self.ether
+        try:
+            await self.boot_clacker()
+            if self.args.tracemalloc and self.args.mode == 'inprocess':
+                tracemalloc.start()
+            base = (_proc_rss_kb(os.getpid()), tracemalloc.get_traced_memory()[0])
+            self.boot_claymores()
+            await self.registration(self.args.register_s)
+            await self.memory(*base)
+            if not self.slots:
+                return self.report
+            await self.heartbeat(self.args.idle_s)
+            await self.fire(self.args.fires)
+            await self.doors()
+        finally:
+            self.stop()
+            await self.http.close()
+            tracemalloc.stop()
+        return self.report
+
+
+def _fmt(d, key='p50'):
+    return '-' if not d else f'{d[key]:.1f}'
+
+
+async def main(args):
+    reports = []
+    for count in args.counts:
+        workdir = os.path.join(args.keep, f'fleet{count}') if args.keep else tempfile.mkdtemp(prefix='fleet')
+        os.makedirs(workdir, exist_ok=True)
+        try:
+            reports.append(await Fleet(args, count, workdir).run())
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+    print(f"{'claymores':>9} {'regd':>5} {'reg p50 s':>9} {'reg max s':>9} {'ack p50':>8} {'ack p99':>8} "
+          f"{'servo p50':>9} {'servo p99':>9} {'door p50':>8} {'cpu %':>6} {'msg/min':>7} {'rss kB':>7}")
+    for r in reports:
+        fire = r.get('fire', {})
+        hb = r.get('heartbeat', {})
+        msgs = sum(v for k, v in hb.items() if k.endswith('_per_claymore_min'))
+        rss = r['memory']['rss_kb_per_claymore']
+        rss = rss['p50'] if isinstance(rss, dict) else rss
+        print(f"{r['count']:>9} {r['registered']:>5} {_fmt(r['registration_s']):>9} "
+              f"{_fmt(r['registration_s'], 'max'):>9} {_fmt(fire.get('ack_ms')):>8} "
+              f"{_fmt(fire.get('ack_ms'), 'p99'):>8} {_fmt(fire.get('servo_ms')):>9} "
+              f"{_fmt(fire.get('servo_ms'), 'p99'):>9} {_fmt(r.get('door_ms')):>8} "
+              f"{hb.get('clacker_cpu_pct', '-'):>6} {msgs:>7.1f} {rss if rss is not None else '-':>7}")
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(reports, fh, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=lambda v: [int(c) for c in v.split(',')], default=[4, 16, 64])
+    parser.add_argument('--mode', choices=['process', 'inprocess'], default='inprocess')
+    parser.add_argument('--fires', type=int, default=3)
+    parser.add_argument('--idle-s', type=float, default=20, help='heartbeat measurement window')
+    parser.add_argument('--register-s', type=float, default=120, help='give up waiting for registrations')
+    parser.add_argument('--tracemalloc', action='store_true', help='measure the Python heap per claymore')
+    parser.add_argument('--json', help='write the full report here')
+    parser.add_argument('--keep', help='keep state, ether and logs under this directory')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,403 @@
+"""
+Micro-benchmarks for the common/ hot paths
+
+On the host (CPython, with the host/ stand-ins):
+    python3 bench/microbench.py [--ms 500] [--runs 3] [--only dns] [--save] [--baseline FILE] [--tolerance 30]
+On a Pico W, with the firmware's common/ modules (and an html/ folder)
+on the device:
+    mpremote cp bench/microbench_baseline.json : + run bench/microbench.py
+
+Per benchmark:
+    ops/s   operations in --ms of wall time, gc enabled
+    B/op    gc.mem_alloc() growth over _ALLOC_OPS operations with gc
+            disabled. On the device that is every byte an operation
+            allocates; CPython frees temporaries as it goes (and only
+            counts while tracemalloc traces), so there it is what an
+            operation leaves behind.
+
+Every benchmark runs --runs times and keeps its best ops/s and B/op, so one
+run that lost the CPU to something else does not count. The result is
+compared with this platform's entry (cpython, rp2) in the baseline file: a
+benchmark regresses when its ops/s fall by more than --tolerance percent,
+or its B/op grow by more than _ALLOC_SLACK. The flash bound benchmarks
+(the ones capped at max_ops writes) time the filesystem more than the code
+and vary too much run to run, so they are printed but never regress.
+--save records the run as the platform's baseline. Exit status 1 on a
+regression.
+"""
+import gc
+import json
+import os
+import sys
+
+try:
+    import tracemalloc
+except ImportError:  # MicroPython
+    tracemalloc = None
+
+if tracemalloc:
+    import tempfile
+    _HERE = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(os.path.dirname(_HERE), 'host'))
+    import hostenv
+    hostenv.install()
+    PLATFORM = 'cpython'
+    BASELINE = os.path.join(_HERE, 'microbench_baseline.json')
+    HTML = os.path.join(os.path.dirname(_HERE), 'claymore', 'html')
+else:
+    PLATFORM = sys.platform
+    BASELINE = 'microbench_baseline.json'
+    HTML = 'html'
+
+from time import ticks_us, ticks_ms, ticks_diff  # noqa: E402
+from captive_portal import CaptivePortal, question_end, answer_tail, answer_into  # noqa: E402
+from helpers import (  # noqa: E402
+    Database, JournalDatabase, PropertiesFromFiles, get_best_channel, file_exists)
+from binary_db import BinaryDatabase  # noqa: E402
+from wifi_scan import WifiScanner  # noqa: E402
+
+_ALLOC_OPS = 10  # operations per allocation measurement, gc off
+_ALLOC_SLACK = 16  # B/op a benchmark may grow by before it counts as a regression
+_BATCH = 10  # operations between clock reads
+_FILES = 'mb_'  # prefix of the scratch files the database benchmarks write
+_PAGE = 'fire' if file_exists(HTML + '/fire.html') else 'index'  # claymore or clacker page
+
+BENCHES = []  # (name, setup, max_ops): setup() -> the operation to time
+
+
+def bench(name, max_ops=None):
+    """ register setup as benchmark name; max_ops caps the operations (flash writes) """
+    def register(setup):
+        BENCHES.append((name, setup, max_ops))
+        return setup
+    return register
+
+
+# ---- fixtures -------------------------------------------------------------
+
+_QUERY = (
+    b'\x1a\x2b\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00'  # id, standard query, 1 question
+    b'\x11connectivitycheck\x07gstatic\x03com\x00'
+    b'\x00\x01\x00\x01')  # A, IN
+
+
+def _claymore(i):
+    return {'mac': f'28CDC1{i:06X}', 'ip': f'192.168.4.{16 + i}', 'team': 'RED', 'id': i}
+
+
+def _clacker_db():
+    return {
+        'clacker': {
+            'mac': '28CDC10000FF', 'team': 'RED', 'ssid': 'clacker_RED_FF', 'password': None,
+            'ip': '192.168.4.1', 'sequence': 'all'},
+        'claymores': [_claymore(i) if i < 16 else {} for i in range(32)],
+        'sequences': {'all': [[0, list(range(16))]], 'ripple': [[100 * i, [i]] for i in range(16)]}}
+
+
+def _claymore_db():
+    return {
+        'claymore': dict(_claymore(3), mac='28CDC1000003'),
+        'clacker': {'ssid': 'clacker_RED_FF', 'password': None, 'ip': '192.168.4.1', 'url': 'http://192.168.4.1'}}
+
+
+def _raw_aps():
+    aps = []
+    for i in range(12):
+        ssid = f'clacker_RED_{i:02X}' if i % 4 == 0 else f'NETGEAR{i:02d}'
+        aps.append((ssid.encode(), bytes([0x28, 0xcd, 0xc1, 0, 0, i]), 1 + (i * 5) % 13, -40 - 4 * i, 3, False))
+    return aps
+
+
+def _fresh(cls, name, data):
+    db = cls(name)
+    db.erase()
+    db.clear()
+    db.update(data)
+    db.sync()
+    return db
+
+
+# ---- benchmarks -----------------------------------------------------------
+
+@bench('dns_parse')
+def _dns_parse():
+    return lambda: question_end(_QUERY, len(_QUERY))
+
+
+@bench('dns_response')
+def _dns_response():
+    tail = answer_tail('192.168.4.1')
+    buf = bytearray(512 + len(tail))
+    view = memoryview(buf)
+    n = len(_QUERY)
+
+    def op():
+        view[:n] = _QUERY  # what recvfrom_into does
+        return view[:answer_into(buf, question_end(buf, n), tail)]
+    return op
+
+
+@bench('dns_reply')
+def _dns_reply():
+    portal = CaptivePortal('192.168.4.1')
+    query = _QUERY[:-4] + b'\x00\x1c\x00\x01'  # AAAA: the longer, SOA tail
+    n = len(query)
+
+    def op():
+        portal.view[:n] = query
+        return portal.view[:portal._reply(n)]  # counted, answered in place
+    return op
+
+
+@bench('db_load_json')
+def _db_load_json():
+    _fresh(Database, _FILES + 'json.txt', _clacker_db())
+    return lambda: Database(_FILES + 'json.txt')
+
+
+@bench('db_flush_json', max_ops=50)
+def _db_flush_json():
+    db = _fresh(Database, _FILES + 'json.txt', _clacker_db())
+
+    def op():
+        db['claymores'][5]['ip'] = '192.168.4.99' if db['claymores'][5]['ip'] != '192.168.4.99' else '192.168.4.21'
+        db.flush()
+    return op
+
+
+@bench('db_load_journal')
+def _db_load_journal():
+    db = _fresh(JournalDatabase, _FILES + 'journal.txt', _clacker_db())
+    for i in range(8):  # a few registrations on top of the snapshot
+        db['claymores'][16 + i] = _claymore(16 + i)
+        db.flush()
+    return lambda: JournalDatabase(_FILES + 'journal.txt')
+
+
+@bench('db_flush_journal', max_ops=50)
+def _db_flush_journal():
+    db = _fresh(JournalDatabase, _FILES + 'journal.txt', _clacker_db())
+
+    def op():
+        db['claymores'][5]['ip'] = '192.168.4.99' if db['claymores'][5]['ip'] != '192.168.4.99' else '192.168.4.21'
+        db.flush()
+    return op
+
+
+@bench('db_load_binary')
+def _db_load_binary():
+    _fresh(BinaryDatabase, _FILES + 'binary.txt', _claymore_db())
+    return lambda: BinaryDatabase(_FILES + 'binary.txt')
+
+
+@bench('db_flush_binary', max_ops=50)
+def _db_flush_binary():
+    db = _fresh(BinaryDatabase, _FILES + 'binary.txt', _claymore_db())
+
+    def op():
+        db['claymore']['ip'] = '192.168.4.99' if db['claymore']['ip'] != '192.168.4.99' else '192.168.4.19'
+        db.flush()
+    return op
+
+
+def _fields(template):
+    """ the {name} placeholders of a str.format template """
+    names = []
+    for part in template.split('{')[1:]:
+        name = part.split('}', 1)[0]
+        if name and name.replace('_', 'a').isalpha():
+            names.append(name)
+    return names
+
+
+@bench('html_format')
+def _html_format():
+    html = PropertiesFromFiles(HTML)
+    template = getattr(html, _PAGE)
+    state = {name: 'OFF' for name in _fields(template)}
+    return lambda: getattr(html, _PAGE).format(**state)
+
+
+@bench('html_load')
+def _html_load():
+    return lambda: getattr(PropertiesFromFiles(HTML), _PAGE)
+
+
+def _scanned():
+    scanner = WifiScanner()
+    scanner.update(_raw_aps(), ticks_ms())
+    return scanner
+
+
+@bench('best_channel')
+def _best_channel():
+    aps = _scanned().aps()
+    return lambda: get_best_channel(aps)
+
+
+@bench('scan_records')
+def _scan_records():
+    scanner = WifiScanner()
+    raw = _raw_aps()
+    terms = scanner.terms('clacker', 'RED')
+
+    def op():
+        scanner.update(raw, ticks_ms())
+        return scanner.aps(terms)
+    return op
+
+
+@bench('scan_query')
+def _scan_query():
+    scanner = _scanned()
+    terms = scanner.terms('clacker', 'RED')
+    return lambda: scanner.aps(terms)
+
+
+# ---- runner ---------------------------------------------------------------
+
+class _Quiet:
+    """ swallow what the benchmarked code prints, host only """
+    def __enter__(self):
+        if tracemalloc:
+            self.stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *_exc):
+        if tracemalloc:
+            sys.stdout.close()
+            sys.stdout = self.stdout
+
+
+def measure(op, ms, max_ops=None):
+    """ (ops/s, bytes allocated per op) """
+    op()  # warm up: first calls read files and intern strings
+    gc.collect()
+    batch = 1 if max_ops else _BATCH
+    n = 0
+    start = ticks_us()
+    while True:
+        for _ in range(batch):
+            op()
+        n += batch
+        elapsed = ticks_diff(ticks_us(), start)
+        if elapsed >= ms * 1000 or (max_ops and n >= max_ops):
+            break
+    ops = n * 1000000 / max(1, elapsed)
+
+    if tracemalloc:
+        tracemalloc.start()  # not while timing, tracing slows CPython down several times
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        for _ in range(_ALLOC_OPS):
+            op()
+        per_op = (gc.mem_alloc() - before) / _ALLOC_OPS
+    finally:
+        gc.enable()
+        if tracemalloc:
+            tracemalloc.stop()
+    return ops, per_op
+
+
+def _cleanup():
+    for name in os.listdir('.'):
+        if name.startswith(_FILES):
+            os.remove(name)
+
+
+def run(ms=500, only=None, runs=1):
+    """ name -> best of runs """
+    results = {}
+    for _ in range(runs):
+        for name, setup, max_ops in BENCHES:
+            if only and only not in name:
+                continue
+            with _Quiet():
+                ops, per_op = measure(setup(), ms, max_ops)
+            best = results.get(name)
+            if best:
+                ops = max(ops, best['ops_per_s'])
+                per_op = min(per_op, best['bytes_per_op'])
+            results[name] = {'ops_per_s': round(ops, 1), 'bytes_per_op': round(per_op)}
+        _cleanup()
+    return results
+
+
+def _gated(name):
+    # flash bound benchmarks are too noisy to fail a run
+    for bench_name, _setup, max_ops in BENCHES:
+        if bench_name == name:
+            return not max_ops
+    return True
+
+
+def _load(baseline):
+    try:
+        with open(baseline) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def compare(results, base, tolerance):
+    """ print the table, return the names of the regressed benchmarks """
+    regressed = []
+    print('{:<18} {:>12} {:>8} {:>12} {:>8}  {}'.format('benchmark', 'ops/s', 'B/op', 'base ops/s', 'base B', ''))
+    for name, r in results.items():
+        b = base.get(name)
+        verdict = ''
+        if b:
+            if r['ops_per_s'] < b['ops_per_s'] * (1 - tolerance / 100):
+                verdict = 'SLOWER'
+            if r['bytes_per_op'] > b['bytes_per_op'] * 1.1 + _ALLOC_SLACK:
+                verdict = (verdict + ' ' if verdict else '') + 'ALLOCATES MORE'
+            if verdict and _gated(name):
+                regressed.append(name)
+            elif verdict:
+                verdict += ' (flash, not gated)'
+        print('{:<18} {:>12} {:>8} {:>12} {:>8}  {}'.format(
+            name, r['ops_per_s'], r['bytes_per_op'],
+            b['ops_per_s'] if b else '-', b['bytes_per_op'] if b else '-', verdict))
+    return regressed
+
+
+def main(argv=()):
+    args = list(argv)
+
+    def option(flag, default=None):
+        if flag in args:
+            i = args.index(flag)
+            value = args[i + 1] if i + 1 < len(args) and not args[i + 1].startswith('--') else True
+            return value
+        return default
+
+    if '--help' in args or '-h' in args:
+        print(__doc__)
+        return 0
+    baseline = option('--baseline', BASELINE)
+    tolerance = float(option('--tolerance', 30))
+    if tracemalloc:
+        scratch = tempfile.mkdtemp(prefix='microbench')
+        os.chdir(scratch)
+    results = run(int(option('--ms', 500)), option('--only'), int(option('--runs', 3)))
+    if tracemalloc:
+        os.rmdir(scratch)
+    stored = _load(baseline)
+    regressed = compare(results, stored.get(PLATFORM, {}), tolerance)
+    if option('--save'):
+        stored.setdefault(PLATFORM, {}).update(results)
+        with open(baseline, 'w') as fh:
+            json.dump(stored, fh)
+        print('saved', PLATFORM, 'baseline to', baseline)
+    elif regressed:
+        print('regressed:', ', '.join(regressed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    status = main(sys.argv[1:])
+    if status:
+        sys.exit(status)
@@ -5,6 +5,7 @@ from dual_led import DualLED
 # from helpers import get_wifi_status
 from hardware import *
 from primitives import Pushbutton
+from time import ticks_ms, ticks_us, ticks_diff
 
 # # Output pins
 # # Output, Normally Low: LED 0 == Off, 1 == On
@@ -29,13 +30,16 @@ from primitives import Pushbutton
 # SW_AB_GP      = 22
 
 
+_BOUNCE_MS = 30  # FIRE button edges this soon after a release are contact bounce
+
+
 class Clacker:
     LED = ('OFF', 'ON')
     SWITCH = ('PRESSED', 'OFF')
     TEAMS = tuple(DualLED.COLORS)
     PRESSED = 0
     NOT_PRESSED = 1
-    MAX_CLAYMORES = 4
+    MAX_CLAYMORES = 32  # paged onto the 4 slot buttons/LEDs, see slots.py
 
     def __init__(self):
         # unique hardware
@@ -65,7 +69,55 @@ class Clacker:
         self.buttons = [self.btn1, self.btn2, self.btn3, self.btn4]
         self.pushbuttons = [self.pb1, self.pb2, self.pb3, self.pb4]
         self.leds = [self.led1, self.led2, self.led3, self.led4]
+
+        # when each slot button last went down/up, to recognise two-button chords
+        self._down = [None] * len(self.buttons)
+        self._up = [None] * len(self.buttons)
+        self.released = None  # callable(position) when a slot button comes up
+        for btn in self.buttons:
+            btn.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self._button_edge)
+        # ticks_us the FIRE button last went down, the first stage of a fire trace
+        self.fire_down_us = None
+        self._fire_up = None  # ticks_ms of the last release
+        self.fire.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self._fire_edge)
         create_task(self.test())
+
+    def _fire_edge(self, pin):
+        if pin.value() == self.PRESSED:
+            held = self.fire_down_us is not None and self._fire_up is None
+            if not held and (self._fire_up is None or ticks_diff(ticks_ms(), self._fire_up) > _BOUNCE_MS):
+                self.fire_down_us = ticks_us()  # first edge of a new press
+                self._fire_up = None
+        else:
+            self._fire_up = ticks_ms()
+
+    def _button_edge(self, pin):
+        i = self.buttons.index(pin)
+        if pin.value() == self.PRESSED:
+            if self._down[i] is None or (self._up[i] is not None and ticks_diff(self._up[i], self._down[i]) >= 0):
+                self._down[i] = ticks_ms()  # first edge of a new press, ignore bounce
+        else:
+            self._up[i] = ticks_ms()
+            if self.released:
+                self.released(i)
+
+    def chord_partner(self, position):
+        """
+        The slot button that was already held down when button position was
+        pressed, or None. Call from position's press handler.
+        """
+        down = self._down[position]
+        if down is None:
+            return None
+        for other in range(len(self.buttons)):
+            if other == position or self._down[other] is None:
+                continue
+            held_from = self._down[other]
+            released = self._up[other]
+            still_held = released is None or ticks_diff(released, held_from) < 0
+            if ticks_diff(down, held_from) > 0 and (still_held or ticks_diff(released, down) > 0):
+                return other
+        return None
         
     async def test(self):
         self.status.alternate_colors()
@@ -4,16 +4,24 @@
 Main program for CLACKER
 
 """
-from os import remove
 from sys import print_exception
 from tinyweb import webserver
-import aiohttp
 from uasyncio import run, get_event_loop, sleep_ms
+from time import ticks_ms, ticks_diff
 from helpers import (
     PropertiesFromFiles, wifi_start_access_point, _handle_exception, mac_to_hostname,
-    Database, get_mac, file_exists)
+    JournalDatabase, get_mac, run_bounded)
 from captive_portal import CaptivePortal
+from channels import choose_channel, ChannelWatch, CHANNEL_BOOTS
+from wifi_scan import scanner
+from http_pool import HttpPool
+from metrics import Metrics
+from trace import TraceLog
+from clack_protocol import ClackSender, StateTable, slot_bitmap, next_epoch, FIRED
 from clacker_hardware import Clacker
+from registry import Registry
+from slots import SlotPager
+from sequences import SequenceEngine, DEFAULT_SEQUENCES, DEFAULT_SEQUENCE, validate
 from machine import Timer
 from functools import partial
 from micropython import const
@@ -26,30 +34,45 @@ _DB_FILE = f'db_{_HOSTNAME}.txt'
 _HTML_PATH = const("./html")
 _LED_STATUS_OFF = const(3500)  # ms
 _LED_CLACK_OFF = const(4500)  # ms
+_DB_WRITE_BEHIND = const(2000)  # ms, coalesce registry writes to flash
+_FIRE_RETRY = (30, 60, 120)  # ms between UDP FIRE re-broadcasts, override with db['clacker']['fire_retry_ms']
+_FIRE_DEADLINE = const(400)  # ms, then fall back to HTTP for slots that never acknowledged
+_FIRE_LEAD = const(100)  # ms, synced claymores all actuate this long after the FIRE, override with db['clacker']['fire_lead_ms']
+_FIRE_HTTP_TIMEOUT = const(1000)  # ms
+_FANOUT = const(4)  # claymores talked to over HTTP at once
 
 
 HTML = PropertiesFromFiles(_HTML_PATH)  # JIT read html static pages into memory
 hw = Clacker()  # represents the Hardware in the Claymore
 app = webserver()  # Create web server application
-timers = [None] * 4
-
+metrics = Metrics()  # latency histograms and error counts for GET /metrics
+traces = TraceLog()  # stage timings of the last few FIRE button presses, GET /trace/<id>
+pool = HttpPool(max_connections=_FANOUT)  # keep-alive sockets to the claymores we talk to most
+pager = SlotPager(hw.leds, hw.MAX_CLAYMORES)  # slots paged onto the 4 buttons/LEDs
+leds = pager.slots  # one LED per slot, only the shown page reaches the hardware
+timers = [None] * hw.MAX_CLAYMORES
+_chords = {}  # held button -> the button pressed with it, until the held one comes up
+
+db = JournalDatabase(_DB_FILE, write_behind_ms=_DB_WRITE_BEHIND)  # registry changes append to a journal
 if hw.fire.value() == hw.PRESSED and hw.btn4.value() == hw.PRESSED:
     # magic key combination to clear out any DB
     # FIRE + BUTTON 4 on START
-    if file_exists(_DB_FILE):
-        print('RESET-Deleting DB')
-        remove(_DB_FILE)
+    print('RESET-Deleting DB')
+    db.erase()
+    db.clear()
 
-db = Database(_DB_FILE)
 db.setdefault('clacker', {}).update({'mac': get_mac()})
-db.setdefault('claymores', [{}] * hw.MAX_CLAYMORES)
+registry = Registry(db, hw.MAX_CLAYMORES)  # db['claymores'] indexed by mac and ip
 team = db['clacker'].setdefault('team', hw.team_color)
 
 ssid = mac_to_hostname(f'{_HOST_BASE_NAME}_{team}')
 # password = ssid[:-3]  # secure AP takes too long and WDT kicks to reboot
 password = None
 
-ip = wifi_start_access_point(ssid=ssid, hostname=_HOSTNAME, password=password)  # turn on our WIFI in AP Mode
+# the channel decided on an earlier boot, until channel_boots boots have used it
+channel = choose_channel(db['clacker'], db['clacker'].get('channel_boots', CHANNEL_BOOTS))
+ip = wifi_start_access_point(
+    ssid=ssid, hostname=_HOSTNAME, password=password, channel=channel)  # turn on our WIFI in AP Mode
 
 if team != hw.team_color:
     # we may have accidentally toggled the team switch, and rebooted
@@ -60,9 +83,30 @@ if team != hw.team_color:
 
 hw.status.on()  # Our AP is active, so turn on our status LED in our team color
 captive = CaptivePortal(ip)  # DNS server that redirect all DNS queries to our http://ip/
+# UDP FIRE broadcast to every claymore on our subnet, in a session no claymore has retired
+clack = ClackSender(ip, team, epoch=next_epoch(db['clacker']))
+clack.trace = traces
+states = StateTable()  # door/trigger/armed LED pushed by each claymore
+
+
+def fire_retry():
+    # db['clacker']['fire_retry_ms'] if it is a list of 1.. positive ms, otherwise _FIRE_RETRY
+    retry = db['clacker'].get('fire_retry_ms')
+    if isinstance(retry, list) and retry and all(isinstance(ms, int) and ms > 0 for ms in retry):
+        return retry
+    if retry is not None:
+        print(f'fire_retry_ms {retry} is not a list of positive ms, using {_FIRE_RETRY}')
+    return _FIRE_RETRY
+
+
+sequencer = SequenceEngine(
+    clack, db['clacker'].get('fire_lead_ms', _FIRE_LEAD), fire_retry(), _FIRE_DEADLINE)  # choreographed volleys
+if 'sequences' not in db:
+    db['sequences'] = {name: [[at, list(slots)] for at, slots in steps] for name, steps in DEFAULT_SEQUENCES.items()}
+db['clacker'].setdefault('sequence', DEFAULT_SEQUENCE)
 
 db['clacker'].update({'ip': ip, 'ssid': ssid})
-db.flush()
+db.sync()
 
 # db.verify_integrity('clacker', 'id', hw.MAX_CLAYMORES)
 # db.flush()
@@ -72,158 +116,313 @@ gc.collect()
 
 def led_off(position, _t):
     print(f'led_off {_t}:{position}')
-    hw.leds[position].off()
+    leds[position].off()
     if timers[position]:
         timers[position].deinit()
         timers[position] = None
 
 
+def led_show(position, color, period):
+    # light the slot LED in color, turn it off again after period ms
+    leds[position].on(color)
+    if timers[position]:
+        timers[position].deinit()
+    timers[position] = Timer()
+    timers[position].init(mode=Timer.ONE_SHOT, period=period, callback=partial(led_off, position))
+
+
+def show_door(position, door):
+    led_state = leds[position].state
+    if not led_state.startswith('OFF'):
+        print(f'LED {position} is not OFF: {led_state}')
+        if timers[position]:
+            timers[position].deinit()
+        timers[position] = Timer()
+        timers[position].init(mode=Timer.ONE_SHOT, period=_LED_CLACK_OFF, callback=partial(led_off, position))
+        return
+    color = 'GREEN'
+    if door.upper() == 'OPEN':
+        color = 'RED'
+    led_show(position, color, _LED_STATUS_OFF)
+
+
 async def check_one(claymore_ip, position):
     # send clack via GET to get the device status before we CLACK
     try:
-        led_state = hw.leds[position].state
-        if not led_state.startswith('OFF'):
-            print(f'LED {position} is not OFF: {led_state}')
-            if timers[position]:
-                timers[position].deinit()
-            timers[position] = Timer()
-            timers[position].init(mode=Timer.ONE_SHOT, period=_LED_CLACK_OFF, callback=partial(led_off, position))
+        if not leds[position].state.startswith('OFF'):
+            show_door(position, 'UNKNOWN')
             return
 
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{claymore_ip}/status"
-            print(url)
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    msg = await resp.text()
-                    print(f'Resp "{msg=}"')
-                    color = 'GREEN'
-                    if msg.upper() == 'OPEN':
-                        color = 'RED'
-                    hw.leds[position].on(color)
-                    if timers[position]:
-                        timers[position].deinit()
-                    timers[position] = Timer()
-                    timers[position].init(mode=Timer.ONE_SHOT, period=_LED_STATUS_OFF, callback=partial(led_off, position))
-                else:
-                    print(resp.status)
+        url = f"http://{claymore_ip}/status"
+        print(url)
+        resp = await metrics.timed('out_status', pool.get(url))
+        if resp.status == 200:
+            msg = resp.text()
+            print(f'Resp "{msg=}"')
+            show_door(position, msg)
+        else:
+            print(resp.status)
     except Exception as e:
-        hw.leds[position].off()
+        leds[position].off()
         print_exception(e)
 
 
-def single_press_fire():
+def show_slot(position, claymore_ip):
+    # light the LED from the state the claymore pushed, no network I/O.
+    # Returns a check_one coroutine if we have not heard from it recently.
+    state = states.get(position)
+    if state:
+        show_door(position, state['door'])
+        return None
+    return check_one(claymore_ip, position)
+
+
+def claymore_rtts():
+    # clock sync round trips the claymores pushed lately, for ChannelWatch
+    rtts = []
+    for slot in list(states.slots):
+        state = states.get(slot)
+        if state and state['sync_rtt_us'] is not None:
+            rtts.append(state['sync_rtt_us'])
+    return rtts
+
+
+async def single_press_fire():
     print("single press fire button")
-    # check the status of all of the known devices
-    gc.collect()
-    loop = get_event_loop()
-    for position, claymore in enumerate(db['claymores']):
-        if not claymore or not claymore.get('ip'):
+    # show the status of all of the known devices
+    stale = []
+    for position, claymore in registry.registered():
+        if not claymore.get('ip'):
             print(f'Skip status {position}')
             continue
-        loop.create_task(check_one(claymore['ip'], position))
+        check = show_slot(position, claymore['ip'])
+        if check:
+            stale.append(check)
+    if stale:
+        await run_bounded(stale, _FANOUT)
 
 
 async def double_press_fire():
     print("double press fire button")
-    await long_press_fire()
+    await run_sequence()
+
+
+async def run_sequence():
+    # fire the armed slots in the selected sequence, db['clacker']['sequence']
+    name = db['clacker'].get('sequence', DEFAULT_SEQUENCE)
+    steps = db['sequences'].get(name)
+    if not steps or sequencer.running:
+        print(f'sequence {name}: {"already running" if steps else "unknown"}')
+        return
+    ready = set(slot for slot in pager.armed() if registry.slots[slot].get('ip'))
+    if not ready:
+        return
+    # claymores that told us they are clock synced can be scheduled ahead
+    synced = set(slot for slot in ready if (states.get(slot) or {}).get('sync_rtt_us') is not None)
+    report = await sequencer.run(name, steps, ready, synced)
+    print(f"sequence {name}: max error {report['max_error_us']}us")
+    for step in report['steps']:
+        print(f"  +{step['at_ms']}ms {step['slots']} dispatch late {step['dispatch_late_us']}us "
+              f"fired {step['fired']} missed {step['missed']}")
+        for position in step['slots']:
+            led_show(position, 'RED' if position in step['missed'] else 'GREEN', _LED_CLACK_OFF)
+    gc.collect()
 
 
-async def fire_one(claymore_ip, position):
-    # send clack via POST
-    async with aiohttp.ClientSession() as session:
+async def fire_one(claymore_ip, position, token=None, trace=0):
+    # send clack via POST, the token stops a claymore that already fired by UDP from firing again
+    try:
         url = f"http://{claymore_ip}/clack"
         print(url)
-        async with session.post(url) as resp:
-            if resp.status == 200:
-                # msg = await resp.text()
-                msg = await resp.text()
-                print(f'clack resp: {msg}')
-            else:
-                print(resp.status)
-    hw.leds[position].off()
-
-
-async def long_press_fire():
-    print("long press fire button")
+        traces.stamp(trace, f'http_sent_{position}')
+        resp = await metrics.timed('out_fire', pool.post(
+            url, json={'token': token, 'trace': trace}, timeout_ms=_FIRE_HTTP_TIMEOUT))
+        if resp.status == 200:
+            traces.stamp(trace, f'http_ack_{position}')
+            print(f'clack resp {position}: {resp.text()}')
+            return True
+        print(resp.status)
+    except Exception as e:
+        print_exception(e)
+    return False
+
+
+def long_press_detected():
+    # Pushbutton recognised the long press: start a trace at the button going down
+    trace = traces.new()
+    if hw.fire_down_us is not None:
+        traces.stamp(trace, 'pressed', hw.fire_down_us)
+    traces.stamp(trace, 'detected')
+    return long_press_fire(trace)  # Pushbutton runs the returned coroutine as a task
+
+
+async def long_press_fire(trace=0):
+    traces.stamp(trace, 'task_started')
+    print(f"long press fire button, trace {trace}")
+    start = ticks_ms()
     # scan to see if any LEDs are ready
-    gc.collect()
-    loop = get_event_loop()
-    for position, claymore in enumerate(db['claymores']):
-        if not claymore or not claymore.get('ip'):
-            print(f'Skip position {position}')
-            continue
-        led_state = hw.leds[position].get_state()
-        if led_state.get('STATE', 'UNKNOWN').startswith('ALTERNATE'):
-            loop.create_task(fire_one(claymore['ip'], position))
-        else:
-            print(f'position {position} Not selected')
-    await sleep_ms(5)  # let our fire_one task start
+    armed = []
+    # armed slots on every page, not just the one shown
+    for position in pager.armed():
+        if registry.slots[position].get('ip'):
+            armed.append(position)
+    if not armed:
+        return
+    acked = {}
+    try:
+        # one broadcast datagram reaches every armed claymore at once,
+        # re-broadcast quickly to any that do not acknowledge
+        acked = await metrics.timed('out_fire_udp', clack.fire(
+            slot_bitmap(armed), fire_retry(), _FIRE_DEADLINE,
+            db['clacker'].get('fire_lead_ms', _FIRE_LEAD), trace=trace))
+    except OSError as e:
+        print_exception(e)
+    token = clack.token()
+    missing = [position for position in armed if position not in acked]
+    if missing:
+        # fall back to HTTP POST /clack with the same token
+        print(f'FIRE {token}: no UDP ACK from {missing}, trying HTTP')
+        results = await run_bounded([
+            fire_one(registry.slots[position]['ip'], position, token, trace) for position in missing], _FANOUT)
+        acked.update({position: FIRED for position, ok in zip(missing, results) if ok is True})
+    print(f'FIRE {token} slots {armed}: acked {acked} in {ticks_diff(ticks_ms(), start)}ms')
+    for position in armed:
+        # GREEN: claymore confirmed the fire, RED: it never answered
+        led_show(position, 'GREEN' if position in acked else 'RED', _LED_CLACK_OFF)
+    gc.collect()  # the skew prints from clack.run() once the scheduled claymores report FIRED
 
 
 async def ping_one(position, led_callback):
     # ping-pong first
     try:
-        claymore_ip = db['claymores'][position].get('ip')  # need try/except in case it is missing/empty
+        claymore_ip = registry.slots[position].get('ip')  # need try/except in case it is missing/empty
         if not claymore_ip:
             return
         if timers[position]:
             timers[position].deinit()
             timers[position] = None
         gc.collect()
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{claymore_ip}/ping"
-            print(url)
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    msg = await resp.text()
-                    print(f'ping resp: {msg}')
-                    if msg.lower() == 'pong':
-                        # toggle, or turn off if blinking or alternating
-                        led_callback()
-                else:
-                    print(resp.status)
+        url = f"http://{claymore_ip}/ping"
+        print(url)
+        resp = await metrics.timed('out_ping', pool.get(url))
+        if resp.status == 200:
+            msg = resp.text()
+            print(f'ping resp: {msg}')
+            if msg.lower() == 'pong':
+                # toggle, or turn off if blinking or alternating
+                led_callback()
+        else:
+            print(resp.status)
     except Exception as e:
-        hw.leds[position].off()
+        leds[position].off()
         print_exception(e)
 
 
+def show_page(page):
+    pager.show(page)
+    print(f'page {pager.page}: slots {list(pager.page_slots())}')
+    if pager.page:
+        hw.status.count_number(pager.page + 1)
+    else:
+        hw.status.on()
+
+
+def chord(position):
+    """
+    Another slot button was held when position was pressed: show page
+    position, or when that is already shown, the next page on button
+    position (position + 4, ...). Only the first press of position while
+    the other is held turns the page, so the second click of a double
+    press stays on it. Returns True if the press was (part of) a chord.
+    """
+    held = hw.chord_partner(position)
+    if held is None:
+        return False
+    if _chords.get(held) != position:
+        _chords[held] = position
+        slot = pager.slot(held)
+        if timers[slot] and leds[slot].armed():
+            # the held button's own press was no status check, leave its slot armed
+            timers[slot].deinit()
+            timers[slot] = None
+        show_page(pager.next_page(position))
+    return True
+
+
+def in_chord(position):
+    # held for a chord, or pressed while another button was held for one
+    return position in _chords or position in _chords.values()
+
+
+def chord_released(position):
+    # from the button IRQ: the held half of a chord came up, the next chord turns the page again
+    _chords.pop(position, None)
+
+
+async def arm_page():
+    # ping every registered slot on the shown page, arm the ones that answer
+    jobs = [
+        ping_one(slot, leds[slot].alternate_colors)
+        for slot in pager.page_slots() if registry.slots[slot].get('ip')]
+    await run_bounded(jobs, _FANOUT)
+
+
+async def arm_all():
+    # ping every registered slot on every page, _FANOUT at a time, arm the ones that answer
+    jobs = [
+        ping_one(slot, leds[slot].alternate_colors)
+        for slot, claymore in registry.registered() if claymore.get('ip')]
+    print(f'arming {len(jobs)} claymores')
+    await run_bounded(jobs, _FANOUT)
+
+
 async def single_press(position):
     print(f'single_press {position}')
     try:
-        gc.collect()
-        ip = db['claymores'][position].get('ip')
+        if chord(position):
+            return
+        position = pager.slot(position)
+        ip = registry.slots[position].get('ip')
         if not ip:
             return
-        loop = get_event_loop()
-        loop.create_task(check_one(ip, position))
-        await sleep_ms(5)  # let our ping_one task start
+        check = show_slot(position, ip)
+        if check:
+            await check
     except Exception as e:
-        hw.leds[position].off()
         print_exception(e)
 
 
 async def double_press(position):
     print(f'double_press {position}')
     try:
+        if chord(position):
+            # hold any button + double press another: show that page and arm all of it
+            await arm_page()
+            return
+        position = pager.slot(position)
         loop = get_event_loop()
         # blink the LED
-        loop.create_task(ping_one(position, hw.leds[position].blink))
+        loop.create_task(ping_one(position, leds[position].blink))
         await sleep_ms(5)  # let our ping_one task start
     except Exception as e:
-        hw.leds[position].off()
         print_exception(e)
 
 
 async def long_press(position):
     print(f'long_press {position}')
+    if in_chord(position):
+        if position in _chords.values():
+            # hold any button + long press another: arm every registered claymore
+            await arm_all()
+        return  # the held button, kept down for a chord, arms nothing
+    slot = pager.slot(position)
     try:
         loop = get_event_loop()
         # alternate the LED
-        loop.create_task(ping_one(position, hw.leds[position].alternate_colors))
+        loop.create_task(ping_one(slot, leds[slot].alternate_colors))
         await sleep_ms(5)  # let our ping_one task start
     except Exception as e:
-        hw.leds[position].off()
+        leds[slot].off()
         print_exception(e)
 
 
@@ -234,7 +433,7 @@ def setup_pushbutton(pb, position):
 
 
 # Index page
-@app.route('/')
+@metrics.route(app, '/')
 async def index(_request, response):
     # Start HTTP response with content-type text/html
     print(response.writer.get_extra_info('peername'))
@@ -249,7 +448,7 @@ async def index(_request, response):
         print_exception(e)
 
 
-@app.route('/ping')
+@metrics.route(app, '/ping')
 async def ping(_request, response):
     await response.start_html()
     try:
@@ -262,23 +461,8 @@ async def ping(_request, response):
 
 class Register:
 
-    def _update_from_db(self, data, id):
-        data.update({
-            'id': id,
-            'team': db['clacker']['team']})
-
-    def _find_slot_in_db(self, mac):
-        first_empty = -1
-        for i, claymore in enumerate(db['claymores']):
-            try:
-                if not claymore:
-                    if first_empty < 0:
-                        first_empty = i
-                elif claymore.get('mac', 'no-mac').lower() == mac.lower():
-                    return i, claymore
-            except Exception as e:
-                print_exception(e)
-        return first_empty, {}
+    def _update_from_db(self, data):
+        data.update({'team': db['clacker']['team']})
 
     def not_exists(self, msg='unknown mac', err=404):
         return {'message': msg}, err
@@ -286,7 +470,7 @@ class Register:
     def get(self, data, mac):
         """Get detailed information about given claymore's mac"""
         print(f'GET /register/{mac} GET {data}')
-        found_i, claymore = self._find_slot_in_db(mac)
+        found_i, claymore = registry.find(mac)
         if not claymore:
             return self.not_exists()
         print('Returning:', claymore)
@@ -295,21 +479,14 @@ class Register:
     def post(self, data, mac):
         """create given claymore"""
         print(f'/register/{mac} POST {data}')
-        found_i, claymore = self._find_slot_in_db(mac)
-        try:
-            if found_i < 0:
-                print('post here 3')
-                return self.not_exists('Clacker FULL', 405)
-            if claymore:  # is not empty
-                print('post here 4')
-                return self.not_exists('mac already exists. Try PUT', 403)
-        except Exception as e:
-            print_exception(e)
+        found_i, claymore = registry.find(mac)
+        if claymore:  # is not empty
+            return self.not_exists('mac already exists. Try PUT', 403)
 
         try:
-            self._update_from_db(data, found_i)
-            db['claymores'][found_i] = data
-            db[mac] = data
+            self._update_from_db(data)
+            if registry.add(mac, data) < 0:
+                return self.not_exists('Clacker FULL', 405)
             db.flush()
         except Exception as e:
             print_exception(e)
@@ -318,30 +495,93 @@ class Register:
 
     def put(self, data, mac):
         """Update given mac"""
-        found_i, claymore = self._find_slot_in_db(mac)
-        if found_i < 0 or (not claymore):
+        found_i, claymore = registry.find(mac)
+        if found_i < 0:
             return self.not_exists()
         print(f'/register/{mac} PUT {data}')
 
-        self._update_from_db(data, found_i)
-        db['claymores'][found_i] = data
-        db[mac] = data
+        self._update_from_db(data)
+        registry.update(found_i, data)
         db.flush()
         return data
 
     def delete(self, data, mac):
         """Delete customer"""
-        found_i, claymore = self._find_slot_in_db(mac)
-        if found_i < 0 or (not claymore):
+        found_i, claymore = registry.find(mac)
+        if found_i < 0:
             return self.not_exists()
         print(f'/register/{mac} DELETE {data} -> {found_i}')
-        del db[mac]
-        db['claymores'][found_i] = {}
+        registry.remove(found_i)
+        states.forget(found_i)
+        db.flush()
+        return {'message': 'successfully deleted'}
+
+
+class Sequences:
+
+    def get(self, _data, name):
+        """Steps of a sequence, 'all' for every sequence, the selected one and the last run report"""
+        if name == 'all':
+            return {
+                'sequences': db['sequences'], 'selected': db['clacker'].get('sequence'),
+                'last': sequencer.last}
+        if name not in db['sequences']:
+            return {'message': 'unknown sequence'}, 404
+        return {'name': name, 'steps': db['sequences'][name]}
+
+    def put(self, data, name):
+        """Create or replace a sequence: {"steps": [[offset_ms, [slot, ...]], ...]}"""
+        try:
+            db['sequences'][name] = validate(data.get('steps'), hw.MAX_CLAYMORES)
+        except (ValueError, AttributeError) as e:
+            return {'message': str(e)}, 400
+        db.flush()
+        return {'name': name, 'steps': db['sequences'][name]}
+
+    def post(self, _data, name):
+        """Select the sequence a double press of FIRE runs"""
+        if name not in db['sequences']:
+            return {'message': 'unknown sequence'}, 404
+        db['clacker']['sequence'] = name
+        db.flush()
+        return {'selected': name}
+
+    def delete(self, _data, name):
+        if name not in db['sequences']:
+            return {'message': 'unknown sequence'}, 404
+        del db['sequences'][name]
         db.flush()
         return {'message': 'successfully deleted'}
 
 
-@app.route('/register')
+class MetricsReport:
+
+    def get(self, _data):
+        """Latency histograms, error counters and free heap"""
+        return metrics.report()
+
+
+class Traces:
+
+    def get(self, _data, trace):
+        """Stage timings of a FIRE button trace, 'all' for the last few"""
+        if trace == 'all':
+            return {'traces': traces.recent()}
+        report = traces.get(int(trace))
+        return report if report else ({'message': 'unknown trace'}, 404)
+
+
+class ClackStats:
+
+    def get(self, _data):
+        """UDP fire sequence, per-slot dispatch->actuation latency and pushed state"""
+        stats = clack.stats()
+        stats['states'] = states.slots
+        stats.update({'state_pushes': states.pushes, 'syncs': states.syncs})
+        return stats
+
+
+@metrics.route(app, '/register')
 async def register(_request, response):
     print(response.writer.get_extra_info('peername'))
     await response.start_html()
@@ -355,21 +595,38 @@ async def register(_request, response):
 
 
 async def main():
-    app.add_resource(Register, '/register/<mac>')
+    metrics.add_resource(app, Register, '/register/<mac>')
+    metrics.add_resource(app, ClackStats, '/clack')
+    metrics.add_resource(app, Sequences, '/sequences/<name>')
+    metrics.add_resource(app, MetricsReport, '/metrics')
+    metrics.add_resource(app, Traces, '/trace/<trace>')
+    metrics.sources.append(pool.stats)
+    metrics.sources.append(lambda: {'udp_retransmits': clack.retransmits})
+    metrics.sources.append(captive.stats)
 
     app.run(host='0.0.0.0', port=80, loop_forever=False)
 
     # add pushbutton actions to the event queue
     hw.pb_fire.press_func(single_press_fire, tuple())
     hw.pb_fire.double_func(double_press_fire, tuple())
-    hw.pb_fire.long_func(long_press_fire, tuple())
+    hw.pb_fire.long_func(long_press_detected, tuple())
 
     for position, pb in enumerate(hw.pushbuttons):
         setup_pushbutton(pb, position)
+    hw.released = chord_released
 
     loop = get_event_loop()
     loop.set_exception_handler(_handle_exception)
     await captive.add_server(loop)
+    loop.create_task(clack.run())
+    states.verify = lambda slot, ip: registry.slot_of_ip(ip) == slot
+    loop.create_task(states.run())
+    if db['clacker'].get('channel_watch_ms'):
+        # look for a quieter channel while running, db['clacker']['channel_watch_ms'] apart
+        watch = ChannelWatch(channel, claymore_rtts, db['clacker']['channel_watch_ms'])
+        scanner.busy = lambda: clack.in_flight() or sequencer.running is not None
+        metrics.sources.append(watch.stats)
+        loop.create_task(watch.run())
     print('Looping forever...')
     loop.run_forever()
 
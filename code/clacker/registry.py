@@ -0,0 +1,101 @@
+"""
+(C) Rod Slattery 2024
+Registry of claymores known to this CLACKER
+
+db['claymores'] is the one persisted copy of every record, indexed by slot.
+The MAC and IP dicts below only map to slot numbers, so every lookup is
+constant time no matter how many claymores are registered.
+"""
+
+
+def normalize_mac(mac):
+    """ 'aa:bb:cc:dd:ee:ff' or 'AABBCCDDEEFF' -> 'AABBCCDDEEFF' """
+    return mac.replace(':', '').replace('-', '').upper()
+
+
+class Registry:
+    def __init__(self, db, max_slots):
+        self.db = db
+        self.slots = db.setdefault('claymores', [])
+        if len(self.slots) < max_slots:
+            self.slots.extend({} for _ in range(max_slots - len(self.slots)))
+        self._by_mac = {}  # normalized mac -> slot
+        self._by_ip = {}  # ip -> slot
+        self._free = []  # empty slots, highest first so pop() hands out the lowest
+        for slot in range(len(self.slots) - 1, -1, -1):
+            record = self.slots[slot]
+            if record and record.get('mac'):
+                self._index(slot, record)
+            else:
+                self.slots[slot] = {}
+                self._free.append(slot)
+        self._drop_legacy_copies()
+
+    def _drop_legacy_copies(self):
+        # older firmware also stored each record under db[mac]
+        for key in [k for k in self.db if normalize_mac(k) in self._by_mac]:
+            del self.db[key]
+
+    def _index(self, slot, record):
+        self._by_mac[normalize_mac(record['mac'])] = slot
+        ip = record.get('ip')
+        if ip:
+            other = self._by_ip.get(ip)
+            if other is not None and other != slot:
+                self.slots[other].pop('ip', None)  # its lease went to this claymore, it has moved on
+            self._by_ip[ip] = slot
+
+    def _unindex(self, slot):
+        record = self.slots[slot]
+        if record.get('mac'):
+            self._by_mac.pop(normalize_mac(record['mac']), None)
+        if self._by_ip.get(record.get('ip')) == slot:
+            del self._by_ip[record['ip']]
+
+    def __len__(self):
+        return len(self._by_mac)
+
+    def capacity(self):
+        return len(self.slots)
+
+    def find(self, mac):
+        """ (slot, record) registered for mac, or (-1, {}) """
+        slot = self._by_mac.get(normalize_mac(mac), -1)
+        if slot < 0:
+            return -1, {}
+        return slot, self.slots[slot]
+
+    def slot_of_ip(self, ip):
+        return self._by_ip.get(ip)
+
+    def add(self, mac, record):
+        """ store record in the lowest free slot, return that slot or -1 if full """
+        if not self._free:
+            return -1
+        slot = self._free.pop()
+        record['id'] = slot
+        record['mac'] = record.get('mac') or mac
+        self.slots[slot] = record
+        self._index(slot, record)
+        return slot
+
+    def update(self, slot, record):
+        """ replace slot's record, re-indexed under its (maybe new) ip """
+        record['id'] = slot
+        record['mac'] = record.get('mac') or self.slots[slot]['mac']
+        self._unindex(slot)
+        self.slots[slot] = record
+        self._index(slot, record)
+
+    def remove(self, slot):
+        self._unindex(slot)
+        self.slots[slot] = {}
+        # keep the free list highest first
+        i = 0
+        while i < len(self._free) and self._free[i] > slot:
+            i += 1
+        self._free.insert(i, slot)
+
+    def registered(self):
+        """ (slot, record) of every registered claymore """
+        return [(slot, record) for slot, record in enumerate(self.slots) if record]
@@ -0,0 +1,138 @@
+"""
+(C) Rod Slattery 2024
+Choreographed fire sequences for the CLACKER
+
+A sequence is a list of steps [offset_ms, [slot, ...]]: every listed slot
+fires offset_ms after the sequence starts. Slots are registry ids, the
+same numbers the claymores count on their armed LED minus one. Sequences
+live in db['sequences'] by name, db['clacker']['sequence'] is the one a
+double press of FIRE runs.
+
+Timing rides on the synchronized FIRE of clack_protocol: each step is
+broadcast lead_ms ahead of its actuate-at, so a late or retransmitted
+datagram still lands before the servo has to move. Claymores without a
+fresh clock offset would fire the moment the datagram arrives, so their
+share of a step is broadcast at the step's own time instead.
+
+Everything is scheduled against one ticks_us origin, so a slow step does
+not push the later ones back. Per step the engine records how late the
+broadcast went out and, from the FIRED acknowledgements, how far each
+claymore's servo was from its target.
+"""
+from time import ticks_us, ticks_diff, ticks_add
+from uasyncio import sleep_ms
+from clack_protocol import slot_bitmap
+
+DEFAULT_SEQUENCES = {
+    'ripple': [[0, [0]], [150, [1]], [300, [2]], [450, [3]]],  # slots 1->4, 150ms apart
+    'pairs': [[0, [0, 2]], [300, [1, 3]]],  # alternating pairs
+}
+DEFAULT_SEQUENCE = 'ripple'
+_MAX_STEPS = 64
+_MAX_OFFSET = 60000  # ms
+
+
+def validate(steps, max_slots):
+    """ raise ValueError unless steps is a list of [offset_ms, [slot, ...]] """
+    if not isinstance(steps, list) or not 0 < len(steps) <= _MAX_STEPS:
+        raise ValueError(f'a sequence is a list of 1..{_MAX_STEPS} steps')
+    for step in steps:
+        if not isinstance(step, list) or len(step) != 2:
+            raise ValueError(f'step {step} is not [offset_ms, [slot, ...]]')
+        offset, slots = step
+        if not isinstance(offset, int) or not 0 <= offset <= _MAX_OFFSET:
+            raise ValueError(f'step offset {offset} is not 0..{_MAX_OFFSET}ms')
+        if not isinstance(slots, list) or not all(isinstance(s, int) and 0 <= s < max_slots for s in slots):
+            raise ValueError(f'step slots {slots} are not 0..{max_slots - 1}')
+    return steps
+
+
+class SequenceEngine:
+    def __init__(self, clack, lead_ms, schedule, deadline_ms):
+        self.clack = clack  # ClackSender
+        self.lead_ms = lead_ms
+        self.schedule = schedule
+        self.deadline_ms = deadline_ms
+        self.running = None  # name of the sequence in progress
+        self.last = None  # report of the last sequence run
+
+    def plan(self, steps, ready, synced):
+        """
+        Broadcasts for steps, limited to the ready slots:
+        [(send_ms, at_ms or None, slots, step), ...] ordered by send_ms,
+        times relative to the first step's actuation
+        """
+        dispatches = []
+        for step, (offset, slots) in enumerate(steps):
+            early = [slot for slot in slots if slot in ready and slot in synced]
+            on_time = [slot for slot in slots if slot in ready and slot not in synced]
+            if early:
+                dispatches.append((offset - self.lead_ms, offset, early, step))
+            if on_time:
+                dispatches.append((offset, None, on_time, step))
+        dispatches.sort(key=lambda d: d[0])
+        return dispatches
+
+    async def run(self, name, steps, ready, synced):
+        """
+        Fire steps for the ready slots (set), scheduling the synced ones
+        (set) ahead. Returns the per step report, also kept in self.last
+        """
+        dispatches = self.plan(steps, ready, synced)
+        report = {
+            'sequence': name, 'steps': [
+                {'at_ms': offset, 'slots': [s for s in slots if s in ready],
+                 'dispatch_late_us': None, 'fired': {}, 'missed': []}
+                for offset, slots in steps],
+            'max_error_us': None}
+        if not dispatches:
+            self.last = report
+            return report
+        step_of_seq = {}
+
+        def on_report(slot, fired):
+            step = step_of_seq.get(fired['seq'])
+            if step is not None:
+                report['steps'][step]['fired'][str(slot)] = fired['late_us']
+
+        self.running = name
+        self.clack.on_report = on_report
+        # origin: the first step actuates once the earliest broadcast has had its lead
+        origin = ticks_add(ticks_us(), -min(0, dispatches[0][0]) * 1000)
+        try:
+            for i, (send_ms, at_ms, slots, step) in enumerate(dispatches):
+                send_at = ticks_add(origin, send_ms * 1000)
+                wait_ms = ticks_diff(send_at, ticks_us()) // 1000
+                if wait_ms > 0:
+                    await sleep_ms(wait_ms)
+                step_report = report['steps'][step]
+                late = ticks_diff(ticks_us(), send_at)
+                step_report['dispatch_late_us'] = max(late, step_report['dispatch_late_us'] or 0)
+                # retransmit until the next broadcast is due, never past the usual deadline
+                deadline_ms = self.deadline_ms
+                if i + 1 < len(dispatches):
+                    next_at = ticks_add(origin, dispatches[i + 1][0] * 1000)
+                    deadline_ms = max(0, min(deadline_ms, ticks_diff(next_at, ticks_us()) // 1000))
+                at_us = None if at_ms is None else ticks_add(origin, at_ms * 1000)
+                step_of_seq[self.clack.seq + 1] = step  # the volley fire() is about to number
+                acked = await self.clack.fire(slot_bitmap(slots), self.schedule, deadline_ms, at_us=at_us)
+                step_report['missed'].extend(slot for slot in slots if slot not in acked)
+            # FIRED acknowledgements of the last scheduled step arrive after its actuate-at
+            last_at = ticks_add(origin, max(d[0] if d[1] is None else d[1] for d in dispatches) * 1000)
+            wait_ms = ticks_diff(last_at, ticks_us()) // 1000 + self.schedule[0]
+            if wait_ms > 0:
+                await sleep_ms(wait_ms)
+        finally:
+            self.clack.on_report = None
+            self.running = None
+        worst = None
+        for step_report in report['steps']:
+            # a FIRED report can beat the SCHEDULED one that fire() waited for
+            step_report['missed'] = [s for s in step_report['missed'] if str(s) not in step_report['fired']]
+            for late_us in step_report['fired'].values():
+                # fired on receipt: its error is how late the broadcast went out
+                error = abs(step_report['dispatch_late_us'] if late_us is None else late_us)
+                worst = error if worst is None else max(worst, error)
+        report['max_error_us'] = worst
+        self.last = report
+        return report
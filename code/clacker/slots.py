@@ -0,0 +1,106 @@
+"""
+(C) Rod Slattery 2024
+Claymore slots paged onto the CLACKER's LEDs and buttons
+
+The clacker has four buttons and four slot LEDs but can manage
+Clacker.MAX_CLAYMORES slots. Slots are grouped into pages of four; the
+page being shown decides which slot each button/LED stands for. With more
+pages than buttons, button n chords to pages n, n + 4, n + 8, ... in turn.
+
+Every slot gets a SlotLED that remembers what it should show (ON in a
+color, BLINK, ALTERNATE == armed, OFF) whether or not its page is visible,
+and forwards to the physical DualLED while it is. Switching page replays
+the remembered state of the new page's slots onto the hardware.
+"""
+
+OFF = 'OFF'
+ON = 'ON'
+BLINK = 'BLINK'
+ALTERNATE = 'ALTERNATE'
+
+
+class SlotLED:
+    """ the subset of DualLED the clacker main program uses, for one slot """
+
+    def __init__(self):
+        self.physical = None  # DualLED while our page is shown
+        self.state = OFF
+        self._color = None
+
+    def _apply(self):
+        led = self.physical
+        if led is None:
+            return
+        if self.state == ON and self._color:
+            led.on(self._color)
+        elif self.state == ON:
+            led.on()
+        elif self.state == BLINK:
+            led.blink()
+        elif self.state == ALTERNATE:
+            led.alternate_colors()
+        else:
+            led.off()
+
+    def on(self, color=None):
+        self.state = ON
+        self._color = color
+        self._apply()
+
+    def off(self):
+        self.state = OFF
+        self._apply()
+
+    def blink(self):
+        self.state = BLINK
+        self._apply()
+
+    def alternate_colors(self):
+        self.state = ALTERNATE
+        self._apply()
+
+    def armed(self):
+        return self.state == ALTERNATE
+
+    def get_state(self):
+        return {'STATE': self.state, 'COLOR': self._color}
+
+
+class SlotPager:
+    def __init__(self, leds, max_slots):
+        self.leds = leds  # physical DualLEDs, one per button
+        self.per_page = len(leds)
+        self.slots = [SlotLED() for _ in range(max_slots)]
+        self.pages = (max_slots + self.per_page - 1) // self.per_page
+        self.page = 0
+        self.show(0)
+
+    def slot(self, position):
+        """ slot number behind physical button/LED position on the current page """
+        return self.page * self.per_page + position
+
+    def next_page(self, position):
+        """ the page a chord on button position goes to: page position, or the next page sharing that button """
+        if self.page % self.per_page != position:
+            return position
+        page = self.page + self.per_page
+        return page if page < self.pages else position
+
+    def page_slots(self, page=None):
+        start = (self.page if page is None else page) * self.per_page
+        return range(start, min(start + self.per_page, len(self.slots)))
+
+    def show(self, page):
+        """ put page's slots onto the physical LEDs """
+        self.page = page % self.pages
+        for slot_led in self.slots:
+            slot_led.physical = None
+        for position, slot in enumerate(self.page_slots()):
+            self.slots[slot].physical = self.leds[position]
+            self.slots[slot]._apply()
+        for position in range(len(self.page_slots()), self.per_page):
+            self.leds[position].off()
+
+    def armed(self):
+        """ every armed slot on every page """
+        return [slot for slot, slot_led in enumerate(self.slots) if slot_led.armed()]
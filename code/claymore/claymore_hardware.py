@@ -1,5 +1,7 @@
 import sys
 import uasyncio as asyncio
+from micropython import const
+from time import ticks_us, ticks_diff
 from machine import Pin, Timer, PWM, WDT
 from dual_led import DualLED
 from primitives import Pushbutton
@@ -23,6 +25,9 @@ from hardware import *
 # SERVO_GPIO = 22        # PWM to control trigger servo
 
 
+_DEBOUNCE_MS = const(20)  # pins must be stable this long before the snapshot changes
+
+
 class MultiPushbutton(Pushbutton):
     def __init__(self, pin, suppress=False, sense=None):
         self._multipend = False  # Multiclick waiting for more_clicks
@@ -69,6 +74,18 @@ class Claymore:
         self.armed_led = DualLED(ARMED_RED_GPIO, ARMED_GRN_GPIO, self.team_color)
         self.signal_led = DualLED(SIGNAL_RED_GPIO, SIGNAL_GRN_GPIO, self.team_color)
 
+        # status() snapshot, version bumps on every change
+        self.version = 0
+        self._armed_state = None
+        self._signal_state = None
+        self._snapshot = {'team_color': self.team_color, 'trigger': 'READY'}
+        self._read_pins()
+        self._refresh_leds()
+        # any edge on an input restarts the debounce timer, the pins are read once they settle
+        self._debounce = Timer()
+        for pin in (self.door, self.team, self.ap_mode):
+            pin.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self._pin_edge)
+
         self.trigger = PWM(Pin(SERVO_GPIO))
         self.trigger.freq(50)
         self.timer = None
@@ -76,6 +93,28 @@ class Claymore:
         self.set_trigger_position(ServoReady)
         asyncio.create_task(self.test())
 
+    def _pin_edge(self, _pin):
+        self._debounce.init(mode=Timer.ONE_SHOT, period=_DEBOUNCE_MS, callback=self._read_pins)
+
+    def _update(self, key, value):
+        if self._snapshot.get(key) != value:
+            self._snapshot[key] = value
+            self.version += 1
+
+    def _read_pins(self, _t=None):
+        self._update('door', self.DOOR[self.door.value()])  # 0->CLOSED, 1->OPEN
+        self._update('team', self.TEAM[self.team.value()])
+        self._update('standalone', str(bool(self.ap_mode.value() == 0)))
+
+    def _refresh_leds(self):
+        # DualLED has no change callback, but comparing its state string is cheap
+        if self.armed_led.state != self._armed_state:
+            self._armed_state = self.armed_led.state
+            self._update('armed', self.armed_led.get_state())
+        if self.signal_led.state != self._signal_state:
+            self._signal_state = self.signal_led.state
+            self._update('signal', self.signal_led.get_state())
+
     async def test(self):
         self.armed_led.alternate_colors()
         self.signal_led.alternate_colors()
@@ -91,8 +130,16 @@ class Claymore:
         position = ServoMax if position > ServoMax else position
         self.servo_position = position
         self.trigger.duty_u16(position)
-
-    def fire_trigger(self):
+        self._update('trigger', self.trigger_state())
+
+    def fire_trigger(self, at_us=None):
+        """
+        fire now, or at ticks_us at_us (spins until then, keep it a few ms away)
+        returns the ticks_us the servo was set
+        """
+        if at_us is not None:
+            while ticks_diff(at_us, ticks_us()) > 0:
+                pass
         if self.timer:
             self.timer.deinit()
         signal_state = self.signal_led.state
@@ -108,24 +155,29 @@ class Claymore:
                 self.timer = None
 
         self.set_trigger_position(ServoFire)
+        servo_us = ticks_us()
         self.signal_led.alternate_colors()
         self.armed_led.alternate_colors()
         self.timer = Timer()
         self.timer.init(
             mode=Timer.ONE_SHOT, period=int(self.TRIGGER_RESET), callback=__reset_trigger)
+        return servo_us
+
+    def trigger_state(self):
+        return "READY" if self.servo_position == ServoReady else "FIRING"
 
     def status(self):
-        # status = get_wifi_status()
-        status = {
-            'door': self.DOOR[self.door.value()],  # 0->CLOSED, 1->OPEN
-            'team': self.TEAM[self.team.value()],
-            'team_color': self.team_color,
-            'standalone': str(bool(self.ap_mode.value() == 0)),
-            'armed': self.armed_led.get_state(),
-            'signal': self.signal_led.get_state(),
-            'trigger': "READY" if self.servo_position == ServoReady else "FIRING"
-        }
-        return status
+        """
+        Pin and LED state, kept current by pin IRQs. Returns the same dict
+        every time, do not modify it. See changed_since()
+        """
+        self._refresh_leds()
+        return self._snapshot
+
+    def changed_since(self, version):
+        """ True if status() differs from when self.version was version """
+        self._refresh_leds()
+        return self.version != version
 
 
 if __name__ == '__main__':
@@ -133,7 +185,7 @@ if __name__ == '__main__':
         while True:  # Poll hardware and update LEDs
             try:
                 await asyncio.sleep_ms(interval)
-                status = await self.status()
+                status = self.status()
                 self.team_color = DualLED.COLORS[self.team.value()]
                 self.armed_led.set_primary_color(self.team_color)
                 self.signal_led.set_primary_color(self.team_color)
@@ -6,16 +6,21 @@ Main program for CLAYMORE
 import errno
 import network
 import uasyncio as asyncio
-from os import remove
 from machine import (reset, WDT, reset_cause, PWRON_RESET, WDT_RESET)
 from micropython import const
-from time import sleep
+from time import sleep, ticks_ms, ticks_diff
 from sys import print_exception
+from ubinascii import unhexlify
 from tinyweb import webserver
-from aiohttp import ClientSession
+from http_pool import HttpPool
+from metrics import Metrics
+from trace import TraceLog
+from clack_protocol import ClackListener, StatePusher, parse_token, FIRED
 from helpers import (
-    PropertiesFromFiles, wifi_start_access_point, wifi_connect_to_access_point,
-    _handle_exception, mac_to_hostname, Database, scan_wifi, get_mac, WLAN_STATUS)
+    PropertiesFromFiles, wifi_start_access_point, wifi_connect_to_access_point, wifi_connect_async, Backoff,
+    _handle_exception, mac_to_hostname, get_mac, WLAN_STATUS)
+from wifi_scan import scanner
+from binary_db import BinaryDatabase
 # from captive_portal import CaptivePortal
 from claymore_hardware import Claymore
 from gc import collect
@@ -26,6 +31,14 @@ HOST_BASE_NAME = const('claymore')
 HTML_PATH = const("./html")
 WDT_TIMEOUT = const(8000)
 IP_TIMEOUT = const(6000)  # Must be less than WDT
+STATE_POLL = const(50)  # ms between door/trigger/armed LED checks
+DB_WRITE_BEHIND = const(2000)  # ms, coalesce db writes to flash
+FAST_JOIN = const(3000)  # ms to wait on the cached BSSID before falling back to a full scan
+JOIN_TIMEOUT = const(10000)  # ms to wait on the link after a scan found the clacker
+RESCAN_AGE = const(10000)  # ms, a rejoin reuses a scan this recent instead of scanning again
+REJOIN_POLL = const(100)  # ms, how often ping_forever checks on a rejoin in progress
+REJOIN_BACKOFF = (500, 4000)  # ms, first and longest wait between failed rejoins
+JOIN_BUCKETS_US = (100000, 250000, 500000, 1000000, 2000000, 4000000, 8000000, 16000000)  # rejoin times
 
 RESET_CAUSES = {
     PWRON_RESET: 'PWRON_RESET',
@@ -36,6 +49,14 @@ MY_WDT = None
 HTML = PropertiesFromFiles(HTML_PATH)  # JIT read html static pages into memory
 hw = Claymore()  # represents the Hardware in the Claymore
 app = webserver()  # Create web server application
+metrics = Metrics()  # latency histograms and error counts for GET /metrics
+pool = HttpPool(max_connections=1, timeout_ms=IP_TIMEOUT)  # keep-alive socket to our clacker
+clack = ClackListener(hw.fire_trigger)  # UDP FIRE broadcasts from our clacker
+pusher = StatePusher()  # UDP door/trigger/armed changes to our clacker
+traces = TraceLog()  # received/servo_set stages of fires the clacker traced, GET /trace/<id>
+backoff = Backoff(*REJOIN_BACKOFF)  # between failed attempts to rejoin the clacker
+traces.offset_us = lambda: clack.offset_us if clack.synced() else None
+clack.trace = traces
 
 hostname = mac_to_hostname(base=HOST_BASE_NAME)
 db_file = f'db_{hostname}.txt'
@@ -44,7 +65,7 @@ db_file = f'db_{hostname}.txt'
 # for now power on with the door open.
 # Then double-click the door button
 
-db = Database(db_file)
+db = BinaryDatabase(db_file, write_behind_ms=DB_WRITE_BEHIND)  # migrates an old JSON db_file
 db.setdefault('claymore', {}).update({'mac': get_mac()})  # , 'hostname': hostname})
 team = db['claymore'].setdefault('team', hw.team_color)
 if team != hw.team_color:
@@ -56,7 +77,7 @@ if team != hw.team_color:
 if hw.pb_door:
     def reset_db():
         print('RESET-Deleting DB')
-        remove(db_file)
+        db.erase()
         reset()
 
     hw.pb_door.multi_click_func(5, reset_db, tuple())
@@ -70,19 +91,25 @@ elif reset_cause() in [WDT_RESET]:
 else:
     print("UNKNOWN RESET CAUSE")
 
+def remember_ap(ap):
+    # the AP we joined, so a reconnect can go straight to it without a scan
+    db['clacker'].update({'bssid': ap['bssid'], 'channel': ap['channel'], 'security': ap['security']})
+
+
 # scan for wifi clacker
+team_terms = scanner.terms('clacker', team)  # must match both 'clacker' and team color
 available_wifi = []
 while not available_wifi:
+    scanner.scan()  # one scan answers both questions
     if db.get('clacker', {}).get('ssid'):
         # is old clacker available?
-        available_wifi = scan_wifi([db['clacker']['ssid']])
+        available_wifi = scanner.aps(scanner.terms(db['clacker']['ssid']))
         if not available_wifi:
             print(f"Our old clacker: {db['clacker']['ssid']} is not in the current list!")
             #  db.pop('clacker', None)  # Do we really want to do this?
-            # must match both 'clacker' and team color
-            available_wifi = scan_wifi(['clacker', team])
+            available_wifi = scanner.aps(team_terms)
     else:
-        available_wifi = scan_wifi(['clacker', team])
+        available_wifi = scanner.aps(team_terms)
     if not available_wifi:
         print(f"No suitable APs available for {db['clacker']['ssid']} or team {team}")
         sleep(3)
@@ -99,10 +126,11 @@ for ap in available_wifi:
         db['claymore'].update({'ip': ip})  # , 'url': f'http://{ip}'})
         db.setdefault('clacker', {}).update({'ssid': ap['ssid'], 'password': password})
         db['clacker'].update({'ip': clacker_ip, 'url': f"http://{clacker_ip}"})
+        remember_ap(ap)
         break
     except Exception as e:
         print_exception(e)
-db.flush()
+db.sync()
 
 print(f"pico w IP: http://{ip}:80")
 print(f"pico w IP: http://{network.hostname()}:80")
@@ -111,31 +139,101 @@ print(f"pico w IP: http://{network.hostname()}:80")
 # captive = CaptivePortal(ip)
 captive = None
 url_base = db['clacker']['url']
+clacker_terms = scanner.terms(db['clacker']['ssid'])  # what a rescan looks for
+
 
+def update_clack_listener():
+    # only act on FIRE datagrams from our clacker, for our team and slot
+    clack.clacker_ip = db['clacker']['ip']
+    clack.team = db['claymore']['team']
+    clack.slot = db['claymore'].get('id')
 
-def rescan_wifi(ssid):
-    available_wifi = scan_wifi([ssid])
+
+def rescan_wifi(terms):
+    # a scan from a rejoin attempt moments ago will do
+    available_wifi = scanner.aps(terms, max_age_ms=RESCAN_AGE)
     print(f'\nRescan APs found:\n{available_wifi}')
     return available_wifi
 
 
+async def join_clacker():
+    """
+    rejoin our clacker: straight to the BSSID we last joined first, the
+    full scan only when that does not connect within FAST_JOIN
+    returns (ip, clacker_ip), None if the clacker is nowhere to be seen
+    """
+    clacker = db['clacker']
+    start = ticks_ms()
+    how = 'cached'
+    joined = None
+    if clacker.get('bssid'):
+        joined = await wifi_connect_async(
+            clacker['ssid'], clacker['password'], timeout_ms=FAST_JOIN, bssid=unhexlify(clacker['bssid']))
+    if joined is None:
+        avail = rescan_wifi(clacker_terms)  # blocks while the radio scans, unless a recent scan will do
+        MY_WDT.feed()
+        if not avail:
+            return None
+        joined = await wifi_connect_async(clacker['ssid'], clacker['password'], timeout_ms=JOIN_TIMEOUT)
+        if joined is None:
+            return None
+        remember_ap(avail[0])
+        how = 'scan'
+    elapsed = ticks_diff(ticks_ms(), start)
+    metrics.histogram(f'wifi_join_{how}', JOIN_BUCKETS_US).record(elapsed * 1000)
+    print(f"Rejoined {clacker['ssid']} ({how}) in {elapsed} ms")
+    return joined
+
+
+async def rejoin_forever():
+    """
+    background task: rejoin the clacker and register again, retrying with
+    backoff until both worked; /clack, the LEDs and ping_forever carry on
+    """
+    await pool.close()  # sockets from the old link are dead
+    while True:
+        try:
+            joined = await join_clacker()
+            if joined:
+                ip, clacker_ip = joined
+                db['claymore'].update({'ip': ip})  # , 'url': f'http://{ip}'})
+                db['clacker'].update({'ip': clacker_ip, 'url': f"http://{clacker_ip}"})
+                db['claymore']['id'] = await get_registered(db)
+                db.flush()
+                update_clack_listener()
+                metrics.count('wifi_reconnects')
+                backoff.reset()
+                return
+        except Exception as e:
+            print_exception(e)
+        await asyncio.sleep_ms(backoff.next())
+
+
+_index_cache = [-1, None]  # [hw.version, html]
+
+
+def render_index():
+    # only re-render the page when the hardware snapshot has changed
+    if hw.changed_since(_index_cache[0]):
+        _index_cache[1] = HTML.fire.format(**hw.status())
+        _index_cache[0] = hw.version
+    return _index_cache[1]
+
+
 # Index page
-@app.route('/')
+@metrics.route(app, '/')
 async def index(_request, response):
     # Start HTTP response with content-type text/html
     await response.start_html()
     try:
-        state = await hw.status()
-        print(state)
-        html = HTML.fire.format(**state)
         # Send actual HTML page
-        await response.send(html)
+        await response.send(render_index())
     except Exception as e:
         print_exception(e)
         return str(e), 500
 
 
-@app.route('/fire')
+@metrics.route(app, '/fire')
 async def fire_get(_request, response):
     try:
         # Start HTTP response with content-type text/html
@@ -146,22 +244,19 @@ async def fire_get(_request, response):
         return str(e), 500
 
 
-@app.route('/status')
+@metrics.route(app, '/status')
 async def status(_request, response):
     await response.start_html()
     try:
         # Start HTTP response with content-type text/html
-        status = hw.status()
-        state = status['door']
-        print(state)
         # Send actual HTML page
-        await response.send(state)
+        await response.send(hw.status()['door'])
     except Exception as e:
         print_exception(e)
         return str(e), 500
 
 
-@app.route('/ping')
+@metrics.route(app, '/ping')
 async def ping(_request, response):
     await response.start_html()
     try:
@@ -173,12 +268,27 @@ async def ping(_request, response):
         await response.send(str(e)), 500
 
 
+class MetricsReport:
+    def get(self, _data):
+        """Latency histograms, error counters and free heap"""
+        return metrics.report()
+
+
+class Traces:
+    def get(self, _data, trace):
+        """Stage timings of a traced fire, 'all' for the last few"""
+        if trace == 'all':
+            return {'traces': traces.recent()}
+        report = traces.get(int(trace))
+        return report if report else ({'message': 'unknown trace'}, 404)
+
+
 class Clack:
-    async def get(self, data):
+    def get(self, data):
         print(f'/clack GET {data}')
         try:
-            status = await hw.status()
-            data.update(status)  #  = {'door': status['door']}
+            data.update(hw.status())  #  = {'door': status['door']}
+            data.update(clack.stats())
             print(data)
             # print(f'Returning:\n{json.dumps(status)}')
             return data
@@ -186,20 +296,48 @@ class Clack:
             print_exception(e)
             return str(e), 500
 
-    async def post(self, data):
+    def post(self, data):
         print(f'/clack POST {data}')
         try:
-            hw.fire_trigger()
+            # same idempotency token as the UDP FIRE, so a fallback never fires twice
+            token = data.get('token') if isinstance(data, dict) else None
+            trace = data.get('trace', 0) if isinstance(data, dict) else 0
+            traces.stamp(trace, 'received')
+            status = clack.actuate(parse_token(token) if token else None, trace)
             print("fire_trigger 5")
-            return 'FIRE'
+            return 'FIRE' if status == FIRED else 'DUPLICATE'
         except Exception as e:
             print_exception(e)
             return str(e), 500
 
 
+async def push_state_forever(poll_ms=STATE_POLL, heartbeat_ms=IP_TIMEOUT):
+    # push door/trigger/armed LED to the clacker the moment one changes,
+    # and at least every heartbeat_ms so a rebooted clacker catches up
+    version = -1
+    since = 0
+    while True:
+        await asyncio.sleep_ms(poll_ms)
+        since += poll_ms
+        if clack.slot is None:
+            continue  # not registered yet
+        if not hw.changed_since(version) and since < heartbeat_ms:
+            continue
+        try:
+            status = hw.status()
+            pusher.push(
+                db['clacker']['ip'], clack.slot,
+                status['door'], status['trigger'], hw.armed_led.state, clack.sync_rtt_us)
+            version = hw.version
+            since = 0
+        except OSError as e:
+            print_exception(e)
+
+
 async def ping_forever(interval_ms=None):
     interval_ms = interval_ms or IP_TIMEOUT
     err_do_reconnect = True
+    rejoin = None  # rejoin_forever() task
     while True:
         MY_WDT.feed()
         collect()  # the garbage
@@ -212,20 +350,17 @@ async def ping_forever(interval_ms=None):
             wlan_status = network.WLAN().status()
             if (wlan_status != 3) or err_do_reconnect:  # NOT LINK_UP or failed in some other way
                 print('wlanstatus =', WLAN_STATUS.get(wlan_status, f'UNKNOWN{wlan_status}'))
-                MY_WDT.feed()
-                avail = rescan_wifi(db['clacker']['ssid'])
-                MY_WDT.feed()
-                if avail:
-                    # try reconnect (This may not play well with asyncio)
-                    ip, clacker_ip = wifi_connect_to_access_point(
-                        ssid=db['clacker']['ssid'], password=db['clacker']['password'])
+                if rejoin is None or rejoin.done():
+                    rejoin = asyncio.create_task(rejoin_forever())
+                err_do_reconnect = False
+            if rejoin is not None and not rejoin.done():
+                # give the rejoin up to one interval, then look again
+                start = ticks_ms()
+                while not rejoin.done() and ticks_diff(ticks_ms(), start) < interval_ms:
                     MY_WDT.feed()
-                    db['claymore'].update({'ip': ip})  # , 'url': f'http://{ip}'})
-                    db['clacker'].update({'ip': clacker_ip, 'url': f"http://{clacker_ip}"})
-                    db['claymore']['id'] = await get_registered(db)
-                    db.flush()
-                    err_do_reconnect = False
-
+                    await asyncio.sleep_ms(REJOIN_POLL)
+                if not rejoin.done():
+                    continue  # nothing to ping yet
         except Exception as e:
             print_exception(e)
         MY_WDT.feed()
@@ -234,6 +369,8 @@ async def ping_forever(interval_ms=None):
             MY_WDT.feed()
             print(pong)
             if pong.lower() == 'pong':
+                await clack.sync()  # the link is up, refresh our clock offset to the clacker
+                MY_WDT.feed()
                 if not hw.timer:  # we may be doing something else...
                     hw.signal_led.on()
                     if not hw.armed_led.state.startswith('COUNT'):
@@ -246,7 +383,7 @@ async def ping_forever(interval_ms=None):
             print_exception(e)
             err_do_reconnect = True
         except OSError as e:
-            print(f'OSError during Ping: {e.errno=} {e.value=}')
+            print(f'OSError during Ping: {e.errno=} {e.args=}')
             hw.signal_led.blink()
             print_exception(e)
             if e.errno == errno.ENOMEM:
@@ -263,39 +400,28 @@ async def ping_forever(interval_ms=None):
 
 
 async def send_ping(url):
-    # ping with a shorter timeout if the wifi has dropped
-    async with ClientSession() as session:
-        # add a timeout in case our wifi connection has gone bad
-        # let the timeout exception bubble up so it can be handled
-        MY_WDT.feed()
-        ses = session.get(url)
-        resp = await asyncio.wait_for(ses.__aenter__(), timeout=IP_TIMEOUT)
-        MY_WDT.feed()
-        pong = await asyncio.wait_for(resp.text(), timeout=IP_TIMEOUT)
-        MY_WDT.feed()
-        await asyncio.wait_for(ses.__aexit__(None, None, None), timeout=IP_TIMEOUT)
-        MY_WDT.feed()
-        return pong, resp.status
+    # ping with a timeout in case our wifi connection has gone bad
+    # let the timeout exception bubble up so it can be handled
+    MY_WDT.feed()
+    resp = await metrics.timed('out_ping', pool.get(url))
+    MY_WDT.feed()
+    return resp.text(), resp.status
 
 
 async def send_rest(verb, url, **kwargs):
     MY_WDT.feed()
     data = None
-    async with ClientSession() as session:
-        ses = session.request(verb, url, **kwargs)
-        resp = await asyncio.wait_for(ses.__aenter__(), timeout=IP_TIMEOUT)
-        MY_WDT.feed()
-        if resp.status == 200:
-            data = await asyncio.wait_for(resp.json(), timeout=IP_TIMEOUT)
-            MY_WDT.feed()
-        await asyncio.wait_for(ses.__aexit__(None, None, None), timeout=IP_TIMEOUT)
-        MY_WDT.feed()
-        return data, resp.status
+    resp = await metrics.timed('out_register', pool.request(verb, url, **kwargs))
+    MY_WDT.feed()
+    if resp.status == 200:
+        data = resp.json()
+    return data, resp.status
 
 
 async def get_registered(db):
     await send_ping(f"{db['clacker']['url']}/ping")  # may cause a timeout if no response
     url = f"{db['clacker']['url']}/register/{db['claymore']['mac']}"
+    ip = db['claymore'].get('ip')  # this link's address, whatever the clacker remembers
     print(f'Getting registered: {url}')
     for verb in ['GET', 'POST', 'PUT', 'GET']:
         if verb == 'GET':
@@ -303,6 +429,12 @@ async def get_registered(db):
         else:
             data, resp_status = await send_rest(verb, url, json=db['claymore'])
         print(f'{verb} {url} -> {resp_status}:{data}')
+        if resp_status == 200 and 'id' in data and data.get('ip') != ip:
+            # registered at an old DHCP lease: the clacker must learn the new one or it drops our pushes
+            print(f"registered at {data.get('ip')}, now {ip}")
+            data['ip'] = ip
+            data, resp_status = await send_rest('PUT', url, json=data)
+            print(f'PUT {url} -> {resp_status}:{data}')
         if resp_status == 200:
             if 'id' in data:
                 db['claymore'].update(data)
@@ -317,9 +449,14 @@ async def run():
     # ping-pong our clacker
     db.setdefault('clacker', {}).update({'ssid': ap['ssid'], 'password': password, 'security': ap['security']})
     db['clacker'].update({'ip': clacker_ip, 'url': f"http://{clacker_ip}"})
-    db.flush()
-
-    app.add_resource(Clack, '/clack')
+    db.sync()
+
+    metrics.add_resource(app, Clack, '/clack')
+    metrics.add_resource(app, MetricsReport, '/metrics')
+    metrics.add_resource(app, Traces, '/trace/<trace>')
+    metrics.sources.append(pool.stats)
+    metrics.sources.append(clack.stats)
+    metrics.sources.append(scanner.stats)
     app.run(host='0.0.0.0', port=80, loop_forever=False)
 
     loop = asyncio.get_event_loop()
@@ -327,6 +464,8 @@ async def run():
     if captive:
         await captive.add_server(loop)
     loop.create_task(ping_forever())
+    loop.create_task(clack.run())
+    loop.create_task(push_state_forever())
     print('Looping forever...')
     loop.run_forever()
 
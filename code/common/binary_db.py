@@ -0,0 +1,289 @@
+"""
+Compact binary on-flash format for helpers.Database
+Intended for Raspberry Pi Pico W
+
+JSON parsing at boot churns the heap while the claymore is racing its
+8 s WDT. This format stores the known record shapes as length-prefixed
+fields that are read straight out of one buffer with struct.unpack_from;
+the only allocations are the resulting strings and dicts.
+
+File layout (little endian):
+    b'FCDB' version:u8 count:u8
+    count x record:
+        kind:u8 key:str value
+
+    str     len:u8 utf-8 bytes (len 255 == None)
+    present u8 bit n set when the n-th fixed field is in the record at all
+    extras  len:u16 JSON of any keys beyond the fixed fields (0 == none)
+
+    KIND_JSON      len:u32 JSON          anything not matching a shape
+    KIND_CLAYMORE  present mac ip team:str id:i16 (-1 == None) extras
+    KIND_CLACKER   present ssid password ip url:str extras
+    KIND_CLAYMORES count:u8 x (empty:u8 | claymore record)
+
+Whatever is saved loads back equal: a missing field and one set to None
+are told apart by present.
+
+A missing .bin with an existing JSON db (db_<hostname>.txt) is migrated
+on first load and the JSON file removed. A .bin that does not decode falls back to the .tmp
+of an interrupted write, then the JSON db, then an empty db, rather than
+failing every boot.
+"""
+import json
+import struct
+from os import stat, remove
+from sys import print_exception
+from micropython import const
+from helpers import Database, file_exists
+
+_MAGIC = b'FCDB'
+_VERSION = const(2)
+_NONE = const(255)
+
+KIND_JSON = const(0)
+KIND_CLAYMORE = const(1)
+KIND_CLACKER = const(2)
+KIND_CLAYMORES = const(3)
+
+_CLAYMORE_FIELDS = ('mac', 'ip', 'team')
+_CLAYMORE_KEYS = _CLAYMORE_FIELDS + ('id', )  # the present bits of a claymore record
+_CLACKER_FIELDS = ('ssid', 'password', 'ip', 'url')
+# top level key -> record shape
+_SHAPES = {'claymore': KIND_CLAYMORE, 'clacker': KIND_CLACKER, 'claymores': KIND_CLAYMORES}
+
+
+def _bin_name(filename):
+    return filename.rsplit('.', 1)[0] + '.bin'
+
+
+def _str_fits(value):
+    return value is None or (isinstance(value, str) and len(value.encode()) < _NONE)
+
+
+def _record_fits(record, fields):
+    if not isinstance(record, dict):
+        return False
+    for field in fields:
+        if not _str_fits(record.get(field)):
+            return False
+    return True
+
+
+def _claymore_fits(record):
+    if not _record_fits(record, _CLAYMORE_FIELDS):
+        return False
+    i = record.get('id')
+    return i is None or (isinstance(i, int) and 0 <= i < 0x7fff)
+
+
+def _fits(kind, value):
+    if kind == KIND_CLAYMORE:
+        return _claymore_fits(value)
+    if kind == KIND_CLACKER:
+        return _record_fits(value, _CLACKER_FIELDS)
+    if kind == KIND_CLAYMORES:
+        return isinstance(value, list) and len(value) < 256 and all(r == {} or _claymore_fits(r) for r in value)
+    return False
+
+
+# ---- encode -------------------------------------------------------------
+
+def _put_str(out, value):
+    if value is None:
+        out.append(_NONE)
+        return
+    raw = value.encode()
+    out.append(len(raw))
+    out.extend(raw)
+
+
+def _put_json(out, value, fmt='<H'):
+    raw = json.dumps(value).encode() if value is not None else b''
+    out.extend(struct.pack(fmt, len(raw)))
+    out.extend(raw)
+
+
+def _put_present(out, record, keys):
+    present = 0
+    for bit, key in enumerate(keys):
+        if key in record:
+            present |= 1 << bit
+    out.append(present)
+
+
+def _put_fields(out, record, fields, skip=()):
+    for field in fields:
+        _put_str(out, record.get(field))
+    return {k: v for k, v in record.items() if k not in fields and k not in skip}
+
+
+def _put_claymore(out, record):
+    _put_present(out, record, _CLAYMORE_KEYS)
+    extras = _put_fields(out, record, _CLAYMORE_FIELDS, ('id', ))
+    i = record.get('id')
+    out.extend(struct.pack('<h', -1 if i is None else i))
+    _put_json(out, extras or None)
+
+
+def encode(d):
+    out = bytearray(_MAGIC)
+    out.append(_VERSION)
+    out.append(len(d))
+    for key, value in d.items():
+        kind = _SHAPES.get(key, KIND_JSON)
+        if not _fits(kind, value):
+            kind = KIND_JSON
+        out.append(kind)
+        _put_str(out, key)
+        if kind == KIND_CLAYMORE:
+            _put_claymore(out, value)
+        elif kind == KIND_CLACKER:
+            _put_present(out, value, _CLACKER_FIELDS)
+            _put_json(out, _put_fields(out, value, _CLACKER_FIELDS) or None)
+        elif kind == KIND_CLAYMORES:
+            out.append(len(value))
+            for record in value:
+                out.append(1 if record else 0)
+                if record:
+                    _put_claymore(out, record)
+        else:
+            _put_json(out, value, '<I')
+    return out
+
+
+# ---- decode -------------------------------------------------------------
+
+def _get_str(buf, mv, pos):
+    n = buf[pos]
+    pos += 1
+    if n == _NONE:
+        return None, pos
+    return str(mv[pos:pos + n], 'utf-8'), pos + n
+
+
+def _get_json(buf, mv, pos, fmt='<H', size=2):
+    n = struct.unpack_from(fmt, buf, pos)[0]
+    pos += size
+    if not n:
+        return None, pos
+    return json.loads(str(mv[pos:pos + n], 'utf-8')), pos + n
+
+
+def _get_fields(buf, mv, pos, fields, record):
+    present = buf[pos]
+    pos += 1
+    for bit, field in enumerate(fields):
+        value, pos = _get_str(buf, mv, pos)
+        if present & (1 << bit):
+            record[field] = value
+    return present, pos
+
+
+def _get_claymore(buf, mv, pos):
+    record = {}
+    present, pos = _get_fields(buf, mv, pos, _CLAYMORE_FIELDS, record)
+    i = struct.unpack_from('<h', buf, pos)[0]
+    if present & (1 << len(_CLAYMORE_FIELDS)):
+        record['id'] = None if i < 0 else i
+    extras, pos = _get_json(buf, mv, pos + 2)
+    if extras:
+        record.update(extras)
+    return record, pos
+
+
+def decode(buf):
+    mv = memoryview(buf)
+    if bytes(mv[:4]) != _MAGIC:
+        raise ValueError('not a binary db')
+    version, count = buf[4], buf[5]
+    if version != _VERSION:
+        raise ValueError(f'unsupported binary db version {version}')
+    d = {}
+    pos = 6
+    for _ in range(count):
+        kind = buf[pos]
+        key, pos = _get_str(buf, mv, pos + 1)
+        if kind == KIND_CLAYMORE:
+            value, pos = _get_claymore(buf, mv, pos)
+        elif kind == KIND_CLACKER:
+            value = {}
+            _, pos = _get_fields(buf, mv, pos, _CLACKER_FIELDS, value)
+            extras, pos = _get_json(buf, mv, pos)
+            if extras:
+                value.update(extras)
+        elif kind == KIND_CLAYMORES:
+            value = []
+            n = buf[pos]
+            pos += 1
+            for _ in range(n):
+                pos += 1
+                if buf[pos - 1]:
+                    record, pos = _get_claymore(buf, mv, pos)
+                    value.append(record)
+                else:
+                    value.append({})
+        else:
+            value, pos = _get_json(buf, mv, pos, '<I', 4)
+        d[key] = value
+    return d
+
+
+def _load(filename):
+    """ the decoded file, None if it does not decode """
+    try:
+        return decode(_read(filename))
+    except Exception as e:  # a torn or corrupt file trips IndexError, struct errors, bad JSON...
+        print(f'{filename} unreadable')
+        print_exception(e)
+        return None
+
+
+def _read(filename):
+    buf = bytearray(stat(filename)[6])
+    with open(filename, 'rb') as fh:
+        fh.readinto(buf)
+    return buf
+
+
+class BinaryDatabase(Database):
+    """
+    Database stored in the compact binary format
+    filename is the (legacy) JSON name, the data lives next to it as .bin
+    """
+    def __init__(self, filename, *args, write_behind_ms=None):
+        self._legacy = filename
+        super().__init__(_bin_name(filename), *args, write_behind_ms=write_behind_ms)
+
+    def init_from_file(self):
+        if file_exists(self._filename):
+            d = _load(self._filename)
+            if d is not None:
+                if file_exists(self._tmp):
+                    remove(self._tmp)  # interrupted write, the real file is still whole
+                return d
+        if file_exists(self._tmp):
+            # reset between removing the old file and renaming the new one, or the real file is corrupt
+            d = _load(self._tmp)
+            if d is not None:
+                self._commit_tmp()
+                return d
+        if file_exists(self._legacy):
+            try:
+                with open(self._legacy, 'rb') as fh:
+                    d = json.load(fh)
+            except (OSError, ValueError) as e:
+                print_exception(e)
+            else:
+                print(f'Migrating {self._legacy} to {self._filename}')
+                self._atomic_write(encode(d))
+                remove(self._legacy)
+                return d
+        return {}
+
+    def _write(self):
+        self._atomic_write(encode(self))
+
+    def erase(self):
+        super().erase()
+        if file_exists(self._legacy):
+            remove(self._legacy)
@@ -14,34 +14,124 @@ References:
 - https://www.w3.org/Protocols/rfc2616/rfc2616-sec5.html#sec5
 """
 import sys
+import errno
 import socket
+import struct
 import uasyncio as asyncio
+from micropython import const
+from helpers import wait_readable
+
+_HEADER = const(12)  # bytes of DNS header before the question
+_MAX_QUERY = const(512)  # bytes, the most a DNS query over UDP may be
+_MAX_NAME = const(255)  # bytes, the longest name on the wire, length octets and root included
+_TTL = const(60)  # s a client may cache our answer
+_DRAIN = const(8)  # queries answered per wakeup before the rest of the loop gets a turn
+_A = const(1)
+_PTR = const(12)
+_ANY = const(255)
+_IN = const(1)
+_NOERROR = const(0)
+_NXDOMAIN = const(3)
+QTYPES = {1: 'A', 5: 'CNAME', 12: 'PTR', 15: 'MX', 16: 'TXT', 28: 'AAAA', 33: 'SRV', 64: 'SVCB', 65: 'HTTPS', 255: 'ANY'}
+
+
+def question_end(data, length):
+    """
+    offset just past the question (name, qtype, qclass) of the standard
+    query in data[:length], 0 if it is anything else (a name longer than
+    a name may be included); nothing is copied
+    """
+    if length < _HEADER + 5 or data[2] & 0xf8 or data[4] or data[5] != 1:
+        return 0  # a response, not a standard query, or not exactly one question
+    i = _HEADER
+    while i < length:
+        if i - _HEADER >= _MAX_NAME:
+            return 0
+        lon = data[i]
+        if lon == 0:
+            end = i + 5
+            return end if end <= length else 0
+        if lon & 0xc0:
+            return 0  # a pointer has nothing to point back to in a question
+        i += lon + 1
+    return 0
+
+
+def answer_tail(ip, ttl=_TTL):
+    """ what follows the question in every answer: name pointer, A, IN, ttl, ip """
+    return b'\xc0\x0c\x00\x01\x00\x01' + struct.pack('>IH', ttl, 4) + bytes(int(b) for b in ip.split('.'))
+
+
+def soa_tail(ttl=_TTL):
+    """
+    what follows the question in every empty reply: an SOA for the name
+    asked for, its minimum ttl is how long the client remembers the no
+    """
+    return (b'\xc0\x0c\x00\x06\x00\x01' + struct.pack('>IH', ttl, 24) + b'\xc0\x0c\xc0\x0c'
+            + struct.pack('>5I', 1, ttl, ttl, ttl, ttl))
+
+
+def question_type(buf, end):
+    """ (qtype, qclass) of the question ending at end """
+    return buf[end - 4] << 8 | buf[end - 3], buf[end - 2] << 8 | buf[end - 1]
+
+
+def answer_into(buf, end, tail, rcode=None):
+    """
+    turn the query in buf, its question ending at end, into the reply in
+    place and return its length: an A answer with tail from answer_tail(),
+    or with an rcode an authoritative empty NOERROR/NXDOMAIN with tail from
+    soa_tail(), which the client may cache instead of asking again
+    """
+    buf[6] = buf[8] = buf[10] = buf[11] = 0
+    if rcode is None:
+        buf[2] = 0x81  # response, recursion desired
+        buf[3] = 0x80  # recursion available, no error
+        buf[7] = 1  # the answer
+        buf[9] = 0
+    else:
+        buf[2] = 0x85  # authoritative response, recursion desired
+        buf[3] = 0x80 | rcode
+        buf[7] = 0
+        buf[9] = 1  # the SOA
+    n = end + len(tail)
+    buf[end:n] = tail
+    return n
+
+
+def reply_for(qtype, qclass, answer, soa):
+    """ (tail, rcode) for answer_into(): answer (our address) for A, soa and a no for the rest """
+    if qclass not in (_IN, _ANY):
+        return soa, _NXDOMAIN
+    if qtype in (_A, _ANY):
+        return answer, None
+    if qtype == _PTR:
+        return soa, _NXDOMAIN  # no names for addresses
+    return soa, _NOERROR  # the name is there, just no AAAA, HTTPS...
 
 
 class DNSQuery:
+    """ one query as bytes, for code that answers a datagram at a time """
     def __init__(self, data):
         self.data = data
-        domain = []
-        tipo = (data[2] >> 3) & 15  # Opcode bits
-        if tipo == 0:  # Standard query
-            ini = 12
-            lon = data[ini]
-            while lon != 0:
-                domain.append(data[ini + 1:ini + lon + 1].decode('utf-8') + '.')
-                ini += lon + 1
-                lon = data[ini]
-        self.domain = ''.join(domain)
+        self.end = question_end(data, len(data))
+
+    @property
+    def domain(self):
+        """ the name asked for, dotted; decoded only when somebody looks """
+        labels = []
+        i = _HEADER
+        while self.end and self.data[i]:
+            labels.append(self.data[i + 1:i + 1 + self.data[i]].decode('utf-8') + '.')
+            i += self.data[i] + 1
+        return ''.join(labels)
 
     def response(self, ip):
-        if self.domain:
-            packet = [
-                self.data[:2] + b'\x81\x80',
-                self.data[4:6] + self.data[4:6] + b'\x00\x00\x00\x00',  # Questions and Answers Counts
-                self.data[12:],  # Original Domain Name Question
-                b'\xC0\x0C',     # Pointer to domain name
-                b'\x00\x01\x00\x01\x00\x00\x00\x3C\x00\x04',  # Response type, ttl and resource data length -> 4 bytes
-                bytes(map(int, ip.split('.')))]  # 4bytes of IP
-            return b''.join(packet)
+        if self.end:
+            tail, rcode = reply_for(*question_type(self.data, self.end), answer_tail(ip), soa_tail())
+            buf = bytearray(self.end + len(tail))
+            buf[:self.end] = self.data[:self.end]
+            return bytes(buf[:answer_into(buf, self.end, tail, rcode)])
 
 
 class CaptivePortal:
@@ -66,25 +156,66 @@ class CaptivePortal:
         http://{our ip address}/
         """
         self.server_ip = server_ip
+        self.tail = answer_tail(server_ip)  # the same for every answer, made once
+        self.soa = soa_tail()  # the same for every empty reply
+        # each query is answered in place in here, room for the longer of the two tails
+        self.buf = bytearray(_MAX_QUERY + max(len(self.tail), len(self.soa)))
+        self.view = memoryview(self.buf)
+        self.answered = 0
+        self.ignored = 0  # datagrams that were not a standard query
+        self.qtypes = {}  # QTYPES name or 'other' -> queries
+
+    def _reply(self, length):
+        """ the query in self.buf turned into its reply in place: its length, 0 to drop it """
+        buf = self.buf
+        end = question_end(buf, length)
+        if not end:
+            self.ignored += 1
+            return 0
+        qtype, qclass = question_type(buf, end)
+        name = QTYPES.get(qtype, 'other')  # a client may send any of 65536, keep the keys bounded
+        self.qtypes[name] = self.qtypes.get(name, 0) + 1
+        return answer_into(buf, end, *reply_for(qtype, qclass, self.tail, self.soa))
+
+    def _receive(self, udps, recvfrom_into):
+        """ the next queued query into self.buf: (length, addr) """
+        if recvfrom_into:
+            return recvfrom_into(self.buf, _MAX_QUERY)
+        data, addr = udps.recvfrom(_MAX_QUERY)  # MicroPython has no recvfrom_into
+        self.view[:len(data)] = data
+        return len(data), addr
 
     async def run_dns_server(self):
         """ create udp server for dns queries and respond forever """
         udps = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         udps.setblocking(False)
         udps.bind(('0.0.0.0', 53))
+        recvfrom_into = getattr(udps, 'recvfrom_into', None)
 
         while True:
             try:
-                # gc.collect()
-                yield asyncio.core._io_queue.queue_read(udps)
-                data, addr = udps.recvfrom(4096)
-                dns = DNSQuery(data)
-                udps.sendto(dns.response(self.server_ip), addr)
+                await wait_readable(udps)
+                # a dozen phones joining at once queue up queries, answer what is there
+                for _ in range(_DRAIN):
+                    try:
+                        length, addr = self._receive(udps, recvfrom_into)
+                    except OSError as e:
+                        if e.errno == errno.EAGAIN:
+                            break  # drained
+                        raise
+                    n = self._reply(length)
+                    if n:
+                        udps.sendto(self.view[:n], addr)
+                        self.answered += 1
 
             except Exception as e:
                 sys.print_exception(e)
                 await asyncio.sleep_ms(3000)
 
+    def stats(self):
+        return {
+            'dns_answered': self.answered, 'dns_ignored': self.ignored, 'dns_qtypes': dict(self.qtypes)}
+
     async def add_server(self, loop=None):
         """
         Adds this server to the asyncio loop specified or the default event loop
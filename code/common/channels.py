@@ -0,0 +1,167 @@
+"""
+Access point channel selection
+Intended for Raspberry Pi Pico W
+
+Only channels 1, 6 and 11 do not overlap, so the clacker's AP goes on
+whichever of them the neighbours crowd least. A survey folds several scans
+together: every BSSID counts once, at its mean RSSI and weighted by the
+share of the scans that heard it, so one lucky or unlucky scan does not
+decide. An AP on channel c weighs on candidate channel k by
+
+    overlap(|c - k|) * heard * (AP_COST + 10 ** ((RSSI - RSSI_REF) / 10))
+
+AP_COST is the beacons and contention of one more network however faint,
+the power term makes a neighbour 10 dB louder count ten times as much.
+
+choose_channel() keeps its decision in the db with a count of the boots
+that used it, so the next boots go straight to that channel without
+scanning, and every CHANNEL_BOOTS-th surveys again. Boots, not time: the
+Pico W's RTC starts over at every power on, with nothing to set it from.
+
+ChannelWatch is the optional runtime check. Moving the AP would drop every
+claymore for a rejoin, so it only reports when another channel looks worth
+the move.
+"""
+from micropython import const
+from sys import print_exception
+from time import sleep_ms
+import uasyncio as asyncio
+from wifi_scan import scanner
+
+CHANNELS = (1, 6, 11)  # the non-overlapping 2.4 GHz channels
+_OVERLAP = (1.0, 0.77, 0.55, 0.32, 0.09)  # share of a 22 MHz channel 0..4 channels (5 MHz each) away
+AP_COST = 0.5  # weight of an AP heard at all
+RSSI_REF = const(-70)  # dBm of an AP whose signal weighs 1
+SURVEY_SCANS = const(3)  # scans a survey folds together
+SURVEY_GAP = const(200)  # ms between the scans of a survey
+CHANNEL_BOOTS = const(20)  # boots a channel decision in the db is good for
+WATCH_INTERVAL = const(600000)  # ms between ChannelWatch looks
+WATCH_SCANS = const(6)  # scans ChannelWatch keeps in its rolling survey
+WATCH_MIN_GAIN = const(2000)  # us of claymore RTT a move must be expected to save
+
+
+class ChannelSurvey:
+    def __init__(self):
+        self.heard = {}  # bssid -> [channel, sum of RSSI, times heard]
+        self.scans = 0
+
+    def hear(self, bssid, channel, rssi):
+        seen = self.heard.get(bssid)
+        if seen is None:
+            self.heard[bssid] = [channel, rssi, 1]
+        else:
+            seen[0] = channel
+            seen[1] += rssi
+            seen[2] += 1
+
+    def add(self, raw_aps):
+        """ fold in one WLAN.scan() result """
+        for _ssid, bssid, channel, rssi, _security, _hidden in raw_aps:
+            self.hear(bssid, channel, rssi)
+        self.scans += 1
+
+    def scores(self, channels=CHANNELS):
+        """ channel -> interference, lower is better """
+        scores = {k: 0.0 for k in channels}
+        scans = max(1, self.scans)
+        for channel, total, times in self.heard.values():
+            weight = min(1, times / scans) * (AP_COST + 10 ** ((total / times - RSSI_REF) / 10))
+            for k in channels:
+                away = abs(channel - k)
+                if away < len(_OVERLAP):
+                    scores[k] += _OVERLAP[away] * weight
+        return scores
+
+    def best(self, channels=CHANNELS):
+        """ the least crowded channel, the first of a tie """
+        scores = self.scores(channels)
+        return min(channels, key=lambda k: scores[k])
+
+
+def survey_channels(scans=SURVEY_SCANS, gap_ms=SURVEY_GAP):
+    """ blocks: scans WLAN scans gap_ms apart, folded into one ChannelSurvey """
+    survey = ChannelSurvey()
+    for i in range(scans):
+        if i:
+            sleep_ms(gap_ms)
+        survey.add(scanner.scan())
+    return survey
+
+
+def choose_channel(store, boots=CHANNEL_BOOTS, scans=SURVEY_SCANS):
+    """
+    the AP channel remembered in store (a db section) for fewer than boots
+    boots, counting this one, otherwise a survey's best, remembered in
+    store['ap_channel'] (flushing the db is up to the caller)
+    """
+    cached = store.get('ap_channel')
+    if cached and cached.get('boots', boots) < boots:
+        cached['boots'] += 1
+        print(f"AP channel {cached['channel']}, boot {cached['boots']} of {boots} on it")
+        return cached['channel']
+    survey = survey_channels(scans)
+    scores = survey.scores()
+    channel = survey.best()
+    store['ap_channel'] = {'channel': channel, 'boots': 1, 'scores': [round(scores[k], 2) for k in CHANNELS]}
+    print(f'AP channel {channel} of {scores} from {survey.scans} scans, {len(survey.heard)} APs')
+    return channel
+
+
+class ChannelWatch:
+    """
+    optional runtime check of the AP's channel: every interval_ms, once
+    the radio is idle, one scan joins a rolling survey of the last
+    WATCH_SCANS and the claymores' RTTs are sampled. The lowest median RTT
+    seen is the link's floor, what is above it is put down to contention,
+    which another channel would scale by the ratio of the two scores.
+    When that would save WATCH_MIN_GAIN or more, it says so.
+    """
+    def __init__(self, channel, rtts, interval_ms=WATCH_INTERVAL):
+        self.channel = channel
+        self.rtts = rtts  # callable -> the claymores' recent RTTs in us
+        self.interval_ms = interval_ms
+        self.recent = []  # the last WATCH_SCANS WLAN.scan() results
+        self.floor_us = None
+        self.rtt_us = None
+        self.best = channel
+        self.gain_us = 0
+        self.advised = 0  # looks that found a better channel
+
+    def look(self, raw_aps, rtts):
+        """ fold in one scan and the RTTs; the channel worth moving to, or None """
+        self.recent.append(raw_aps)
+        del self.recent[:-WATCH_SCANS]
+        survey = ChannelSurvey()
+        for scan in self.recent:
+            survey.add(scan)
+        scores = survey.scores()
+        self.best = survey.best()
+        self.gain_us = 0
+        if rtts:
+            rtts = sorted(rtts)
+            self.rtt_us = rtts[len(rtts) // 2]
+            self.floor_us = self.rtt_us if self.floor_us is None else min(self.floor_us, self.rtt_us)
+            if self.best != self.channel and scores[self.channel] > 0:
+                expected = self.floor_us + (self.rtt_us - self.floor_us) * scores[self.best] / scores[self.channel]
+                self.gain_us = int(self.rtt_us - expected)
+        if self.gain_us < WATCH_MIN_GAIN:
+            return None
+        self.advised += 1
+        print(f'Channel {self.best} would cut claymore RTT by ~{self.gain_us // 1000} ms '
+              f'(now {self.rtt_us // 1000} ms on {self.channel}, interference {scores})')
+        return self.best
+
+    async def run(self):
+        while True:
+            await asyncio.sleep_ms(self.interval_ms)
+            while not scanner.idle():
+                await asyncio.sleep_ms(self.interval_ms // 100)
+            try:
+                self.look(scanner.scan(), self.rtts())
+            except OSError as e:
+                print_exception(e)
+
+    def stats(self):
+        return {
+            'ap_channel': self.channel, 'ap_channel_best': self.best, 'ap_channel_rtt_us': self.rtt_us,
+            'ap_channel_gain_us': self.gain_us, 'ap_channel_advised': self.advised}
@@ -0,0 +1,564 @@
+"""
+Clacker <-> claymore UDP fire protocol
+Intended for Raspberry Pi Pico W
+
+One FIRE datagram per volley is broadcast on the clacker's AP subnet, so
+every armed claymore sees it at (nearly) the same moment instead of each
+waiting on its own TCP connect + HTTP parse of POST /clack.
+
+FIRE   clacker -> subnet broadcast
+       epoch, seq, slot bitmap, team, actuate-at (clacker ticks_us),
+       trace ID (see trace.py, 0 == untraced)
+ACK    claymore -> clacker (unicast)
+       epoch, seq, slot, SCHEDULED/FIRED/DUPLICATE, microseconds from
+       datagram received to servo set, microseconds the servo was set
+       after actuate-at
+STATE  claymore -> clacker (unicast, STATE_PORT)
+       slot, change counter, door, trigger, armed LED, clock sync rtt
+       pushed the moment any of them changes, and re-sent as a heartbeat
+SYNC   claymore -> clacker (STATE_PORT) and back
+       NTP style: the claymore's send time, the clacker's receive and
+       reply times. Sent as a short burst after every ping; the sample
+       with the smallest round trip gives the claymore its offset to the
+       clacker's ticks_us.
+
+Synchronized fire: the clacker sets actuate-at a little ahead (lead_ms)
+of now. A claymore with a fresh clock offset converts it to its own
+ticks_us, acknowledges SCHEDULED at once, sleeps, spins the last few ms
+and sets the servo, then acknowledges FIRED with how late it was. A
+claymore without a fresh offset fires on receipt. The clacker reports the
+spread of the FIRED lateness across a volley as its skew, printed as soon
+as the last scheduled slot of the volley has reported FIRED.
+
+(epoch, seq) is the idempotency token of a volley. The clacker re-broadcasts
+the same token to the slots that have not acknowledged yet on a short
+schedule (30/60/120 ms) until a deadline, instead of waiting seconds for a
+TCP timeout. A claymore fires once per token, ever, and acknowledges every
+repeat of it as DUPLICATE. HTTP POST /clack carries the same token as
+{"token": "<epoch>-<seq>"}, so a fallback never double fires.
+
+Replay guard (no HMAC): the clacker's epoch is its previous boot's plus
+one (next_epoch() keeps it in the db; random only on a fresh db), so a
+new session never reuses an epoch a claymore has retired, and seq
+increments per volley. A claymore only acts on datagrams from its
+registered clacker IP, for its team, with its slot bit set, with a seq no
+older than the last one it saw for that epoch, and not from one of the last
+few epochs it has seen the clacker leave behind. What it cannot catch: a
+datagram from an older session than those, or any session at all once the
+claymore itself has rebooted and forgotten them, fires when replayed.
+"""
+import socket
+import struct
+from random import getrandbits
+from sys import print_exception
+from time import ticks_us, ticks_ms, ticks_diff, ticks_add
+import uasyncio as asyncio
+from micropython import const
+from helpers import wait_readable, broadcast_address, SERVER_SUBNET
+
+CLACK_PORT = const(5005)
+STATE_PORT = const(5006)
+_MAGIC = b'FC'
+_VERSION = const(4)
+_MAX_DATAGRAM = const(64)
+_SO_BROADCAST = const(0x20)
+
+_RETRY_SCHEDULE = (30, 60, 120)  # ms between re-broadcasts of an unacknowledged FIRE
+_DEADLINE = const(400)  # ms, give up on UDP for a volley after this
+_RETIRED = const(4)  # epochs of earlier clacker sessions remembered, to refuse their replays
+_STALE = const(20000)  # ms, pushed state older than this is not trusted
+_SYNC_SAMPLES = const(4)  # SYNC datagrams per round, the fastest round trip wins
+_SYNC_GAP = const(10)  # ms between them
+_SYNC_FRESH = const(60000)  # ms, older clock offsets are not used to schedule a fire
+_MAX_LEAD = const(2000)  # ms, actuate-at further ahead than this is treated as bogus
+_SPIN = const(3)  # ms before actuate-at to stop sleeping and spin on ticks_us
+_NOW = const(0xffffffff)  # actuate-at: fire on receipt (ticks_us never gets this big)
+_NO_TARGET = const(0x7fffffff)  # lateness: fired on receipt, nothing to be late for
+_REPORT_WINDOW = const(16)  # volleys back a FIRED report is still accepted for (sequences overlap them)
+
+FIRE = const(1)
+ACK = const(2)
+STATE = const(3)
+SYNC = const(4)
+SYNC_REPLY = const(5)
+
+FIRED = const(1)
+DUPLICATE = const(2)
+SCHEDULED = const(3)
+
+# magic, version, kind, epoch, seq, slot bitmap, team, actuate-at, trace ID
+_FIRE_FMT = '<2sBBHII8sIH'
+# magic, version, kind, epoch, seq, slot, status, datagram received -> servo set (us), servo set - actuate-at (us)
+_ACK_FMT = '<2sBBHIBBIi'
+# magic, version, kind, slot, change counter, door, trigger, armed LED state, clock sync rtt (us)
+_STATE_FMT = '<2sBBBH8s8s16sI'
+# magic, version, kind, claymore send time
+_SYNC_FMT = '<2sBBI'
+# magic, version, kind, claymore send time, clacker receive time, clacker reply time
+_SYNC_REPLY_FMT = '<2sBBIII'
+_HEADER_FMT = '<2sBB'
+
+
+def slot_bitmap(slots):
+    bitmap = 0
+    for slot in slots:
+        bitmap |= 1 << slot
+    return bitmap
+
+
+def _us(value, none='?'):
+    return none if value is None else f'{value}us'
+
+
+def next_epoch(store):
+    """ the epoch after the one remembered in store (a db section), remembered in its place """
+    epoch = (store['clack_epoch'] + 1) & 0xffff if 'clack_epoch' in store else getrandbits(16)
+    store['clack_epoch'] = epoch
+    return epoch
+
+
+def make_token(epoch, seq):
+    return f'{epoch}-{seq}'
+
+
+def parse_token(token):
+    """ '<epoch>-<seq>' -> (epoch, seq) """
+    epoch, seq = token.split('-')
+    return int(epoch), int(seq)
+
+
+def _kind(data):
+    """ return the packet kind, or None if it isn't one of ours """
+    if len(data) < 4:
+        return None
+    magic, version, kind = struct.unpack_from(_HEADER_FMT, data)
+    if magic != _MAGIC or version != _VERSION:
+        return None
+    return kind
+
+
+def _text(field):
+    return field.rstrip(b'\x00').decode()
+
+
+def _udp_socket(port=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    if port is not None:
+        sock.bind(('0.0.0.0', port))
+    return sock
+
+
+class ClackSender:
+    """ clacker side: broadcast FIRE, re-broadcast until every slot acknowledges """
+
+    def __init__(self, ip, team, subnet=SERVER_SUBNET, port=CLACK_PORT, epoch=None):
+        self.team = team
+        self.port = port
+        self.broadcast = broadcast_address(ip, subnet)
+        self.epoch = getrandbits(16) if epoch is None else epoch  # next_epoch() across boots
+        self.seq = 0
+        self.retransmits = 0
+        self.reports = {}  # slot -> {'seq', 'ip', 'rtt_us', 'fire_us', 'latency_us', 'late_us'}
+        self.on_report = None  # on_report(slot, report) for every FIRED report
+        self.trace = None  # TraceLog for request_sent/ack_<slot> stamps
+        self._sent_at = 0  # ticks_us of the first datagram of the volley in flight
+        self._at = _NOW  # actuate-at of the volley in flight
+        self._trace = 0  # trace ID of the volley in flight
+        self._pending = 0  # slot bitmap still waiting for an ACK
+        self._acked = {}  # slot -> ACK status for the volley in flight
+        self._skewed = 0  # seq whose skew was printed
+        self._ack = asyncio.Event()
+        self.sock = _udp_socket()
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_BROADCAST', _SO_BROADCAST), 1)
+        except OSError as e:
+            print_exception(e)
+
+    def token(self):
+        """ idempotency token of the current volley """
+        return make_token(self.epoch, self.seq)
+
+    def in_flight(self):
+        """ True while a volley is still waiting for ACKs """
+        return self._pending != 0
+
+    def _send(self, slots):
+        packet = struct.pack(
+            _FIRE_FMT, _MAGIC, _VERSION, FIRE, self.epoch, self.seq, slots, self.team.encode(), self._at,
+            self._trace)
+        self.sock.sendto(packet, (self.broadcast, self.port))
+
+    async def fire(self, slots, schedule=_RETRY_SCHEDULE, deadline_ms=_DEADLINE, lead_ms=0, at_us=None, trace=0):
+        """
+        Broadcast one FIRE for the slot bitmap and re-broadcast it to the
+        slots that have not acknowledged on schedule, until deadline_ms.
+        With lead_ms every synced claymore actuates lead_ms from now
+        instead of on receipt, with at_us at that ticks_us. trace rides
+        along to the claymores and stamps request_sent and ack_<slot>.
+        Returns {slot: SCHEDULED/FIRED/DUPLICATE} for every slot that acknowledged.
+        """
+        self.seq += 1
+        self._pending = slots
+        self._acked = {}
+        self._ack.clear()
+        start = ticks_ms()
+        self._sent_at = ticks_us()
+        if at_us is None:
+            at_us = ticks_add(self._sent_at, lead_ms * 1000) if lead_ms else _NOW
+        self._at = at_us
+        self._trace = trace
+        self._send(slots)
+        if self.trace:
+            self.trace.stamp(trace, 'request_sent', self._sent_at)
+        retry = 0
+        while self._pending:
+            elapsed = ticks_diff(ticks_ms(), start)
+            if elapsed >= deadline_ms:
+                break
+            wait_ms = deadline_ms - elapsed
+            if retry < len(schedule):
+                wait_ms = min(wait_ms, schedule[retry])
+            try:
+                await asyncio.wait_for_ms(self._ack.wait(), wait_ms)
+                self._ack.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+            if retry < len(schedule) and self._pending:
+                retry += 1
+                self.retransmits += 1
+                self._send(self._pending)
+        self._pending = 0
+        self._report_skew()
+        return self._acked
+
+    def _report_skew(self):
+        # once per volley, when every acknowledged slot has fired
+        if self._pending or self._skewed == self.seq or SCHEDULED in self._acked.values():
+            return
+        skew = self.skew()
+        if skew is not None:
+            self._skewed = self.seq
+            print(f'FIRE {self.token()} skew {skew}us')
+
+    def skew(self):
+        """ spread (us) of actuation times across the last volley, None until two synced slots fired """
+        late = [r['late_us'] for r in self.reports.values() if r['seq'] == self.seq and r['late_us'] is not None]
+        if len(late) < 2:
+            return None
+        return max(late) - min(late)
+
+    def stats(self):
+        return {
+            'epoch': self.epoch, 'seq': self.seq, 'retransmits': self.retransmits,
+            'skew_us': self.skew(), 'reports': self.reports}
+
+    async def run(self):
+        """ receive ACKs forever """
+        while True:
+            try:
+                await wait_readable(self.sock)
+                data, addr = self.sock.recvfrom(_MAX_DATAGRAM)
+                now = ticks_us()
+                if _kind(data) != ACK:
+                    continue
+                _, _, _, epoch, seq, slot, status, fire_us, late_us = struct.unpack_from(_ACK_FMT, data)
+                if epoch != self.epoch or not 0 <= self.seq - seq < _REPORT_WINDOW:
+                    continue  # ACK for a volley long gone
+                if seq != self.seq and status != FIRED:
+                    continue  # late ACK for an earlier volley
+                if seq == self.seq and (self._pending >> slot) & 1:
+                    self._pending &= ~(1 << slot)
+                    self._acked[slot] = status
+                    self._ack.set()
+                    if self.trace:
+                        self.trace.stamp(self._trace, f'ack_{slot}', now)
+                elif seq == self.seq and status == FIRED and self.trace:
+                    self.trace.stamp(self._trace, f'fired_ack_{slot}', now)  # after SCHEDULED
+                if status == FIRED:
+                    # a scheduled claymore sends FIRED after SCHEDULED, once the servo is set
+                    rtt_us = latency_us = None
+                    if seq == self.seq:
+                        self._acked[slot] = FIRED
+                        rtt_us = ticks_diff(now, self._sent_at)
+                        # one-way estimate: half the network round trip plus the claymore's own rx->servo time
+                        latency_us = (rtt_us - fire_us) // 2 + fire_us
+                    late_us = None if late_us == _NO_TARGET else late_us
+                    report = self.reports[slot] = {
+                        'seq': seq, 'ip': addr[0], 'rtt_us': rtt_us,
+                        'fire_us': fire_us, 'latency_us': latency_us, 'late_us': late_us}
+                    if self.on_report:
+                        self.on_report(slot, report)
+                    print(f'ACK slot {slot} seq {seq}: dispatch->actuation ~{_us(latency_us)} '
+                          f'(rtt {_us(rtt_us)}, late {_us(late_us, "on receipt")})')
+                    if seq == self.seq:
+                        self._report_skew()
+            except Exception as e:
+                print_exception(e)
+                await asyncio.sleep_ms(100)
+
+
+class ClackListener:
+    """ claymore side: act on FIRE datagrams addressed to our slot """
+
+    def __init__(self, on_fire, port=CLACK_PORT):
+        self.on_fire = on_fire  # on_fire(at_us=None), must actuate synchronously, at ticks_us at_us if given
+        # and may return the ticks_us the servo was set
+        self.trace = None  # TraceLog for received/servo_set/ack_sent stamps
+        self.port = port
+        self.clacker_ip = None  # only accept datagrams from this address
+        self.team = None
+        self.slot = None  # our registered id on the clacker
+        self.sock = None
+        self._epoch = None
+        self._seq = 0
+        self._retired = []  # earlier epochs, oldest first
+        self._token = None  # last token we fired for
+        self._scheduled = None  # token waiting for its actuate-at
+        self.fired = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.last_fire_us = None
+        self.last_late_us = None
+        # clock sync: clacker ticks_us == ticks_add(our ticks_us, offset_us)
+        self.offset_us = None
+        self.sync_rtt_us = None
+        self.synced_at = 0  # ticks_ms
+        self._round = None  # [offset, rtt] of the best sample of the round in progress
+
+    def stats(self):
+        return {
+            'udp_fired': self.fired, 'udp_duplicates': self.duplicates,
+            'udp_rejected': self.rejected, 'udp_last_fire_us': self.last_fire_us,
+            'udp_last_late_us': self.last_late_us, 'sync_offset_us': self.offset_us,
+            'sync_rtt_us': self.sync_rtt_us, 'synced': self.synced()}
+
+    def synced(self):
+        return self.offset_us is not None and ticks_diff(ticks_ms(), self.synced_at) < _SYNC_FRESH
+
+    def _is_duplicate(self, token):
+        if token is None:
+            return False
+        return token == self._scheduled or token == self._token
+
+    def _stamp(self, trace, stage, us=None):
+        if self.trace:
+            self.trace.stamp(trace, stage, us)
+
+    def _fire(self, token, at_us=None, trace=0):
+        """ actuate, return the ticks_us the servo was set """
+        servo_us = self.on_fire(at_us)
+        if not isinstance(servo_us, int):
+            servo_us = ticks_us()
+        self._stamp(trace, 'servo_set', servo_us)
+        self._token = token
+        self.fired += 1
+        return servo_us
+
+    def actuate(self, token=None, trace=0):
+        """
+        Fire once per token. Returns FIRED, or DUPLICATE if token has
+        already fired or is scheduled to. No token (web page, old
+        clacker) always fires.
+        """
+        if self._is_duplicate(token):
+            self.duplicates += 1
+            return DUPLICATE
+        self._fire(token, trace=trace)
+        return FIRED
+
+    def _accept(self, addr, epoch, seq, slots, team):
+        if self.slot is None or addr[0] != self.clacker_ip:
+            return False
+        if not (slots >> self.slot) & 1:
+            return False
+        if _text(team) != self.team:
+            return False
+        if epoch != self._epoch:
+            if epoch in self._retired:
+                return False  # a session the clacker has left behind: replayed
+            if self._epoch is not None:
+                self._retired.append(self._epoch)
+                del self._retired[:-_RETIRED]
+        elif seq < self._seq:
+            return False  # replayed
+        # seq == self._seq gets through to be acknowledged DUPLICATE, never to fire again
+        self._epoch = epoch
+        self._seq = seq
+        return True
+
+    def _local_target(self, at_us):
+        """ our ticks_us for the clacker's actuate-at, or None to fire on receipt """
+        if at_us == _NOW or not self.synced():
+            return None
+        target = ticks_add(at_us, -self.offset_us)
+        if not 0 < ticks_diff(target, ticks_us()) < _MAX_LEAD * 1000:
+            return None  # already passed, or too far off to be believed
+        return target
+
+    def _ack(self, addr, epoch, seq, status, fire_us=0, late_us=_NO_TARGET):
+        self.sock.sendto(struct.pack(
+            _ACK_FMT, _MAGIC, _VERSION, ACK, epoch, seq, self.slot, status, fire_us, late_us), addr)
+
+    async def _fire_at(self, addr, token, target, rx, trace):
+        epoch, seq = token
+        wait_ms = ticks_diff(target, ticks_us()) // 1000 - _SPIN
+        if wait_ms > 0:
+            await asyncio.sleep_ms(wait_ms)
+        if self._scheduled == token:
+            self._scheduled = None
+        done = self._fire(token, target, trace)  # on_fire spins out the last few ms
+        self.last_fire_us = ticks_diff(done, rx)
+        self.last_late_us = ticks_diff(done, target)
+        self._ack(addr, epoch, seq, FIRED, self.last_fire_us, self.last_late_us)
+        self._stamp(trace, 'ack_sent')
+        print(f'UDP FIRE seq {seq}: FIRED at target +{self.last_late_us}us')
+
+    def _on_fire_datagram(self, data, addr, rx):
+        _, _, _, epoch, seq, slots, team, at_us, trace = struct.unpack_from(_FIRE_FMT, data)
+        if not self._accept(addr, epoch, seq, slots, team):
+            self.rejected += 1
+            return
+        token = (epoch, seq)
+        if token == self._scheduled:
+            self._ack(addr, epoch, seq, SCHEDULED)  # our first ACK was lost
+            return
+        target = self._local_target(at_us)
+        if target is not None and not self._is_duplicate(token):
+            self._stamp(trace, 'received', rx)
+            self._scheduled = token
+            self._ack(addr, epoch, seq, SCHEDULED)
+            self._stamp(trace, 'scheduled')
+            asyncio.create_task(self._fire_at(addr, token, target, rx, trace))
+            return
+        if not self._is_duplicate(token):
+            self._stamp(trace, 'received', rx)  # retransmits of a fired token are not stamped again
+        status = self.actuate(token, trace)
+        fire_us = ticks_diff(ticks_us(), rx)
+        if status == FIRED:
+            self.last_fire_us = fire_us
+        self._ack(addr, epoch, seq, status, fire_us)
+        if status == FIRED:
+            self._stamp(trace, 'ack_sent')
+        print(f'UDP FIRE seq {seq}: {"FIRED" if status == FIRED else "DUPLICATE"} rx->servo {fire_us}us')
+
+    def _on_sync_reply(self, data, rx):
+        if self._round is None:
+            return  # straggler from a finished round
+        _, _, _, t0, t1, t2 = struct.unpack_from(_SYNC_REPLY_FMT, data)
+        rtt = ticks_diff(rx, t0) - ticks_diff(t2, t1)
+        if rtt < 0:
+            return
+        # the two one-way differences straddle the true offset by the path delay
+        there = ticks_diff(t1, t0)
+        back = ticks_diff(t2, rx)
+        offset = ticks_diff(there + ticks_diff(back, there) // 2, 0)
+        if self._round[1] is None or rtt < self._round[1]:
+            self._round[0], self._round[1] = offset, rtt
+
+    async def sync(self, samples=_SYNC_SAMPLES, gap_ms=_SYNC_GAP):
+        """ one burst of SYNC to the clacker, keep the offset of the fastest round trip """
+        if self.sock is None or self.clacker_ip is None:
+            return
+        self._round = [None, None]
+        try:
+            for _ in range(samples):
+                self.sock.sendto(
+                    struct.pack(_SYNC_FMT, _MAGIC, _VERSION, SYNC, ticks_us()), (self.clacker_ip, STATE_PORT))
+                await asyncio.sleep_ms(gap_ms)
+        except OSError as e:
+            print_exception(e)
+        offset, rtt = self._round
+        self._round = None
+        if rtt is not None:
+            self.offset_us, self.sync_rtt_us = offset, rtt
+            self.synced_at = ticks_ms()
+
+    async def run(self):
+        self.sock = _udp_socket(self.port)
+        while True:
+            try:
+                await wait_readable(self.sock)
+                data, addr = self.sock.recvfrom(_MAX_DATAGRAM)
+                rx = ticks_us()
+                kind = _kind(data)
+                if kind == FIRE:
+                    self._on_fire_datagram(data, addr, rx)
+                elif kind == SYNC_REPLY and addr[0] == self.clacker_ip:
+                    self._on_sync_reply(data, rx)
+            except Exception as e:
+                print_exception(e)
+                await asyncio.sleep_ms(100)
+
+
+class StatePusher:
+    """ claymore side: push door/trigger/armed changes to the clacker """
+
+    def __init__(self, port=STATE_PORT):
+        self.port = port
+        self.version = 0
+        self.pushes = 0
+        self.sock = _udp_socket()
+
+    def push(self, clacker_ip, slot, door, trigger, armed, sync_rtt_us=None):
+        self.version = (self.version + 1) & 0xffff
+        self.sock.sendto(struct.pack(
+            _STATE_FMT, _MAGIC, _VERSION, STATE, slot, self.version,
+            door.encode()[:8], trigger.encode()[:8], armed.encode()[:16],
+            _NOW if sync_rtt_us is None else sync_rtt_us), (clacker_ip, self.port))
+        self.pushes += 1
+
+
+class StateTable:
+    """ clacker side: live per-slot state, kept fresh by STATE pushes, and the SYNC time server """
+
+    def __init__(self, port=STATE_PORT, stale_ms=_STALE):
+        self.port = port
+        self.stale_ms = stale_ms
+        self.slots = {}  # slot -> {'door', 'trigger', 'armed', 'sync_rtt_us', 'ip', 'version', 'seen'}
+        self.syncs = 0
+        self.pushes = 0  # STATE datagrams received
+        self.verify = None  # verify(slot, ip) -> True if ip is registered in slot
+
+    def get(self, slot):
+        """ latest pushed state of slot, or None if we have nothing recent """
+        state = self.slots.get(slot)
+        if state and ticks_diff(ticks_ms(), state['seen']) < self.stale_ms:
+            return state
+        return None
+
+    def forget(self, slot):
+        self.slots.pop(slot, None)
+
+    async def run(self):
+        sock = _udp_socket(self.port)
+        while True:
+            try:
+                await wait_readable(sock)
+                data, addr = sock.recvfrom(_MAX_DATAGRAM)
+                rx = ticks_us()
+                kind = _kind(data)
+                if kind == SYNC:
+                    # answer straight away, the reply time is part of the sample
+                    t0 = struct.unpack_from(_SYNC_FMT, data)[3]
+                    sock.sendto(struct.pack(
+                        _SYNC_REPLY_FMT, _MAGIC, _VERSION, SYNC_REPLY, t0, rx, ticks_us()), addr)
+                    self.syncs += 1
+                    continue
+                if kind != STATE:
+                    continue
+                self.pushes += 1
+                _, _, _, slot, version, door, trigger, armed, sync_rtt_us = struct.unpack_from(_STATE_FMT, data)
+                if self.verify and not self.verify(slot, addr[0]):
+                    continue
+                old = self.slots.get(slot)
+                if old and 0 < ((old['version'] - version) & 0xffff) < 16:
+                    continue  # reordered, we already have something newer
+                self.slots[slot] = {
+                    'door': _text(door), 'trigger': _text(trigger), 'armed': _text(armed),
+                    'sync_rtt_us': None if sync_rtt_us == _NOW else sync_rtt_us,
+                    'ip': addr[0], 'version': version, 'seen': ticks_ms()}
+            except Exception as e:
+                print_exception(e)
+                await asyncio.sleep_ms(100)
@@ -1,11 +1,15 @@
 from sys import print_exception, exit
-from os import stat
+from os import stat, remove, rename
 #from micropython import mem_info
-from gc import enable, collect
+from gc import enable
 import network
 from ubinascii import hexlify
 import json
-from time import sleep
+from random import getrandbits
+from time import sleep, ticks_ms, ticks_diff
+import uasyncio as asyncio
+from wifi_scan import scanner
+from channels import ChannelSurvey, survey_channels
 wlan = 'wlan{}'
 SERVER_SSID = 'PicoW'  # max 32 characters
 SERVER_SUBNET = '255.255.255.0'
@@ -41,6 +45,47 @@ def file_exists(filename):
     return False
     
 
+class _Readable:
+    """ awaitable that parks the current task until sock has data to read """
+    def __init__(self, sock):
+        self.sock = sock
+
+    def __iter__(self):
+        yield asyncio.core._io_queue.queue_read(self.sock)
+
+    __await__ = __iter__
+
+
+def wait_readable(sock):
+    return _Readable(sock)
+
+
+async def run_bounded(jobs, limit):
+    """
+    await every coroutine in jobs with at most limit running at once
+    returns their results in order, an exception is returned in place of its result
+    """
+    results = [None] * len(jobs)
+    pending = list(range(len(jobs) - 1, -1, -1))
+
+    async def worker():
+        while pending:
+            i = pending.pop()
+            try:
+                results[i] = await jobs[i]
+            except Exception as e:
+                results[i] = e
+
+    await asyncio.gather(*[worker() for _ in range(min(limit, len(jobs)))])
+    return results
+
+
+def broadcast_address(ip, subnet=SERVER_SUBNET):
+    ip = [int(octet) for octet in ip.split('.')]
+    mask = [int(octet) for octet in subnet.split('.')]
+    return '.'.join(str(i | (~m & 0xff)) for i, m in zip(ip, mask))
+
+
 class PropertiesFromFiles:
 
     def __init__(self, folder):
@@ -54,20 +99,104 @@ class PropertiesFromFiles:
 
 
 class Database(dict):
-    def __init__(self, filename, *args):
-        self.__filename = filename
+    """
+    dict persisted as JSON in filename
+
+    flush() writes immediately, or with write_behind_ms set, marks the db
+    dirty and writes once write_behind_ms after the first change, so a burst
+    of updates costs a single flash write. sync() always writes now. Writes go to filename.tmp which is then renamed over
+    filename, so a reset mid-write leaves the previous copy intact.
+    """
+    def __init__(self, filename, *args, write_behind_ms=None):
+        self._filename = filename
+        self._tmp = filename + '.tmp'
+        self.write_behind_ms = write_behind_ms
+        self._dirty = False
+        self.__pending = None  # write-behind task
+        self.flush_requests = 0
+        self.flush_count = 0
+        self.flush_ms_last = 0
+        self.flush_ms_max = 0
+        self.flush_ms_total = 0
         d = self.init_from_file()
         super().__init__(list(args) + list(d.items()))
 
     def init_from_file(self):
-        if file_exists(self.__filename):
-            with open(self.__filename, 'rb') as fh:
+        if file_exists(self._filename):
+            if file_exists(self._tmp):
+                remove(self._tmp)  # interrupted write, the real file is still whole
+            with open(self._filename, 'rb') as fh:
                 return json.load(fh)
+        if file_exists(self._tmp):
+            # reset between removing the old file and renaming the new one
+            try:
+                with open(self._tmp, 'rb') as fh:
+                    d = json.load(fh)
+                rename(self._tmp, self._filename)
+                return d
+            except (OSError, ValueError) as e:
+                print_exception(e)
         return {}
 
     def flush(self):
-        with open(self.__filename, 'wb') as fh:
-            fh.write(json.dumps(self))
+        self._dirty = True
+        self.flush_requests += 1
+        if not self.write_behind_ms:
+            self.sync()
+        elif self.__pending is None:
+            self.__pending = asyncio.create_task(self.__write_behind())
+
+    async def __write_behind(self):
+        try:
+            await asyncio.sleep_ms(self.write_behind_ms)
+            if self._dirty:
+                self.sync()
+        finally:
+            self.__pending = None
+
+    def sync(self):
+        """ write to flash now """
+        start = ticks_ms()
+        self._write()
+        self._dirty = False
+        elapsed = ticks_diff(ticks_ms(), start)
+        self.flush_count += 1
+        self.flush_ms_last = elapsed
+        self.flush_ms_total += elapsed
+        self.flush_ms_max = max(self.flush_ms_max, elapsed)
+
+    def _write(self):
+        self._atomic_write(json.dumps(self))
+
+    def _atomic_write(self, data):
+        self._write_tmp(data)
+        self._commit_tmp()
+
+    def _write_tmp(self, data):
+        with open(self._tmp, 'wb' if isinstance(data, (bytes, bytearray)) else 'w') as fh:
+            fh.write(data)
+
+    def _commit_tmp(self):
+        """ rename the whole filename.tmp over filename """
+        try:
+            rename(self._tmp, self._filename)
+        except OSError:
+            # filesystems that will not rename over an existing file
+            remove(self._filename)
+            rename(self._tmp, self._filename)
+
+    def erase(self):
+        """ delete the persisted copy, the in-memory dict is untouched """
+        self._dirty = False
+        for filename in (self._filename, self._tmp):
+            if file_exists(filename):
+                remove(filename)
+
+    def stats(self):
+        return {
+            'flush_requests': self.flush_requests, 'flush_count': self.flush_count,
+            'flush_ms_last': self.flush_ms_last, 'flush_ms_max': self.flush_ms_max,
+            'flush_ms_total': self.flush_ms_total}
 
     def verify_integrity(self, base='clacker', id='id', max=4):
         return True
@@ -106,9 +235,140 @@ class Database(dict):
         self[base]['active'] = active_ids
 
 
-def wifi_start_access_point(ssid=None, password=None, hostname=None):
-    """ set up the access point """
-    best_channel = get_best_channel(scan_wifi())
+class JournalDatabase(Database):
+    """
+    Database that appends change records to filename.log instead of
+    rewriting the whole document on every flush
+
+    Each flush diffs the dict against what is already on flash, one level
+    into dicts and lists (e.g. one slot of db['claymores']), and appends one
+    JSON line per changed entry:
+        {"k": ["claymores", 2], "v": {...}}    set
+        {"d": ["claymores", 2]}                delete
+    At boot the snapshot (same JSON file Database writes) is loaded and the
+    journal replayed on top. Once the journal grows past compact_bytes the
+    snapshot is rewritten atomically and the journal removed. A torn last
+    line from a reset mid-append is ignored, and the journal compacted
+    away at once so the next append does not start on the same line.
+
+    compact() renames the journal to filename.log.old before the new
+    snapshot goes into place, so a reset part way through never replays
+    the old journal over the new snapshot: while the .old file exists,
+    filename.tmp is the whole new snapshot, or already renamed.
+    """
+    def __init__(self, filename, *args, write_behind_ms=None, compact_bytes=4096):
+        self._journal = filename + '.log'
+        self._folded = self._journal + '.old'  # journal of a compaction in progress
+        self.compact_bytes = compact_bytes
+        self.journal_bytes = 0
+        self.compactions = 0
+        self._persisted = {}  # path tuple -> json of the value on flash
+        self._torn = False  # the journal's last line has no newline
+        super().__init__(filename, *args, write_behind_ms=write_behind_ms)
+        self._persisted = self._entries()
+        if self._torn:
+            self.compact()  # an append would run on from the torn line and be lost with it
+
+    def init_from_file(self):
+        if file_exists(self._folded):
+            # reset mid compact(): the journal is already in the new snapshot
+            if file_exists(self._tmp):
+                self._commit_tmp()
+            remove(self._folded)
+        d = super().init_from_file()
+        if file_exists(self._journal):
+            with open(self._journal) as fh:
+                for line in fh:
+                    self.journal_bytes += len(line)
+                    self._torn = not line.endswith('\n')
+                    try:
+                        self._replay(d, json.loads(line))
+                    except (ValueError, KeyError, IndexError, TypeError) as e:
+                        print('journal: skipping bad record', line, e)
+        return d
+
+    @staticmethod
+    def _replay(d, record):
+        path = record['k'] if 'k' in record else record['d']
+        parent = d[path[0]] if len(path) == 2 else d
+        if 'k' in record:
+            parent[path[-1]] = record['v']
+        else:
+            parent.pop(path[-1], None)
+
+    def _entries(self):
+        """
+        path tuple -> json of every entry as it would be journaled.
+        A container's own entry only records its shape, so a change inside
+        it is written as one child record instead of the whole container.
+        """
+        entries = {}
+        for k, v in self.items():
+            if isinstance(v, dict):
+                entries[(k, )] = 'D'
+                for k2, v2 in v.items():
+                    entries[(k, k2)] = json.dumps(v2)
+            elif isinstance(v, list):
+                entries[(k, )] = f'L{len(v)}'
+                for i, v2 in enumerate(v):
+                    entries[(k, i)] = json.dumps(v2)
+            else:
+                entries[(k, )] = json.dumps(v)
+        return entries
+
+    def _write(self):
+        if self.journal_bytes > self.compact_bytes or not file_exists(self._filename):
+            self.compact()
+            return
+        old = self._persisted
+        new = self._entries()
+        records = []
+        for path, value in new.items():
+            if old.get(path) == value:
+                continue
+            if len(path) == 1:
+                records.append({'k': [path[0]], 'v': self[path[0]]})  # new key, or shape changed
+            elif old.get(path[:1]) == new[path[:1]]:
+                records.append({'k': list(path), 'v': self[path[0]][path[1]]})
+        for path in old:
+            if path not in new and (len(path) == 1 or old[path[:1]] == new.get(path[:1])):
+                records.append({'d': list(path)})
+        if records:
+            with open(self._journal, 'a') as fh:
+                for record in records:
+                    line = json.dumps(record) + '\n'
+                    fh.write(line)
+                    self.journal_bytes += len(line)
+        self._persisted = new
+
+    def compact(self):
+        """ rewrite the snapshot and start an empty journal """
+        self._write_tmp(json.dumps(self))
+        if file_exists(self._journal):
+            rename(self._journal, self._folded)
+        self._commit_tmp()
+        if file_exists(self._folded):
+            remove(self._folded)
+        self.journal_bytes = 0
+        self.compactions += 1
+        self._persisted = self._entries()
+
+    def erase(self):
+        super().erase()
+        for filename in (self._journal, self._folded):
+            if file_exists(filename):
+                remove(filename)
+        self.journal_bytes = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({'journal_bytes': self.journal_bytes, 'compactions': self.compactions})
+        return stats
+
+
+def wifi_start_access_point(ssid=None, password=None, hostname=None, channel=None):
+    """ set up the access point, on channel or the best a survey finds """
+    best_channel = channel or survey_channels().best()
     ap = network.WLAN(network.AP_IF)
 
     ap.active(False)
@@ -138,15 +398,8 @@ def wifi_start_access_point(ssid=None, password=None, hostname=None):
     return ip
 
 
-def wifi_connect_to_access_point(ssid, password=None, timeout=10):
-    """
-    Parameters:
-    ssid[str]: The name of the ap you want to connect
-    password[str]: Password for your internet connection
-    hostname[str]: hostname for this device
-    Returns: Your ip address
-    """
-    # Just making our internet connection
+def _station_connect(ssid, password, bssid):
+    """ start joining ssid, returns the STA interface """
     wifi = network.WLAN(network.STA_IF)
     wifi.config(ssid=ssid)
     wifi.config(pm=0xa11140)  # max power baby!
@@ -157,7 +410,26 @@ def wifi_connect_to_access_point(ssid, password=None, timeout=10):
         wifi.config(password=password)
     wifi.active(True)
 
-    wifi.connect(ssid, password)
+    if bssid:
+        wifi.connect(ssid, password, bssid=bssid)
+    else:
+        wifi.connect(ssid, password)
+    return wifi
+
+
+def wifi_connect_to_access_point(ssid, password=None, timeout=10, bssid=None):
+    """
+    Parameters:
+    ssid[str]: The name of the ap you want to connect
+    password[str]: Password for your internet connection
+    timeout[int]: seconds to wait for the link
+    bssid[bytes]: join this AP directly, no need to find it by scanning first
+    Returns: Your ip address
+    Blocks for up to timeout seconds: only for use before the event loop runs,
+    see wifi_connect_async()
+    """
+    # Just making our internet connection
+    wifi = _station_connect(ssid, password, bssid)
     for _ in range(timeout):
         if wifi.isconnected():
             break
@@ -169,55 +441,72 @@ def wifi_connect_to_access_point(ssid, password=None, timeout=10):
     return ip[0], ip[2]
 
 
+_JOIN_FAILED = (-3, -2, -1)  # CYW43 LINK_BADAUTH, LINK_NONET, LINK_FAIL: waiting longer will not help
+
+
+async def wifi_connect_async(ssid, password=None, timeout_ms=10000, bssid=None, poll_ms=250):
+    """
+    wifi_connect_to_access_point() that polls the link status on sleep_ms,
+    so the web server, buttons and watchdog feeding carry on meanwhile
+    Returns (ip, gateway), None if the link did not come up in timeout_ms.
+    Cancelling it (task.cancel(), wait_for_ms) drops the half made
+    connection, so the radio is idle again for the next attempt.
+    """
+    wifi = _station_connect(ssid, password, bssid)
+    start = ticks_ms()
+    try:
+        while not wifi.isconnected():
+            status = wifi.status()
+            if status in _JOIN_FAILED or ticks_diff(ticks_ms(), start) > timeout_ms:
+                print('Connecting to {} failed: {}'.format(ssid, WLAN_STATUS.get(status, status)))
+                wifi.disconnect()
+                return None
+            await asyncio.sleep_ms(poll_ms)
+    except asyncio.CancelledError:
+        wifi.disconnect()
+        raise
+    ip = wifi.ifconfig()
+    print('Connected to AP: {} our IP: {} in {} ms'.format(ssid, ip, ticks_diff(ticks_ms(), start)))
+    return ip[0], ip[2]
+
+
+class Backoff:
+    """
+    delays between retries: first_ms, doubling up to max_ms, each spread by
+    +-jitter so a fleet that lost the same AP does not retry in lockstep
+    """
+    def __init__(self, first_ms=500, max_ms=8000, jitter=0.25):
+        self.first_ms = first_ms
+        self.max_ms = max_ms
+        self.jitter = jitter
+        self.delay_ms = first_ms
+        self.retries = 0
+
+    def next(self):
+        """ ms to wait before the next attempt """
+        delay = self.delay_ms
+        self.delay_ms = min(self.max_ms, delay * 2)
+        self.retries += 1
+        spread = int(delay * self.jitter)
+        return delay + (getrandbits(16) % (2 * spread + 1)) - spread if spread else delay
+
+    def reset(self):
+        self.delay_ms = self.first_ms
+
+
 def get_best_channel(ap_list):
-    # https://en.wikipedia.org/wiki/List_of_WLAN_channels
-    # find the wifi channel of 1, 6, 11 for which has the least RSSI competition
-    overlap = {
-        1: 1, 2: 1, 3: 1,
-        4: 6, 5: 6, 6: 6, 7: 6, 8: 6,
-        9: 11, 10: 11, 11: 11, 12: 11, 13: 11, 14: 11
-    }
-    hits = {1: 0.0, 6: 0.0, 11: 0.0}
+    """ the least crowded of channels 1, 6 and 11 by one scan's ap dicts, see channels.py """
+    survey = ChannelSurvey()
     for ap in ap_list:
-        if ap['RSSI'] < -80:
-            # Very far away Neighbor's house
-            hits[overlap[ap['channel']]] += .25
-        elif ap['RSSI'] < -65:
-            # Next Door Neighbor
-            hits[overlap[ap['channel']]] += .5
-        else:
-            # Inside the house
-            hits[overlap[ap['channel']]] += 1.0
-    min_hits = min(hits.values())
-    channel = [k for k, v in hits.items() if v == min_hits][0]
-    print(hits, channel)
-    return channel
+        survey.hear(ap['bssid'], ap['channel'], ap['RSSI'])
+    survey.scans = 1
+    return survey.best()
 
 
 def scan_wifi(match=None):
-    wifi = network.WLAN(network.STA_IF)
-    prev_active = wifi.active()
-    wifi.active(True)
-    collect()  # gc
-    raw_aps = wifi.scan()
-    wifi.active(prev_active)
-    raw_aps.sort(key=lambda x: -x[3])  # sort by strongest signal strength
-    ap_list = []
-    for ap in raw_aps:
-        (ssid, bssid, channel, RSSI, security, hidden) = ap
-        ap_list.append({
-            'ssid': ssid.decode('utf-8'),
-            'bssid': hexlify(bssid).decode(),
-            'channel': channel,
-            'RSSI': RSSI,
-            'security': security,
-            'hidden': hidden
-        })
-        print(ap_list[-1])
-    if match:
-        return [ap for ap in ap_list if all(m.lower() in ap['ssid'].lower() for m in match)]
-
-    return ap_list
+    """ scan now: the APs whose ssid contains every string in match, strongest first """
+    scanner.scan()
+    return scanner.aps(scanner.terms(*match) if match else ())
 
 
 def _handle_exception(_loop, context):
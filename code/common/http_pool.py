@@ -0,0 +1,262 @@
+"""
+Pooled, keep-alive HTTP/1.1 client using uasyncio streams
+Intended for Raspberry Pi Pico W
+
+Replaces one aiohttp.ClientSession per request with one persistent
+connection per peer IP, shared by every task on the device.
+
+* at most one open socket per (host, port)
+* at most max_connections open sockets in total (least recently used idle
+  connection is closed to make room)
+* a connection that turns out to be dead (peer closed, reset, lwIP error)
+  is dropped and the request is retried once on a fresh socket
+* peers that answer "Connection: close" or send no Content-Length
+  (tinyweb html pages) are handled, the socket is simply not reused
+* a peer that closed a socket we had just reused is taken to close after
+  every response (tinyweb does, without saying so): from then on its
+  requests say "Connection: close" and get a fresh socket, so only the
+  first reuse pays for a failed attempt
+
+Usage:
+    pool = HttpPool(max_connections=4)
+    resp = await pool.get('http://192.168.4.16/ping')
+    if resp.status == 200:
+        print(resp.text())
+"""
+import json
+import uasyncio as asyncio
+from time import ticks_ms, ticks_diff
+from micropython import const
+
+_DEFAULT_TIMEOUT = const(3000)  # ms, must be less than the claymore WDT
+_IDLE_CLOSE = const(30000)  # ms, close connections unused for this long
+_WAIT_SLOT = const(10)  # ms, poll interval while every connection is busy
+
+
+class HttpResponse:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def text(self):
+        return self.body.decode()
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class _Connection:
+    def __init__(self, host, port, reader, writer):
+        self.host = host
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+        self.requests = 0
+        self.last_used = ticks_ms()
+
+    async def close(self):
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception:
+            pass  # already dead, nothing to do
+
+
+def _split_url(url):
+    """ 'http://host[:port]/path' -> (host, port, path) """
+    if url.startswith('http://'):
+        url = url[7:]
+    host, _, path = url.partition('/')
+    host, _, port = host.partition(':')
+    return host, int(port or 80), '/' + path
+
+
+class HttpPool:
+    def __init__(self, max_connections=4, timeout_ms=_DEFAULT_TIMEOUT, idle_ms=_IDLE_CLOSE):
+        self.max_connections = max_connections
+        self.timeout_ms = timeout_ms
+        self.idle_ms = idle_ms
+        self._conns = {}  # (host, port) -> _Connection
+        self._closes = set()  # (host, port) of peers that close after every response
+        self.connects = 0
+        self.reconnects = 0
+
+    def open_count(self):
+        return len(self._conns)
+
+    def stats(self):
+        return {'http_pool': {
+            'open': len(self._conns), 'connects': self.connects, 'reconnects': self.reconnects,
+            'unpooled_peers': len(self._closes)}}
+
+    async def close(self, host=None):
+        """ close every pooled connection, or only those to host """
+        for key in list(self._conns):
+            if host is None or key[0] == host:
+                await self._conns.pop(key).close()
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+    async def request(self, verb, url, json=None, data=None, timeout_ms=None):
+        """
+        Send one request over the pooled connection to the url's host
+        Raises asyncio.TimeoutError if no complete response within timeout_ms
+        """
+        host, port, path = _split_url(url)
+        body = data
+        content_type = None
+        if json is not None:
+            body = _dumps(json)
+            content_type = 'application/json'
+        if isinstance(body, str):
+            body = body.encode()
+        return await asyncio.wait_for_ms(
+            self._request(verb, host, port, path, body, content_type),
+            timeout_ms or self.timeout_ms)
+
+    async def _request(self, verb, host, port, path, body, content_type):
+        key = (host, port)
+        for attempt in (0, 1):
+            conn = await self._acquire(key)
+            try:
+                reused = conn.requests > 0
+                return await self._exchange(conn, verb, path, body, content_type)
+            except (OSError, EOFError) as e:
+                await self._drop(conn)
+                if attempt or not reused:
+                    raise
+                # stale keep-alive socket: the peer closed it after its last response
+                print(f'HttpPool: reconnect {host} ({e}), not pooling it from now on')
+                self._closes.add(key)
+                self.reconnects += 1
+            except BaseException:
+                # timeout/cancel mid-exchange leaves the stream in an unknown state
+                await self._drop(conn)
+                raise
+            finally:
+                conn.lock.release()
+
+    async def _acquire(self, key):
+        """ return the locked pooled connection for key, connecting if needed """
+        while True:
+            conn = self._conns.get(key)
+            if conn is None:
+                if len(self._conns) >= self.max_connections and not await self._evict():
+                    await asyncio.sleep_ms(_WAIT_SLOT)  # every socket is busy
+                    continue
+                conn = await self._connect(key)
+            await conn.lock.acquire()
+            if self._conns.get(key) is conn:
+                return conn
+            conn.lock.release()  # dropped while we waited for the lock
+
+    async def _connect(self, key):
+        reader, writer = await asyncio.open_connection(key[0], key[1])
+        conn = _Connection(key[0], key[1], reader, writer)
+        if key in self._conns:
+            await self._conns[key].close()
+        self._conns[key] = conn
+        self.connects += 1
+        return conn
+
+    async def _drop(self, conn):
+        if self._conns.get((conn.host, conn.port)) is conn:
+            del self._conns[(conn.host, conn.port)]
+        await conn.close()
+
+    async def _evict(self):
+        """ close idle-too-long connections, else the least recently used idle one """
+        now = ticks_ms()
+        lru = None
+        for conn in list(self._conns.values()):
+            if conn.lock.locked():
+                continue
+            if ticks_diff(now, conn.last_used) > self.idle_ms:
+                await self._drop(conn)
+                continue
+            if lru is None or ticks_diff(conn.last_used, lru.last_used) < 0:
+                lru = conn
+        if len(self._conns) < self.max_connections:
+            return True
+        if lru is None:
+            return False
+        await self._drop(lru)
+        return True
+
+    async def _exchange(self, conn, verb, path, body, content_type):
+        w = conn.writer
+        closes = (conn.host, conn.port) in self._closes
+        w.write(f'{verb} {path} HTTP/1.1\r\nHost: {conn.host}\r\n'.encode())
+        w.write(b'Connection: close\r\n' if closes else b'Connection: keep-alive\r\n')
+        if content_type:
+            w.write(f'Content-Type: {content_type}\r\n'.encode())
+        w.write(f'Content-Length: {len(body) if body else 0}\r\n\r\n'.encode())
+        if body:
+            w.write(body)
+        await w.drain()
+
+        r = conn.reader
+        line = await r.readline()
+        if not line:
+            raise EOFError('connection closed by peer')
+        status = int(line.split(None, 2)[1])
+        headers = {}
+        while True:
+            line = await r.readline()
+            if not line or line == b'\r\n':
+                break
+            k, _, v = line.decode().partition(':')
+            headers[k.strip().lower()] = v.strip()
+
+        keep_alive = not closes and headers.get('connection', 'keep-alive').lower() != 'close'
+        if 'content-length' in headers:
+            length = int(headers['content-length'])
+            resp_body = await r.readexactly(length) if length else b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            resp_body = await _read_chunked(r)
+        else:
+            # no framing: body runs until the peer closes the socket
+            resp_body = await _read_to_eof(r)
+            keep_alive = False
+
+        conn.requests += 1
+        conn.last_used = ticks_ms()
+        if not keep_alive:
+            await self._drop(conn)
+        return HttpResponse(status, headers, resp_body)
+
+
+async def _read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if size == 0:
+            await reader.readline()
+            return b''.join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+
+async def _read_to_eof(reader):
+    chunks = []
+    while True:
+        chunk = await reader.read(512)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def _dumps(obj):
+    return json.dumps(obj)
@@ -0,0 +1,164 @@
+"""
+Latency histograms and error counters for GET /metrics
+Intended for Raspberry Pi Pico W
+
+Every histogram is a fixed array of bucket counts allocated when it is
+first named, so recording a sample is a bucket search and a few array
+stores: no allocation, safe on the hot path. Only building the /metrics
+report allocates.
+
+    metrics = Metrics()
+
+    @metrics.route(app, '/status')        # instead of @app.route('/status')
+    async def status(request, response):
+        ...
+
+    metrics.add_resource(app, Clack, '/clack')   # instead of app.add_resource
+
+    resp = await metrics.timed('out_ping', pool.get(url))
+
+Errors raised through any of these are counted as timeouts, ENOMEM or
+other OSErrors before they propagate.
+"""
+import errno
+from array import array
+from gc import mem_free, mem_alloc
+from time import ticks_us, ticks_diff
+import uasyncio as asyncio
+
+# upper bucket edges in microseconds, anything slower lands in the last (overflow) bucket
+BUCKETS_US = (250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000, 2500000)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS_US):
+        self.buckets = buckets
+        self.counts = array('I', [0] * (len(buckets) + 1))
+        # count, sum (ms, so it stays a small int for weeks), max (us)
+        self.totals = array('I', [0, 0, 0])
+
+    def record(self, us):
+        buckets = self.buckets
+        i = 0
+        n = len(buckets)
+        while i < n and us > buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        totals = self.totals
+        totals[0] += 1
+        totals[1] += us // 1000
+        if us > totals[2]:
+            totals[2] = us
+
+    def percentile(self, pct):
+        """ upper edge (us) of the bucket holding the pct'th sample, None for the overflow bucket """
+        rank = self.totals[0] * pct // 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen > rank:
+                return self.buckets[i] if i < len(self.buckets) else None
+        return 0
+
+    def report(self):
+        count, sum_ms, max_us = self.totals
+        report = {
+            'count': count, 'sum_ms': sum_ms, 'max_us': max_us,
+            'p50_us': self.percentile(50), 'p95_us': self.percentile(95), 'p99_us': self.percentile(99),
+            'counts': list(self.counts)}
+        if self.buckets is not BUCKETS_US:
+            report['buckets_us'] = list(self.buckets)  # its own edges, not the report's
+        return report
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {'timeouts': 0, 'oserrors': 0, 'enomem': 0}
+        self.sources = []  # callables returning a dict merged into the report, e.g. pool.stats
+
+    def histogram(self, name, buckets=BUCKETS_US):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram(buckets)
+        return h
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def error(self, e):
+        """ count e by kind """
+        if isinstance(e, asyncio.TimeoutError):
+            self.counters['timeouts'] += 1
+        elif isinstance(e, OSError):
+            if e.errno == errno.ENOMEM:
+                self.counters['enomem'] += 1
+            elif e.errno == errno.ETIMEDOUT:
+                self.counters['timeouts'] += 1
+            else:
+                self.counters['oserrors'] += 1
+
+    async def timed(self, name, awaitable):
+        """ await awaitable, recording its latency in histogram name """
+        h = self.histogram(name)
+        start = ticks_us()
+        try:
+            return await awaitable
+        except Exception as e:
+            self.error(e)
+            raise
+        finally:
+            h.record(ticks_diff(ticks_us(), start))
+
+    def route(self, app, url, **kwargs):
+        """ app.route() that times the handler """
+        h = self.histogram(url)
+
+        def decorate(handler):
+            async def timed_handler(*args, **params):
+                start = ticks_us()
+                try:
+                    return await handler(*args, **params)
+                except Exception as e:
+                    self.error(e)
+                    raise
+                finally:
+                    h.record(ticks_diff(ticks_us(), start))
+            app.add_route(url, timed_handler, **kwargs)
+            return handler
+        return decorate
+
+    def _timed_method(self, h, method):
+        def timed_method(*args, **params):
+            start = ticks_us()
+            try:
+                return method(*args, **params)
+            except Exception as e:
+                self.error(e)
+                raise
+            finally:
+                h.record(ticks_diff(ticks_us(), start))
+        return timed_method
+
+    def add_resource(self, app, cls, url, **kwargs):
+        """ app.add_resource() that times each HTTP method """
+        resource = cls()
+        for verb in ('get', 'post', 'put', 'patch', 'delete'):
+            method = getattr(resource, verb, None)
+            if method:
+                h = self.histogram(f'{verb.upper()} {url}')
+                setattr(resource, verb, self._timed_method(h, method))
+        app.add_resource(resource, url, **kwargs)
+
+    def report(self):
+        d = {
+            'buckets_us': self.buckets(), 'counters': self.counters,
+            'mem_free': mem_free(), 'mem_alloc': mem_alloc(),
+            'histograms': {name: h.report() for name, h in self.histograms.items()}}
+        for source in self.sources:
+            d.update(source())
+        return d
+
+    @staticmethod
+    def buckets():
+        return list(BUCKETS_US) + ['+Inf']
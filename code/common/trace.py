@@ -0,0 +1,66 @@
+"""
+End to end fire traces
+Intended for Raspberry Pi Pico W
+
+A trace ID (u16, 0 == untraced) is made when the clacker's FIRE button
+triggers a fire and travels in the UDP FIRE datagram and the HTTP POST
+/clack body. Each device stamps the stages it sees with its own ticks_us:
+
+    clacker   pressed, detected, task_started, request_sent, http_sent,
+              ack_<slot>
+    claymore  received, servo_set, ack_sent
+
+GET /trace/<id> (or /trace/all) on either device returns the stages in
+order with the time since the first one. A claymore with a clock offset to
+its clacker also reports the stages on the clacker's clock, so the two
+timelines can be laid side by side.
+
+Only the last few traces are kept; a stamp is one small list append.
+"""
+from random import getrandbits
+from time import ticks_us, ticks_diff, ticks_add
+
+_KEEP = 8  # traces remembered
+
+
+class TraceLog:
+    def __init__(self, keep=_KEEP):
+        self.keep = keep
+        self.traces = {}  # trace id -> [[stage, ticks_us], ...]
+        self._order = []  # trace ids, oldest first
+        self._next = getrandbits(16) or 1
+        self.offset_us = None  # callable -> offset to the clacker's ticks_us, or None
+
+    def new(self):
+        """ a fresh trace ID """
+        trace = self._next
+        self._next = (self._next + 1) & 0xffff or 1
+        return trace
+
+    def stamp(self, trace, stage, us=None):
+        if not trace:
+            return
+        stages = self.traces.get(trace)
+        if stages is None:
+            if len(self._order) >= self.keep:
+                del self.traces[self._order.pop(0)]
+            stages = self.traces[trace] = []
+            self._order.append(trace)
+        stages.append([stage, ticks_us() if us is None else us])
+
+    def get(self, trace):
+        """ report of one trace, None if unknown """
+        stages = self.traces.get(trace)
+        if not stages:
+            return None
+        first = stages[0][1]
+        report = {'trace': trace, 'stages': [
+            {'stage': stage, 'us': us, 'since_first_us': ticks_diff(us, first)} for stage, us in stages]}
+        offset = self.offset_us() if self.offset_us else None
+        if offset is not None:
+            for stage in report['stages']:
+                stage['clacker_us'] = ticks_add(stage['us'], offset)
+        return report
+
+    def recent(self):
+        return [self.get(trace) for trace in self._order]
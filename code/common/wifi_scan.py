@@ -0,0 +1,124 @@
+"""
+Background Wi-Fi scanner
+Intended for Raspberry Pi Pico W
+
+WLAN.scan() blocks the event loop for a second or two while the radio hops
+channels, so every caller scanning for itself stacks those seconds up.
+One WifiScanner keeps what the scans saw in a small table,
+
+    ssid -> (ssid lowercased, bssid hex, channel, RSSI, security, hidden, seen ms)
+
+one entry per SSID (its strongest BSSID; hidden APs by BSSID), and callers
+query that instead of scanning again:
+
+    terms = scanner.terms('clacker', team)  # lowercased once, not per AP
+    scanner.aps(terms)                      # as ap dicts, strongest first
+    scanner.aps(terms, max_age_ms=10000)    # scans first if the table is older
+
+There is no background refresh: the table is as fresh as the last scan
+somebody asked for. A periodic scanner that leaves a joined station's
+channel for a second or more loses whatever its AP sends meanwhile. idle()
+tells a caller that scans on its own schedule (ChannelWatch) when the radio
+may go: the station is neither joining nor joined to an AP and busy() (e.g.
+a fire in progress) is false. An AP not seen for ttl_ms drops out of the
+table at the next scan.
+"""
+from micropython import const
+from time import ticks_ms, ticks_diff
+from ubinascii import hexlify
+from gc import collect
+import network
+
+_LOWER = const(0)  # table tuple fields
+_BSSID = const(1)
+_CHANNEL = const(2)
+_RSSI = const(3)
+_SECURITY = const(4)
+_HIDDEN = const(5)
+_SEEN = const(6)
+
+_LINK_JOIN = const(1)  # CYW43 status while a connect is in progress
+SCAN_TTL = const(120000)  # ms an AP stays in the table after it was last seen
+
+
+class WifiScanner:
+    def __init__(self, ttl_ms=SCAN_TTL, busy=None):
+        self.ttl_ms = ttl_ms
+        self.busy = busy or (lambda: False)  # callable -> True while the radio must not leave its channel
+        self.table = {}  # ssid -> tuple, see above
+        self.scanned_ms = None  # ticks_ms of the last scan
+        self.scans = 0
+        self.scan_ms = 0  # how long the last scan blocked
+
+    @staticmethod
+    def terms(*words):
+        """ match terms for aps(): every one must be in the ssid, case blind """
+        return tuple(word.lower() for word in words)
+
+    def age_ms(self):
+        """ ms since the last scan, None before the first """
+        return None if self.scanned_ms is None else ticks_diff(ticks_ms(), self.scanned_ms)
+
+    def idle(self):
+        wifi = network.WLAN(network.STA_IF)
+        return wifi.status() != _LINK_JOIN and not wifi.isconnected() and not self.busy()
+
+    def scan(self):
+        """ scan now (blocks), fold the result into the table; the WLAN.scan() tuples """
+        wifi = network.WLAN(network.STA_IF)
+        prev_active = wifi.active()
+        wifi.active(True)
+        collect()  # gc
+        start = ticks_ms()
+        raw_aps = wifi.scan()
+        self.scan_ms = ticks_diff(ticks_ms(), start)
+        wifi.active(prev_active)
+        self.update(raw_aps, start)
+        print(f'Scan: {len(raw_aps)} APs, {len(self.table)} networks in {self.scan_ms} ms')
+        return raw_aps
+
+    def update(self, raw_aps, now):
+        """ fold WLAN.scan() tuples, heard at ticks_ms now, into the table """
+        table = self.table
+        for ssid, bssid, channel, rssi, security, hidden in raw_aps:
+            bssid = hexlify(bssid).decode()
+            ssid = ssid.decode('utf-8') or bssid
+            old = table.get(ssid)
+            if old is not None and old[_SEEN] == now and old[_RSSI] >= rssi:
+                continue  # a weaker BSSID of a network this scan already heard
+            table[ssid] = (ssid.lower(), bssid, channel, rssi, security, hidden, now)
+        for ssid in [ssid for ssid, ap in table.items() if ticks_diff(now, ap[_SEEN]) > self.ttl_ms]:
+            del table[ssid]
+        self.scanned_ms = now
+        self.scans += 1
+
+    def aps(self, terms=(), max_age_ms=None):
+        """
+        the networks whose ssid contains every one of terms (from terms()),
+        strongest first, as dicts like the ones scan_wifi() always returned;
+        with max_age_ms, only networks heard that recently, scanning first
+        when the table is older
+        """
+        age = self.age_ms()
+        if max_age_ms is not None and (age is None or age > max_age_ms):
+            self.scan()
+        now = ticks_ms()
+        found = [
+            (ssid, ap) for ssid, ap in self.table.items()
+            if all(term in ap[_LOWER] for term in terms)
+            and (max_age_ms is None or ticks_diff(now, ap[_SEEN]) <= max_age_ms)]
+        found.sort(key=lambda item: -item[1][_RSSI])
+        return [{
+            'ssid': '' if ssid == ap[_BSSID] else ssid,
+            'bssid': ap[_BSSID],
+            'channel': ap[_CHANNEL],
+            'RSSI': ap[_RSSI],
+            'security': ap[_SECURITY],
+            'hidden': ap[_HIDDEN]
+        } for ssid, ap in found]
+
+    def stats(self):
+        return {'wifi_scans': self.scans, 'wifi_scan_ms': self.scan_ms, 'wifi_networks': len(self.table)}
+
+
+scanner = WifiScanner()  # one radio, one table
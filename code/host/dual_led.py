@@ -0,0 +1,88 @@
+"""
+dual_led stand-in for CPython
+
+A red/green LED on two output pins. The patterns (blink, alternate,
+count) are driven by a machine.Timer, so they show up in machine.ACTIONS
+as pin changes just like on the board.
+"""
+from machine import Pin, Timer
+
+_TICK = 250  # ms per pattern step
+
+
+class DualLED:
+    COLORS = ['RED', 'GREEN']  # indexed by the team switch: 0 -> RED, 1 -> GREEN
+
+    def __init__(self, red_gpio, green_gpio, primary_color=None):
+        self.pins = {'RED': Pin(red_gpio, Pin.OUT, value=0), 'GREEN': Pin(green_gpio, Pin.OUT, value=0)}
+        self.primary_color = primary_color or self.COLORS[0]
+        self.color = self.primary_color
+        self.state = 'OFF'
+        self._timer = Timer()
+        self._pattern = ()  # colors (None == dark) stepped through every _TICK
+        self._step = 0
+
+    def _show(self, color):
+        for name, pin in self.pins.items():
+            pin.value(name == color)
+
+    def _run(self, state, pattern):
+        self._timer.deinit()
+        self.state = state
+        self._pattern = pattern
+        self._step = 0
+        self._show(pattern[0])
+        if len(pattern) > 1:
+            self._timer.init(mode=Timer.PERIODIC, period=_TICK, callback=self._tick)
+
+    def _tick(self, _t):
+        self._step = (self._step + 1) % len(self._pattern)
+        self._show(self._pattern[self._step])
+
+    def other_color(self):
+        return [c for c in self.COLORS if c != self.primary_color][0]
+
+    def set_primary_color(self, color):
+        self.primary_color = color
+        self.restore_state(self.state)
+
+    def on(self, color=None):
+        self.color = color or self.primary_color
+        self._run('ON', (self.color, ))
+
+    def off(self):
+        self._run('OFF', (None, ))
+
+    def toggle(self):
+        self.off() if self.state == 'ON' else self.on()
+
+    def blink(self):
+        self.color = self.primary_color
+        self._run('BLINK', (self.color, self.color, None, None))
+
+    def alternate_colors(self):
+        self.color = self.primary_color
+        self._run('ALTERNATE', (self.primary_color, self.other_color()))
+
+    def count_number(self, number):
+        """ blink number times, pause, repeat """
+        self.color = self.primary_color
+        self._run(f'COUNT{number}', (self.color, None) * number + (None, ) * 4)
+
+    def restore_state(self, state=None):
+        state = state or 'OFF'
+        if state == 'ON':
+            self.on(self.color)
+        elif state == 'BLINK':
+            self.blink()
+        elif state == 'ALTERNATE':
+            self.alternate_colors()
+        elif state.startswith('COUNT'):
+            self.count_number(int(state[5:]))
+        else:
+            self.off()
+
+    set_state = restore_state
+
+    def get_state(self):
+        return {'STATE': self.state, 'COLOR': self.color}
@@ -0,0 +1,378 @@
+"""
+Run foam-claymore firmware modules under CPython
+
+    import hostenv
+    hostenv.install('clacker')  # or 'claymore', or None for common/ only
+
+puts host/ (stand-in modules), common/ and the device folder on sys.path
+and adds the MicroPython-only functions the firmware calls to sys, time
+and gc.
+
+Every device runs in its own process with its own loopback address
+(127.0.<net>.<host>, handed out by the fake network.WLAN). Sockets are
+patched so that
+
+- binding '0.0.0.0' binds the device address instead,
+- an unbound socket is bound to the device address before it connects or
+  sends, so peers see the right source address,
+- a datagram to the subnet broadcast address goes to every device on that
+  subnet,
+- privileged ports (HTTP 80, DNS 53) are moved up by PORT_BASE when not
+  running as root,
+- traffic to or from an impaired device (impair(), an impair_<name> file)
+  is delayed, dropped or cut off like over a marginal Wi-Fi link.
+
+A process may also host several virtual devices (bench/fleet_sim.py):
+a task that sets DEVICE_IP gets its own address for the sockets it and
+the tasks it creates use.
+
+Devices find each other through the ether directory (FOAM_ETHER, default
+/tmp/foam-ether): access points, DHCP leases and link state are small
+files there. See run_device.py to boot a main program.
+"""
+import contextvars
+import gc
+import errno
+import json
+import os
+import random
+import socket
+import sys
+import time
+import traceback
+import tracemalloc
+
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_PERIOD = 1 << 30  # MicroPython ticks wrap at 2**30
+_HEAP = 192 * 1024  # roughly what a Pico W has free after boot
+
+ETHER = os.environ.get('FOAM_ETHER', '/tmp/foam-ether')
+PORT_BASE = int(os.environ.get('FOAM_PORT_BASE', '0' if os.geteuid() == 0 else '8000'))
+DEVICE = {'name': os.environ.get('FOAM_DEVICE', 'device'), 'ip': None}
+DEVICE_IP = contextvars.ContextVar('device_ip', default=None)  # per task override of DEVICE['ip']
+
+
+def device_ip():
+    return DEVICE_IP.get() or DEVICE['ip']
+
+
+def ticks_ms():
+    return int(time.monotonic() * 1000) & (_PERIOD - 1)
+
+
+def ticks_us():
+    return int(time.monotonic() * 1000000) & (_PERIOD - 1)
+
+
+def ticks_diff(a, b):
+    return ((a - b + _PERIOD // 2) & (_PERIOD - 1)) - _PERIOD // 2
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & (_PERIOD - 1)
+
+
+def mem_alloc():
+    """ bytes currently allocated, only meaningful while tracemalloc is tracing """
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+
+def mem_free():
+    return max(0, _HEAP - mem_alloc())
+
+
+def print_exception(e, file=None):
+    traceback.print_exception(type(e), e, e.__traceback__, file=file)
+
+
+# ---- ether: what the devices know about each other -----------------------
+
+def ether_path(*names):
+    os.makedirs(ETHER, exist_ok=True)
+    return os.path.join(ETHER, *names)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def claim(name, info):
+    """
+    Atomically claim ether file name for this process, returns False if a
+    live process (or another device of this one) holds it. Files left by
+    dead processes, or by this device before a reset, are taken over.
+    """
+    path = ether_path(name)
+    info = dict(info, pid=os.getpid())
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            held = read(name)
+            if not held:
+                return False  # being written by its claimant right now
+            if held.get('pid') == os.getpid() and held.get('name') != info.get('name'):
+                return False  # another virtual device in this process
+            if held.get('pid') != os.getpid() and _alive(held.get('pid', 0)):
+                return False
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(info, fh)
+        return True
+    return False
+
+
+def publish(name, info):
+    """ (re)write ether file name, owned by this process """
+    path = ether_path(name)
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as fh:
+        json.dump(dict(info, pid=os.getpid()), fh)
+    os.replace(tmp, path)
+
+
+def release(name):
+    try:
+        os.remove(ether_path(name))
+    except FileNotFoundError:
+        pass
+
+
+def read(name):
+    try:
+        with open(ether_path(name)) as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def listing(prefix):
+    """ {name: info} of the live ether files starting with prefix """
+    found = {}
+    for name in os.listdir(ether_path()):
+        if name.startswith(prefix) and '.tmp' not in name:
+            info = read(name)
+            if info and _alive(info.get('pid', 0)):
+                found[name] = info
+    return found
+
+
+_peers = {'at': 0.0, 'names': {}}  # names: ip -> device name
+_PEERS_TTL = 1.0  # s, devices joining take this long to start hearing broadcasts
+
+
+def _addresses():
+    now = time.monotonic()
+    if now - _peers['at'] > _PEERS_TTL:
+        _peers['names'] = {info['ip']: info['name'] for info in listing('ip_').values()}
+        _peers['at'] = now
+    return _peers['names']
+
+
+def subnet_peers(ip):
+    """ addresses of every other live device on ip's /24 """
+    net = ip.rsplit('.', 1)[0] + '.'
+    return [peer for peer in _addresses() if peer.startswith(net) and peer != ip]
+
+
+# ---- impairment ------------------------------------------------------------
+
+_impaired = {'at': 0.0, 'names': {}}  # names: device name -> impairment
+_IMPAIR_TTL = 0.2  # s, devices notice a changed impairment this quickly
+_RTO = 0.3  # s, a lost TCP segment arrives one retransmission timeout late
+LINK = {'lost': False}  # this device's link went down since it last connected
+
+
+def impair(name, **conf):
+    """
+    impair every packet to and from device name:
+        latency_ms  added one-way delay
+        jitter_ms   up to this much more, at random
+        loss        fraction of datagrams dropped (TCP segments come _RTO late)
+        down        link cut: nothing gets through, connects fail
+    impair(name) alone makes the link clean again
+    """
+    if conf:
+        publish(f'impair_{name}', conf)
+    else:
+        release(f'impair_{name}')
+
+
+def impairment(name):
+    """ device name's impairment, {} while its link is clean """
+    now = time.monotonic()
+    if now - _impaired['at'] > _IMPAIR_TTL:
+        _impaired['names'] = {name[7:]: info for name, info in listing('impair_').items()}
+        _impaired['at'] = now
+    return _impaired['names'].get(name, {})
+
+
+def _path_to(host):
+    """ the combined impairment between this device and host, None if clean """
+    ip = device_ip()
+    lost = LINK['lost'] and ip == DEVICE['ip']  # off the AP until the firmware connects again
+    if not lost and not _impaired['names'] and time.monotonic() - _impaired['at'] <= _IMPAIR_TTL:
+        return None  # fast path, nothing impaired anywhere
+    if host not in _addresses():
+        return None  # not a device, e.g. run_device.py's control port
+    ends = [impairment(DEVICE['name'] if ip == DEVICE['ip'] else _addresses().get(ip)),
+            impairment(_addresses()[host])]
+    if ends[0].get('down') and ip == DEVICE['ip']:
+        LINK['lost'] = lost = True
+    if not ends[0] and not ends[1] and not lost:
+        return None
+    return {
+        'down': lost or any(end.get('down') for end in ends),
+        'loss': 1 - (1 - ends[0].get('loss', 0)) * (1 - ends[1].get('loss', 0)),
+        'delay': sum(end.get('latency_ms', 0) + random.random() * end.get('jitter_ms', 0) for end in ends) / 1000}
+
+
+def _later(delay, func, *args):
+    import uasyncio
+    uasyncio.loop().call_later(delay, func, *args)
+
+
+# ---- sockets ---------------------------------------------------------------
+
+def host_port(port):
+    return port + PORT_BASE if 0 < port < 1024 else port
+
+
+def _is_broadcast(host):
+    return host.endswith('.255')
+
+
+class HostSocket(socket.socket):
+    """ socket.socket that lives on the device's loopback address """
+
+    def _device_addr(self, address):
+        host, port = address[:2]
+        if host in ('0.0.0.0', ''):
+            host = device_ip() or '127.0.0.1'
+        return host, host_port(port)
+
+    def _bind_to_device(self):
+        ip = device_ip()
+        if self.family == socket.AF_INET and ip and self.getsockname()[1] == 0:
+            super().bind((ip, 0))
+
+    def _reachable(self, host):
+        path = _path_to(host)
+        if path and path['down']:
+            raise OSError(errno.EHOSTUNREACH, os.strerror(errno.EHOSTUNREACH))
+
+    def bind(self, address):
+        if self.family != socket.AF_INET:
+            return super().bind(address)
+        return super().bind(self._device_addr(address))
+
+    def connect(self, address):
+        if self.family != socket.AF_INET:
+            return super().connect(address)
+        self._bind_to_device()
+        self._reachable(address[0])
+        return super().connect((address[0], host_port(address[1])))
+
+    def connect_ex(self, address):
+        if self.family != socket.AF_INET:
+            return super().connect_ex(address)
+        self._bind_to_device()
+        try:
+            self._reachable(address[0])
+        except OSError as e:
+            return e.errno
+        return super().connect_ex((address[0], host_port(address[1])))
+
+    def sendto(self, data, *args):
+        address = args[-1]
+        if self.family != socket.AF_INET:
+            return super().sendto(data, *args)
+        self._bind_to_device()
+        host, port = address[0], host_port(address[1])
+        if _is_broadcast(host) and device_ip():
+            for peer in subnet_peers(device_ip()):
+                try:
+                    self._datagram(data, args[:-1], peer, port)
+                except OSError:
+                    pass  # that peer just went away
+            return len(data)
+        return self._datagram(data, args[:-1], host, port)
+
+    def _datagram(self, data, flags, host, port):
+        path = _path_to(host)
+        if path is None:
+            return super().sendto(data, *flags, (host, port))
+        if path['down'] or random.random() < path['loss']:
+            return len(data)  # lost on the air
+        _later(path['delay'], self._sendto_late, bytes(data), flags, (host, port))
+        return len(data)
+
+    def _sendto_late(self, data, flags, address):
+        try:
+            super().sendto(data, *flags, address)
+        except OSError:
+            pass  # closed meanwhile, the datagram is lost
+
+    def send(self, data, *flags):
+        if self.family != socket.AF_INET or self.type != socket.SOCK_STREAM:
+            return super().send(data, *flags)
+        try:
+            path = _path_to(self.getpeername()[0])
+        except OSError:
+            path = None
+        if path is None and not getattr(self, '_pending', 0):
+            return super().send(data, *flags)
+        if path and path['down']:
+            return len(data)  # never arrives, the peer times out
+        # delayed segments stay in order: none may overtake the one before it
+        now = time.monotonic()
+        delay = (path['delay'] + (_RTO if random.random() < path['loss'] else 0)) if path else 0
+        self._due = max(now + delay, getattr(self, '_due', now))
+        self._pending = getattr(self, '_pending', 0) + 1
+        _later(self._due - now, self._send_late, bytes(data), flags)
+        return len(data)
+
+    def _send_late(self, data, flags):
+        self._pending -= 1
+        try:
+            super().sendall(data, *flags)
+        except OSError:
+            pass  # the peer went away
+        if not self._pending and getattr(self, '_close_pending', False):
+            super().close()
+
+    def close(self):
+        if getattr(self, '_pending', 0):
+            self._close_pending = True  # close once the delayed segments are out
+            return
+        super().close()
+
+
+def install(device=None):
+    paths = [os.path.join(CODE, 'host'), os.path.join(CODE, 'common')]
+    if device:
+        paths.append(os.path.join(CODE, device))
+    for path in reversed(paths):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_diff = ticks_diff
+    time.ticks_add = ticks_add
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    sys.print_exception = print_exception
+    gc.mem_alloc = mem_alloc
+    gc.mem_free = mem_free
+    socket.socket = HostSocket
@@ -0,0 +1,237 @@
+"""
+machine module stand-in for CPython
+
+Pins, PWM outputs, timers and the watchdog are simulated, and everything
+the firmware does to them is appended to ACTIONS as
+(ticks_us, kind, ident, value):
+
+    ('pin', 21, 0)        output or driven input level changed
+    ('pwm', 22, 1400)     duty_u16 set
+    ('wdt', 0, 'feed')    watchdog fed ('start', 'expired')
+    ('reset', 0, cause)   machine.reset() or watchdog reset
+
+Inputs are changed from outside with drive(gpio, value), which runs the
+pin's IRQ handler like an edge on the real board. PRESET holds the level
+input pins read before anything drives them (pulled up ones read 1).
+
+Timer callbacks run on the uasyncio loop, so they never race the
+firmware's tasks. A reset (machine.reset() or an expired WDT) re-executes
+the process with RESTART_ARGV, reset_cause() tells the new boot why.
+"""
+import os
+import sys
+import threading
+import time
+from collections import deque
+import hostenv
+import uasyncio
+
+PWRON_RESET = 1
+WDT_RESET = 3
+
+ACTIONS = deque(maxlen=4096)
+PRESET = {}  # gpio -> level of inputs at boot
+RESTART_ARGV = [sys.executable] + sys.argv
+_RESET_CAUSE = 'FOAM_RESET_CAUSE'
+
+_levels = {}  # gpio -> level, shared by every Pin object on that gpio
+_irqs = {}  # gpio -> (handler, trigger, pin)
+
+
+def record(kind, ident, value):
+    ACTIONS.append((hostenv.ticks_us(), kind, ident, value))
+
+
+def reset_cause():
+    return int(os.environ.get(_RESET_CAUSE, PWRON_RESET))
+
+
+def reset(cause=PWRON_RESET):
+    record('reset', 0, cause)
+    print(f'machine.reset() cause {cause}, restarting')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.environ[_RESET_CAUSE] = str(cause)
+    os.execv(RESTART_ARGV[0], RESTART_ARGV)
+
+
+def soft_reset():
+    reset()
+
+
+def unique_id():
+    return hostenv.DEVICE['name'].encode()[:8]
+
+
+def freq(*_args):
+    return 125000000
+
+
+def idle():
+    time.sleep(0)
+
+
+def drive(gpio, value):
+    """ set input gpio to value from outside, running its IRQ handler on an edge """
+    value = 1 if value else 0
+    old = _levels.get(gpio, PRESET.get(gpio, 1))
+    _levels[gpio] = value
+    if value == old:
+        return
+    record('pin', gpio, value)
+    handler, trigger, pin = _irqs.get(gpio, (None, 0, None))
+    if handler and trigger & (Pin.IRQ_RISING if value else Pin.IRQ_FALLING):
+        try:
+            handler(pin)
+        except Exception as e:
+            hostenv.print_exception(e)
+
+
+def level(gpio):
+    return _levels.get(gpio, PRESET.get(gpio, 0))
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.init(mode, pull, value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if mode != -1:
+            self.mode = mode
+        if self.id not in _levels:
+            if mode == self.IN:
+                _levels[self.id] = PRESET.get(self.id, 1 if pull == self.PULL_UP else 0)
+            else:
+                _levels[self.id] = 0
+        if value is not None:
+            self.value(value)
+
+    def value(self, *args):
+        if not args:
+            return _levels.get(self.id, 0)
+        value = 1 if args[0] else 0
+        if _levels.get(self.id) != value:
+            _levels[self.id] = value
+            record('pin', self.id, value)
+        return None
+
+    __call__ = value
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def high(self):
+        self.value(1)
+
+    def low(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(not self.value())
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        _irqs[self.id] = (handler, trigger, self)
+        return self
+
+    def __repr__(self):
+        return f'Pin(GPIO{self.id})'
+
+
+class PWM:
+    def __init__(self, pin, freq=None, duty_u16=None):
+        self.pin = pin
+        self._freq = 0
+        self._duty = 0
+        if freq is not None:
+            self.freq(freq)
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+
+    def freq(self, *args):
+        if not args:
+            return self._freq
+        self._freq = args[0]
+
+    def duty_u16(self, *args):
+        if not args:
+            return self._duty
+        self._duty = args[0]
+        record('pwm', self.pin.id, args[0])
+
+    def deinit(self):
+        self._duty = 0
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        self._handle = None
+        if callback is not None:
+            self.init(mode=mode, period=period, freq=freq, callback=callback)
+
+    def init(self, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        self.deinit()
+        self.mode = mode
+        self.period = 1000 / freq if freq > 0 else max(period, 0)
+        self.callback = callback
+        self._schedule()
+
+    def _schedule(self):
+        self._handle = uasyncio.loop().call_later(self.period / 1000, self._expired)
+
+    def _expired(self):
+        self._handle = None
+        if self.mode == self.PERIODIC:
+            self._schedule()
+        try:
+            self.callback(self)
+        except Exception as e:
+            hostenv.print_exception(e)
+
+    def deinit(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+
+class WDT:
+    """
+    resets (re-executes) the process once not fed for timeout ms,
+    FOAM_WDT=0 turns that into a warning
+    """
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self._fed = time.monotonic()
+        self._armed = os.environ.get('FOAM_WDT', '1') != '0'
+        record('wdt', id, 'start')
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def feed(self):
+        self._fed = time.monotonic()
+
+    def _watch(self):
+        while True:
+            late = time.monotonic() - self._fed - self.timeout / 1000
+            if late < 0:
+                time.sleep(min(-late, 0.5))
+                continue
+            record('wdt', 0, 'expired')
+            if self._armed:
+                print(f'WDT not fed for {self.timeout}ms')
+                reset(WDT_RESET)
+            print(f'WDT not fed for {self.timeout}ms (FOAM_WDT=0, not resetting)')
+            self._fed = time.monotonic()
@@ -0,0 +1,230 @@
+"""
+network module stand-in for CPython
+
+WLAN is backed by the hostenv ether directory instead of a radio:
+
+    AP_IF active(True)    claims a subnet 127.0.<net>.0/24, takes .1 and
+                          advertises ap_<net> (ssid, channel, security...)
+    STA_IF scan()         every live ap_* file
+    STA_IF connect()      leases 127.0.<net>.<16..254> from that AP
+    status()/isconnected  LINK_UP while the AP process is alive and
+                          hostenv.impair() has not cut the link; once
+                          down it stays down until the next connect()
+
+The device's address goes to hostenv.DEVICE['ip'] so its sockets bind to it.
+Link changes are recorded in machine.ACTIONS as ('wlan', interface, 'down')
+when the firmware first sees the link down, ('wlan', interface, 'up') when
+it has connected.
+"""
+import hashlib
+import hostenv
+from machine import record
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 3
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+
+_SUBNET = '255.255.255.0'
+_RSSI = -50  # dBm every emulated AP is heard at unless its ap_ file says otherwise
+_FIRST_LEASE = 16  # like the Pico W's DHCP server
+
+_hostname = ['PicoW']
+
+
+def hostname(name=None):
+    if name is None:
+        return _hostname[0]
+    _hostname[0] = name
+
+
+def mac_of(name, interface=STA_IF):
+    """ the MAC address device name gets """
+    mac = bytearray(hashlib.md5(name.encode()).digest()[:6])
+    mac[0] = (mac[0] | 0x02) & 0xfe  # locally administered, unicast
+    mac[5] = (mac[5] + interface) & 0xff
+    return bytes(mac)
+
+
+def lease(gateway, name):
+    """ claim an address for device name on gateway's subnet, None if it is full """
+    net = gateway.rsplit('.', 1)[0]
+    for host in range(_FIRST_LEASE, 255):
+        ip = f'{net}.{host}'
+        if hostenv.claim(f'ip_{ip}', {'ip': ip, 'name': name, 'role': 'sta'}):
+            return ip
+    return None
+
+
+class WLAN:
+    PM_NONE = 0x00a11140
+    PM_PERFORMANCE = 0x00111022
+    PM_POWERSAVE = 0x00a11c82
+
+    _interfaces = {}
+
+    def __new__(cls, interface=STA_IF):
+        # like MicroPython, one object per interface
+        wlan = cls._interfaces.get(interface)
+        if wlan is None:
+            wlan = cls._interfaces[interface] = super().__new__(cls)
+            wlan._init(interface)
+        return wlan
+
+    def _init(self, interface):
+        self.interface = interface
+        self._active = False
+        self._status = STAT_IDLE
+        self._ifconfig = ('0.0.0.0', '0.0.0.0', '0.0.0.0', '0.0.0.0')
+        self._net = None  # AP: claimed subnet, STA: subnet of the AP we joined
+        self._ap = None  # STA: ap_ file name we joined
+        self._config = {
+            'mac': mac_of(hostenv.DEVICE['name'], interface), 'ssid': '', 'channel': 1, 'security': 0,
+            'password': None, 'pm': self.PM_PERFORMANCE, 'txpower': 31, 'hidden': False}
+        if interface == AP_IF:
+            self._config['ssid'] = 'PICO' + self._config['mac'][-2:].hex().upper()  # the Pico W's default
+
+    # ---- common -----------------------------------------------------------
+
+    def config(self, *args, **kwargs):
+        if args:
+            param = args[0]
+            if param == 'essid':
+                param = 'ssid'
+            if param == 'hostname':
+                return hostname()
+            if param not in self._config:
+                raise ValueError(f'unknown config param {param}')
+            return self._config[param]
+        for key, value in kwargs.items():
+            self._config['ssid' if key == 'essid' else key] = value
+        if self.interface == AP_IF and self._net is not None:
+            self._advertise()
+
+    def active(self, *args):
+        if not args:
+            return self._active
+        active = bool(args[0])
+        if active == self._active:
+            return None
+        self._active = active
+        if self.interface == AP_IF:
+            self._start_ap() if active else self._stop_ap()
+        elif not active:
+            self.disconnect()
+        return None
+
+    def ifconfig(self, *args):
+        if args:
+            self._ifconfig = tuple(args[0])
+            return None
+        return self._ifconfig
+
+    def status(self, *args):
+        if args:
+            if args[0] == 'rssi':
+                ap = hostenv.read(self._ap) if self._ap else None
+                return ap.get('rssi', _RSSI) if ap else 0
+            raise ValueError(f'unknown status param {args[0]}')
+        if self.interface == STA_IF and self._status == STAT_GOT_IP and not self._link_up():
+            # LINK_DOWN: the AP went away or the link was cut, like the CYW43
+            # the station stays off the AP until it is told to connect again
+            self._status = STAT_IDLE
+            record('wlan', self.interface, 'down')
+        return self._status
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def _link_up(self):
+        if hostenv.LINK['lost'] or self._cut():
+            return False
+        return bool(self._ap and hostenv.listing(self._ap))
+
+    @staticmethod
+    def _cut():
+        return hostenv.impairment(hostenv.DEVICE['name']).get('down', False)
+
+    # ---- access point -----------------------------------------------------
+
+    def _start_ap(self):
+        for net in range(1, 255):
+            if hostenv.claim(f'net_{net}', {'name': hostenv.DEVICE['name']}):
+                break
+        else:
+            raise OSError('no free emulated subnet')
+        self._net = net
+        ip = f'127.0.{net}.1'
+        hostenv.publish(f'ip_{ip}', {'ip': ip, 'name': hostenv.DEVICE['name'], 'role': 'ap'})
+        self._ifconfig = (ip, _SUBNET, ip, ip)
+        hostenv.DEVICE['ip'] = ip
+        self._status = STAT_GOT_IP
+        self._advertise()
+
+    def _advertise(self):
+        hostenv.publish(f'ap_{self._net}', {
+            'ssid': self._config['ssid'], 'bssid': self._config['mac'].hex(),
+            'channel': self._config['channel'], 'security': self._config['security'],
+            'password': self._config['password'], 'ip': self._ifconfig[0], 'rssi': _RSSI,
+            'hidden': self._config['hidden']})
+
+    def _stop_ap(self):
+        if self._net is None:
+            return
+        hostenv.release(f'ap_{self._net}')
+        hostenv.release(f'ip_{self._ifconfig[0]}')
+        hostenv.release(f'net_{self._net}')
+        self._net = None
+        self._status = STAT_IDLE
+
+    # ---- station ----------------------------------------------------------
+
+    def scan(self):
+        aps = []
+        if self._cut():
+            return aps  # out of range of everything
+        own = mac_of(hostenv.DEVICE['name'], AP_IF).hex()  # a radio does not hear its own beacons
+        for ap in hostenv.listing('ap_').values():
+            if ap['bssid'] == own:
+                continue
+            aps.append((
+                ap['ssid'].encode(), bytes.fromhex(ap['bssid']), ap['channel'], ap.get('rssi', _RSSI),
+                ap['security'], ap.get('hidden', False)))
+        return aps
+
+    def connect(self, ssid=None, key=None, *, bssid=None):
+        self.disconnect()
+        self._status = STAT_CONNECTING
+        for name, ap in ({} if self._cut() else hostenv.listing('ap_')).items():
+            if ap['ssid'] == ssid and (bssid is None or bytes(bssid).hex() == ap['bssid']):
+                break
+        else:
+            self._status = STAT_NO_AP_FOUND
+            return
+        if ap['security'] and key != ap['password']:
+            self._status = STAT_WRONG_PASSWORD
+            return
+        ip = lease(ap['ip'], hostenv.DEVICE['name'])
+        if ip is None:
+            self._status = STAT_CONNECT_FAIL
+            return
+        self._ap = name
+        self._config['ssid'] = ssid
+        self._config['channel'] = ap['channel']
+        self._ifconfig = (ip, _SUBNET, ap['ip'], ap['ip'])
+        hostenv.DEVICE['ip'] = ip
+        hostenv.LINK['lost'] = False
+        self._status = STAT_GOT_IP
+        record('wlan', self.interface, 'up')
+
+    def disconnect(self):
+        if self.interface == STA_IF and self._ifconfig[0] != '0.0.0.0':
+            hostenv.release(f'ip_{self._ifconfig[0]}')
+            self._ifconfig = ('0.0.0.0', '0.0.0.0', '0.0.0.0', '0.0.0.0')
+        self._ap = None
+        self._status = STAT_IDLE
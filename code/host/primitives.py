@@ -0,0 +1,172 @@
+"""
+primitives stand-in for CPython: Pushbutton, Delay_ms and launch with the
+behavior of micropython-async v3 primitives, timers on the uasyncio loop
+"""
+from time import ticks_ms, ticks_diff, ticks_add
+import uasyncio as asyncio
+
+
+def launch(func, tup_args):
+    """ call func, running it as a task if it returned a coroutine """
+    res = func(*tup_args)
+    if hasattr(res, 'send') and hasattr(res, 'throw'):
+        res = asyncio.create_task(res)
+    return res
+
+
+class Delay_ms:
+    """ retriggerable delay: func(*args) runs duration ms after the last trigger() """
+
+    def __init__(self, func=None, args=(), duration=1000):
+        self._func = func
+        self._args = args
+        self._durn = duration
+        self._retn = None
+        self._tend = None
+        self._handle = None
+        self._tout = asyncio.Event()
+        self.wait = self._tout.wait
+
+    def _expired(self):
+        self._handle = None
+        self._tout.set()
+        if self._func is not None:
+            self._retn = launch(self._func, self._args)
+
+    def trigger(self, duration=0):
+        self.stop()
+        self._tend = ticks_add(ticks_ms(), duration if duration > 0 else self._durn)
+        self._retn = None
+        self._handle = asyncio.loop().call_later(max(0, ticks_diff(self._tend, ticks_ms())) / 1000, self._expired)
+
+    def stop(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+        self._tout.clear()
+
+    def __call__(self):
+        return self._handle is not None
+
+    running = __call__
+
+    def rvalue(self):
+        return self._retn
+
+    def callback(self, func=None, args=()):
+        self._func = func
+        self._args = args
+
+    def deinit(self):
+        self.stop()
+
+
+class Pushbutton:
+    debounce_ms = 50
+    long_press_ms = 1000
+    double_click_ms = 400
+
+    def __init__(self, pin, suppress=False, sense=None):
+        self._pin = pin
+        self._supp = suppress
+        self._dblpend = False  # doubleclick waiting for 2nd click
+        self._dblran = False  # doubleclick executed user function
+        self._tf = False
+        self._ff = False
+        self._df = False
+        self._ld = False  # Delay_ms instance for long press
+        self._dd = False  # Delay_ms instance for doubleclick
+        self._sense = pin.value() if sense is None else sense  # convert from electrical to logical value
+        self._state = self.rawstate()
+        self._run = asyncio.create_task(self._go())
+
+    async def _go(self):
+        while True:
+            self._check(self.rawstate())
+            await asyncio.sleep_ms(Pushbutton.debounce_ms)
+
+    def _check(self, state):
+        if state == self._state:
+            return
+        self._state = state
+        if state:  # pressed
+            if self._tf:
+                launch(self._tf, self._ta)
+            # long press timer, unless this is the second click of a double
+            if self._ld and not (self._df and self._dd()):
+                self._ld.trigger(Pushbutton.long_press_ms)
+            if self._df:
+                if self._dd():  # second click
+                    self._dd.stop()
+                    self._dblpend = False
+                    self._dblran = True  # no suppressed release func
+                    launch(self._df, self._da)
+                else:
+                    self._dd.trigger(Pushbutton.double_click_ms)
+                    self._dblpend = True
+        else:  # released
+            if self._ff:
+                if self._supp:
+                    d = self._ld
+                    if not self._dblpend and not self._dblran:
+                        if (d and d()) or not d:
+                            launch(self._ff, self._fa)
+                else:
+                    launch(self._ff, self._fa)
+            if self._ld:
+                self._ld.stop()  # a second click is not a long press
+            self._dblran = False
+
+    def _ddto(self):  # no second click in time
+        self._dblpend = False
+        if self._ff and self._supp and not self._state:
+            if not self._ld or (self._ld and not self._ld()):
+                launch(self._ff, self._fa)
+
+    def press_func(self, func=False, args=()):
+        if func is None:
+            self.press = asyncio.Event()
+            func = self.press.set
+        self._tf = func
+        self._ta = args
+
+    def release_func(self, func=False, args=()):
+        if func is None:
+            self.release = asyncio.Event()
+            func = self.release.set
+        self._ff = func
+        self._fa = args
+
+    def double_func(self, func=False, args=()):
+        if func is None:
+            self.double = asyncio.Event()
+            func = self.double.set
+        self._df = func
+        self._da = args
+        if func:
+            if not self._dd:
+                self._dd = Delay_ms(self._ddto)
+        else:
+            self._dd = False
+
+    def long_func(self, func=False, args=()):
+        if func is None:
+            self.long = asyncio.Event()
+            func = self.long.set
+        if func:
+            if self._ld:
+                self._ld.callback(func, args)
+            else:
+                self._ld = Delay_ms(func, args)
+        else:
+            self._ld = False
+
+    def rawstate(self):
+        """ current non-debounced logical state, True == pressed """
+        return bool(self._pin() ^ self._sense)
+
+    def __call__(self):
+        return self._state
+
+    def deinit(self):
+        self._run.cancel()
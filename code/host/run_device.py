@@ -0,0 +1,116 @@
+"""
+Boot clacker/main.py or claymore/main.py unmodified under CPython
+
+    python3 host/run_device.py clacker --state /tmp/foam/clacker
+    python3 host/run_device.py claymore --state /tmp/foam/claymore1 --name claymore1
+
+Every device is its own process. They find each other through the ether
+directory (--ether, shared by all devices of one test) and talk over
+loopback, each on its own 127.0.<net>.<host> address; see hostenv.py.
+The state directory stands in for the device's flash (db files); the
+firmware's html/ folder is linked into it.
+
+Options:
+    --hardware red|green   which clacker hardware_<color>.py is hardware.py
+    --pin GPIO=LEVEL       input level at boot, e.g. --pin 21=0 (claymore
+                           door closed), repeatable
+    --name NAME            device name (hostname seed, MAC), default the
+                           state directory's name
+    --tracemalloc          trace Python allocations so gc.mem_alloc() (and
+                           mem_alloc in GET /metrics) reports the heap in use
+
+While running, the device answers JSON datagrams on the control port it
+publishes in the ether as ctl_<name>:
+    {"cmd": "drive", "gpio": 21, "value": 0}      change an input pin
+    {"cmd": "actions", "since": 0, "kind": "pwm"}  machine.ACTIONS after index
+                                                   since, optionally one kind
+"""
+import argparse
+import json
+import os
+import runpy
+import sys
+
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_CONTROL_REPLY = 60000  # bytes, keeps a reply inside one loopback datagram
+
+
+def _control(sock):
+    import machine
+    try:
+        data, addr = sock.recvfrom(2048)
+        cmd = json.loads(data)
+        if cmd['cmd'] == 'drive':
+            machine.drive(cmd['gpio'], cmd['value'])
+            reply = {'ok': True}
+        elif cmd['cmd'] == 'actions':
+            actions = list(machine.ACTIONS)
+            kind = cmd.get('kind')
+            reply = {
+                'actions': [a for a in actions[cmd.get('since', 0):] if kind is None or a[1] == kind],
+                'next': len(actions)}
+        else:
+            reply = {'error': f"unknown cmd {cmd['cmd']}"}
+        reply = json.dumps(reply).encode()
+        sock.sendto(reply if len(reply) < _CONTROL_REPLY else b'{"error": "reply too long"}', addr)
+    except (OSError, ValueError, KeyError) as e:
+        print('control:', repr(e))
+
+
+def start_control(name):
+    """ control datagram socket on 127.0.0.1, advertised in the ether """
+    import socket
+    import hostenv
+    import uasyncio
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.setblocking(False)
+    uasyncio.loop().add_reader(sock.fileno(), _control, sock)
+    hostenv.publish(f'ctl_{name}', {'port': sock.getsockname()[1]})
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('device', choices=['clacker', 'claymore'])
+    parser.add_argument('--state', required=True, help='directory standing in for the flash filesystem')
+    parser.add_argument('--ether', default=os.environ.get('FOAM_ETHER', '/tmp/foam-ether'))
+    parser.add_argument('--name')
+    parser.add_argument('--hardware', default='red', choices=['red', 'green'])
+    parser.add_argument('--pin', action='append', default=[], help='GPIO=LEVEL input level at boot')
+    parser.add_argument('--tracemalloc', action='store_true')
+    args = parser.parse_args()
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+
+    state = os.path.abspath(args.state)
+    name = args.name or os.path.basename(state)
+    os.environ['FOAM_ETHER'] = args.ether
+    os.environ['FOAM_DEVICE'] = name
+    sys.path.insert(0, os.path.join(CODE, 'host'))
+    import hostenv
+    hostenv.install(args.device)
+
+    import machine
+    machine.RESTART_ARGV = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+    for pin in args.pin:
+        gpio, level = pin.split('=')
+        machine.PRESET[int(gpio)] = int(level)
+    if args.device == 'clacker':
+        import importlib
+        sys.modules['hardware'] = importlib.import_module(f'hardware_{args.hardware}')
+
+    os.makedirs(state, exist_ok=True)
+    html = os.path.join(state, 'html')
+    if not os.path.exists(html):
+        os.symlink(os.path.join(CODE, args.device, 'html'), html)
+    os.chdir(state)
+
+    start_control(name)
+    sys.argv = ['main.py']
+    runpy.run_path(os.path.join(CODE, args.device, 'main.py'), run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
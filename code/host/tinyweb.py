@@ -0,0 +1,285 @@
+"""
+tinyweb stand-in for CPython
+
+The subset of tinyweb's webserver the firmware uses, with the same
+behavior: routes and RESTful resources (URLs may hold <params>), at most
+max_concurrency requests served at once, every response closes its
+connection. Built on asyncio streams; the sockets come from hostenv, so
+the server listens on the device's loopback address.
+"""
+import json
+import sys
+import uasyncio as asyncio
+
+_REASONS = {
+    200: 'OK', 302: 'Found', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HTTPException(Exception):
+    def __init__(self, code=400):
+        super().__init__(code)
+        self.code = code
+
+
+def parse_query_string(s):
+    res = {}
+    for pair in s.split('&'):
+        if not pair:
+            continue
+        key, _, value = pair.partition('=')
+        res[unquote_plus(key)] = unquote_plus(value)
+    return res
+
+
+def unquote_plus(s):
+    s = s.replace('+', ' ')
+    parts = s.split('%')
+    out = [parts[0]]
+    for part in parts[1:]:
+        try:
+            out.append(chr(int(part[:2], 16)) + part[2:])
+        except ValueError:
+            out.append('%' + part)
+    return ''.join(out)
+
+
+class request:
+    def __init__(self, reader):
+        self.reader = reader
+        self.headers = {}
+        self.method = b''
+        self.path = b''
+        self.query_string = b''
+
+    async def read_request_line(self):
+        while True:
+            rl = await self.reader.readline()
+            if not rl:
+                raise HTTPException(400)
+            if rl != b'\r\n':
+                break
+        fields = rl.split(None, 2)
+        if len(fields) < 2:
+            raise HTTPException(400)
+        self.method = fields[0]
+        url = fields[1].split(b'?', 1)
+        self.path = url[0]
+        self.query_string = url[1] if len(url) > 1 else b''
+
+    async def read_headers(self, save_headers=()):
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.partition(b':')
+            if not save_headers or name.strip().lower() in save_headers:
+                self.headers[name.strip()] = value.strip()
+
+    def header(self, name):
+        name = name.lower()
+        for key, value in self.headers.items():
+            if key.lower() == name:
+                return value
+        return None
+
+    async def read_body(self, max_size):
+        size = int(self.header(b'content-length') or 0)
+        if size > max_size:
+            raise HTTPException(413)
+        return await self.reader.readexactly(size) if size else b''
+
+    async def read_parse_form_data(self):
+        body = await self.read_body(1024)
+        return parse_query_string(body.decode())
+
+
+class response:
+    def __init__(self, writer):
+        self.writer = writer
+        self.send = self._send
+        self.code = 200
+        self.version = '1.0'
+        self.headers = {}
+        self.headers_sent = False
+
+    async def _send(self, content, **kwargs):
+        if not self.headers_sent:
+            await self._send_headers()
+        self.writer.write(content.encode() if isinstance(content, str) else content)
+        await self.writer.drain()
+
+    def add_header(self, key, value):
+        self.headers[key] = value
+
+    def add_access_control_headers(self):
+        self.add_header('Access-Control-Allow-Origin', '*')
+
+    async def _send_headers(self):
+        lines = [f'HTTP/{self.version} {self.code} {_REASONS.get(self.code, "NA")}']
+        lines.extend(f'{k}: {v}' for k, v in self.headers.items())
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        self.headers_sent = True
+        await self.writer.drain()
+
+    async def error(self, code, msg=None):
+        self.code = code
+        if msg:
+            self.add_header('Content-Length', len(msg))
+        await self._send_headers()
+        if msg:
+            await self._send(msg)
+
+    async def redirect(self, location, msg=None):
+        self.code = 302
+        self.add_header('Location', location)
+        if msg:
+            self.add_header('Content-Length', len(msg))
+        await self._send_headers()
+        if msg:
+            await self._send(msg)
+
+    async def start_html(self):
+        self.add_header('Content-Type', 'text/html')
+        await self._send_headers()
+
+
+async def restful_resource_handler(req, resp, param=None, **params):
+    body = await req.read_body(param['max_body_size'])
+    if req.method == b'GET':
+        data = parse_query_string(req.query_string.decode())
+    elif (req.header(b'content-type') or b'').startswith(b'application/json'):
+        data = json.loads(body) if body else {}
+    else:
+        data = parse_query_string(body.decode())
+    res = param['_' + req.method.decode().lower()](data, **params)
+    if isinstance(res, tuple):
+        resp.code = res[1]
+        res = res[0]
+    if res is None:
+        raise Exception('Result expected')
+    res = json.dumps(res) if isinstance(res, dict) else str(res)
+    resp.add_header('Content-Type', 'application/json')
+    resp.add_header('Content-Length', str(len(res)))
+    await resp.send(res)
+
+
+class webserver:
+    def __init__(self, request_timeout=3, max_concurrency=3, backlog=16, debug=False):
+        self.request_timeout = request_timeout
+        self.max_concurrency = max_concurrency
+        self.backlog = backlog
+        self.debug = debug
+        self.explicit_url_map = {}  # url -> (handler, params)
+        self.parameterized_url_map = []  # ([segments], handler, params)
+        self.conns = 0
+        self._slots = None
+        self.server = None
+
+    def add_route(self, url, f, **kwargs):
+        if url == '' or '?' in url:
+            raise ValueError('Invalid URL')
+        params = {'methods': ['GET'], 'save_headers': [], 'max_body_size': 1024}
+        params.update(kwargs)
+        params['methods'] = [m.encode().upper() for m in params['methods']]
+        params['save_headers'] = [h.encode().lower() for h in params['save_headers']]
+        if '<' in url:
+            self.parameterized_url_map.append((url.encode().split(b'/'), f, params))
+        else:
+            self.explicit_url_map[url.encode()] = (f, params)
+
+    def add_resource(self, cls, url, **kwargs):
+        inst = cls() if isinstance(cls, type) else cls
+        methods = []
+        callmap = {}
+        for m in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE'):
+            fn = getattr(inst, m.lower(), None)
+            if fn:
+                methods.append(m)
+                callmap['_' + m.lower()] = fn
+        # '_resource': the handler gets the route params, to find the resource's methods
+        params = {'methods': methods, 'save_headers': ['Content-Length', 'Content-Type'], '_resource': True}
+        params.update(kwargs)
+        params.update(callmap)
+        self.add_route(url, restful_resource_handler, **params)
+
+    def route(self, url, **kwargs):
+        def _route(f):
+            self.add_route(url, f, **kwargs)
+            return f
+        return _route
+
+    def _find(self, path):
+        if path in self.explicit_url_map:
+            f, params = self.explicit_url_map[path]
+            return f, params, {}
+        segments = path.split(b'/')
+        for pattern, f, params in self.parameterized_url_map:
+            if len(pattern) != len(segments):
+                continue
+            urlparams = {}
+            for want, got in zip(pattern, segments):
+                if want.startswith(b'<') and want.endswith(b'>'):
+                    urlparams[want[1:-1].decode()] = got.decode()
+                elif want != got:
+                    break
+            else:
+                return f, params, urlparams
+        return None, None, None
+
+    async def _handle_request(self, req, resp):
+        await req.read_request_line()
+        f, params, urlparams = self._find(req.path)
+        if f is None:
+            await req.read_headers()
+            raise HTTPException(404)
+        await req.read_headers(params['save_headers'])
+        if req.method not in params['methods']:
+            raise HTTPException(405)
+        if params.get('_resource'):
+            await f(req, resp, param=params, **urlparams)
+        else:
+            await f(req, resp, **urlparams)
+
+    async def _handler(self, reader, writer):
+        await self._slots.acquire()  # waits while max_concurrency requests are being served
+        self.conns += 1
+        resp = response(writer)
+        try:
+            await asyncio.wait_for(self._handle_request(request(reader), resp), self.request_timeout)
+        except HTTPException as e:
+            try:
+                await resp.error(e.code)
+            except Exception:
+                pass
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            if self.debug:
+                sys.print_exception(e)
+            try:
+                if not resp.headers_sent:
+                    await resp.error(500)
+            except Exception:
+                pass
+        finally:
+            self.conns -= 1
+            self._slots.release()
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _serve(self, host, port):
+        self.server = await asyncio.start_server(self._handler, host, port, backlog=self.backlog)
+
+    def run(self, host='127.0.0.1', port=8081, loop_forever=True):
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        asyncio.create_task(self._serve(host, port))
+        if loop_forever:
+            asyncio.get_event_loop().run_forever()
+
+    def shutdown(self):
+        if self.server:
+            self.server.close()
@@ -0,0 +1,112 @@
+"""
+uasyncio stand-in for CPython: asyncio plus the MicroPython-only extras
+the firmware uses (sleep_ms, wait_for_ms, core._io_queue.queue_read)
+
+MicroPython has one event loop that exists from import, so the firmware
+creates tasks at module level (hardware self tests, Pushbuttons) before
+anything runs, and calls loop.run_forever() from inside its main task.
+Here too there is exactly one loop, made at import:
+
+- create_task() works before the loop runs, the task starts with it,
+- get_event_loop().run_forever() inside the running loop only notes that
+  run() should keep the loop going once main returns,
+- machine.Timer and primitives schedule their callbacks on it.
+"""
+import asyncio as _asyncio
+from asyncio import *  # noqa: F401,F403
+
+_loop = _asyncio.new_event_loop()
+_asyncio.set_event_loop(_loop)
+_forever = [False]  # main asked for run_forever()
+
+
+def loop():
+    """
+    the running event loop, else the one made at import (host tools like
+    bench/ may run their own with asyncio.run)
+    """
+    try:
+        return _asyncio.get_running_loop()
+    except RuntimeError:
+        return _loop
+
+
+async def sleep_ms(ms):
+    await _asyncio.sleep(ms / 1000)
+
+
+async def wait_for_ms(aw, timeout_ms):
+    return await _asyncio.wait_for(aw, timeout_ms / 1000)
+
+
+def create_task(coro):
+    return loop().create_task(coro)
+
+
+class _EventLoop:
+    """ what get_event_loop() returns: the MicroPython loop API over _loop """
+
+    def create_task(self, coro):
+        return loop().create_task(coro)
+
+    def run_forever(self):
+        if _loop.is_running():
+            _forever[0] = True
+        else:
+            _loop.run_forever()
+
+    def run_until_complete(self, aw):
+        return _loop.run_until_complete(aw)
+
+    def set_exception_handler(self, handler):
+        _loop.set_exception_handler(handler)
+
+    def get_exception_handler(self):
+        return _loop.get_exception_handler()
+
+    def stop(self):
+        _loop.stop()
+
+    def close(self):
+        pass
+
+
+_event_loop = _EventLoop()
+
+
+def get_event_loop(*_args):
+    return _event_loop
+
+
+def new_event_loop():
+    return _event_loop
+
+
+def run(coro):
+    """ run coro to completion, then forever if it called loop.run_forever() """
+    result = _loop.run_until_complete(coro)
+    if _forever[0]:
+        _loop.run_forever()
+    return result
+
+
+class _IOQueue:
+    def queue_read(self, sock):
+        """ future that completes once sock is readable, yielded by helpers.wait_readable """
+        running = _asyncio.get_running_loop()
+        fut = running.create_future()
+        fd = sock.fileno()
+
+        def ready():
+            running.remove_reader(fd)
+            if not fut.done():
+                fut.set_result(None)
+
+        running.add_reader(fd, ready)
+        fut.add_done_callback(lambda _f: running.remove_reader(fd))
+        fut._asyncio_future_blocking = True
+        return fut
+
+
+class core:
+    _io_queue = _IOQueue()